@@ -0,0 +1,241 @@
+"""Client-side parsing speed: lines per second through IRCClient.parse_message,
+against the substring-matching parser it replaced.
+
+Uses a captured corpus (one raw server line per line, without \\r\\n) if one is
+given, otherwise generates one shaped like server.py's traffic: mostly channel
+PRIVMSGs, some of them mentioning JOIN, KICK or NICK, plus joins, parts,
+quits, nick changes, numerics, notices and PINGs. It also counts the
+PRIVMSG lines the old parser showed as something else.
+
+    python benchmarks/client_parse.py --lines 200000
+    python benchmarks/client_parse.py --corpus captured.txt
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import Colors, IRCClient, Message
+
+WORDS = ("hello", "anyone", "around", "the", "build", "is", "green", "again", "lunch", "?", "ok", "thanks",
+         "deploying", "now", "JOIN", "KICK", "NICK", "PART", "QUIT", "me", "later", "channel", "#general")
+
+def generate_corpus(count, seed=1):
+    rng = random.Random(seed)
+    nicks = [f"user{i}" for i in range(200)]
+    channels = ["#general", "#main", "#help", "#dev", "#random"]
+    lines = []
+    for _ in range(count):
+        nick = rng.choice(nicks)
+        channel = rng.choice(channels)
+        roll = rng.random()
+        if roll < 0.80:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 14)))
+            if roll < 0.02:
+                text = f"\x01ACTION {text}\x01"
+            target = channel if roll < 0.75 else rng.choice(nicks)
+            lines.append(f":{nick} PRIVMSG {target} :{text}")
+        elif roll < 0.85:
+            lines.append(f":{nick} JOIN {channel}")
+        elif roll < 0.89:
+            lines.append(f":{nick} PART {channel}")
+        elif roll < 0.91:
+            lines.append(f":{nick} QUIT :Connection closed")
+        elif roll < 0.93:
+            lines.append(f":{nick} NICK :{nick}_")
+        elif roll < 0.95:
+            lines.append(f":server 353 me = {channel} :" + " ".join(rng.sample(nicks, 40)))
+            lines.append(f":server 366 me {channel} :End of /NAMES list")
+        elif roll < 0.97:
+            lines.append(f":server NOTICE me :*** 20 messages of {channel} history")
+        else:
+            lines.append("PING :server")
+    return lines[:count]
+
+def load_corpus(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return [line.rstrip("\r\n") for line in f if line.strip()]
+
+def run(parse, client, corpus):
+    start = time.perf_counter()
+    for line in corpus:
+        parse(client, line)
+    return len(corpus) / (time.perf_counter() - start)
+
+def legacy_parse_message(self, raw):
+    """IRCClient.parse_message as it was before Message: substring checks in a
+    fixed order, re-scanning the line for each one."""
+    if not raw:
+        return None
+
+    if raw.startswith('PING'):
+        self.send_command(f"PONG {raw[5:]}")
+        return None
+
+    timestamp = f"{Colors.GRAY}[{time.strftime('%H:%M:%S')}]{Colors.RESET}"
+
+    if raw.startswith('ERROR'):
+        try:
+            reason = raw.split(':', 1)[1].strip()
+            return f"{timestamp} {Colors.RED}*** ERROR: {reason}{Colors.RESET}"
+        except:
+            return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
+
+    if 'KICK' in raw:
+        try:
+            parts = raw.split()
+            nick = parts[3]
+            channel = parts[2]
+            reason = raw.split(':', 1)[1] if ':' in raw else "No reason given"
+            return f"{timestamp} {Colors.RED}*** You have been kicked from {channel}: {reason}{Colors.RESET}"
+        except:
+            return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
+
+    if raw.split()[0].isdigit():
+        parts = raw.split()
+        code = parts[0]
+        message = raw[raw.find(':', 1)+1:] if ':' in raw else ' '.join(parts[3:])
+        if code in ('001', '002', '003', '004', '005'):
+            return f"{timestamp} {Colors.GREEN}●{Colors.RESET} {message}"
+        elif code in ('372', '375', '376'):
+            return f"{timestamp} {Colors.BLUE}●{Colors.RESET} {message}"
+        elif code == '353':
+            channel = parts[4]
+            names = message
+            return f"{timestamp} {Colors.CYAN}Users in {channel}:{Colors.RESET} {names}"
+        elif code == '366':
+            return None
+        else:
+            return f"{timestamp} {Colors.YELLOW}●{Colors.RESET} {message}"
+
+    if 'NOTICE' in raw:
+        try:
+            if ':' in raw:
+                message = raw.split(':', 1)[1].strip()
+            else:
+                message = raw
+            return f"{timestamp} {Colors.GRAY}-NOTICE- {message}{Colors.RESET}"
+        except:
+            return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
+
+    if 'PRIVMSG' in raw:
+        try:
+            sender_start = raw.find(':') + 1
+            prefix_end = raw.find(' ', sender_start)
+            if prefix_end == -1:
+                prefix_end = len(raw)
+            prefix = raw[sender_start:prefix_end]
+            nick_end = prefix.find('!')
+            if nick_end == -1:
+                sender = prefix
+            else:
+                sender = prefix[:nick_end]
+
+            msg_start = raw.find('PRIVMSG ') + 8
+            target_end = raw.find(' ', msg_start)
+            if target_end == -1:
+                target_end = raw.find(':', msg_start)
+            target = raw[msg_start:target_end].strip()
+
+            content_start = raw.find(':', target_end) + 1
+            message = raw[content_start:]
+
+            if message.startswith('\x01ACTION') and message.endswith('\x01'):
+                action = message[7:-1]
+                return f"{timestamp} {Colors.MAGENTA}*{Colors.RESET} {Colors.YELLOW}{sender}{Colors.RESET} {action}"
+
+            if target.startswith('#'):
+                return f"{timestamp} {Colors.BLUE}<{target}>{Colors.RESET} {Colors.YELLOW}<{sender}>{Colors.RESET}: {message}"
+            else:
+                return f"{timestamp} {Colors.MAGENTA}*{sender}*{Colors.RESET} {message}"
+        except Exception:
+            return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
+
+    elif 'JOIN' in raw:
+        try:
+            sender_start = raw.find(':') + 1
+            sender_end = raw.find('!', sender_start)
+            if sender_end == -1:
+                sender_end = raw.find(' ', sender_start)
+            sender = raw[sender_start:sender_end]
+
+            channel_start = raw.find('JOIN') + 5
+            channel = raw[channel_start:].strip()
+            if channel.startswith(':'):
+                channel = channel[1:]
+            return f"{timestamp} {Colors.GREEN}-->{Colors.RESET} {Colors.YELLOW}{sender}{Colors.RESET} joined {Colors.BLUE}{channel}{Colors.RESET}"
+        except:
+            return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
+
+    elif 'PART' in raw:
+        try:
+            sender_start = raw.find(':') + 1
+            sender_end = raw.find('!', sender_start)
+            if sender_end == -1:
+                sender_end = raw.find(' ', sender_start)
+            sender = raw[sender_start:sender_end]
+
+            channel_start = raw.find('PART') + 5
+            channel = raw[channel_start:].strip()
+            if channel.startswith(':'):
+                channel = channel[1:]
+            return f"{timestamp} {Colors.RED}<--{Colors.RESET} {Colors.YELLOW}{sender}{Colors.RESET} left {Colors.BLUE}{channel}{Colors.RESET}"
+        except:
+            return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
+
+    elif 'QUIT' in raw:
+        try:
+            sender_start = raw.find(':') + 1
+            sender_end = raw.find('!', sender_start)
+            if sender_end == -1:
+                sender_end = raw.find(' ', sender_start)
+            sender = raw[sender_start:sender_end]
+            return f"{timestamp} {Colors.RED}<--{Colors.RESET} {Colors.YELLOW}{sender}{Colors.RESET} disconnected"
+        except:
+            return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
+
+    elif 'NICK' in raw:
+        try:
+            sender_start = raw.find(':') + 1
+            sender_end = raw.find('!', sender_start)
+            if sender_end == -1:
+                sender_end = raw.find(' ', sender_start)
+            old_nick = raw[sender_start:sender_end]
+
+            new_nick = raw.split(':')[-1]
+            return f"{timestamp} {Colors.YELLOW}{old_nick}{Colors.RESET} is now known as {Colors.YELLOW}{new_nick}{Colors.RESET}"
+        except:
+            return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
+
+    if raw.strip().startswith(':') and len(raw.strip().split()) == 1:
+        return None
+    return f"{timestamp} {raw}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", help="File of captured server lines")
+    parser.add_argument("--lines", type=int, default=200000, help="Size of the generated corpus")
+    parser.add_argument("--repeat", type=int, default=3, help="Best of this many runs")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else generate_corpus(args.lines)
+    client = IRCClient()
+    client.nick = "me"
+    # Nothing is connected, PONGs go nowhere
+    client.send_command = lambda command: None
+
+    current = max(run(IRCClient.parse_message, client, corpus) for _ in range(args.repeat))
+    legacy = max(run(legacy_parse_message, client, corpus) for _ in range(args.repeat))
+
+    privmsgs = [line for line in corpus if Message.parse(line).command == "PRIVMSG"]
+    chat = (f"{Colors.BLUE}<", f"{Colors.MAGENTA}*")
+    misrouted = sum(1 for line in privmsgs
+                    if not (legacy_parse_message(client, line) or "").split(" ", 1)[-1].startswith(chat))
+    print(f"{len(corpus)} lines")
+    print(f"{'parser':>8} {'lines/s':>12}")
+    print(f"{'legacy':>8} {legacy:>12,.0f}")
+    print(f"{'current':>8} {current:>12,.0f}  ({current / legacy:.2f}x)")
+    print(f"legacy parser showed {misrouted} of {len(privmsgs)} PRIVMSG lines as something else")
@@ -0,0 +1,110 @@
+"""Client receive path: framing and decoding speed of IRCClient.split_lines,
+against the str buffer it replaced.
+
+Feeds a generated stream of server lines, a third of the chat in multibyte
+text, through both in reads of --chunk bytes, then once more as a single
+burst the size of a big NAMES reply. The old path decoded each read on its
+own, so it also counts the reads that split a character and would have
+killed the connection; for timing it is given reads cut at character
+boundaries instead.
+
+    python benchmarks/client_recv.py --lines 200000 --chunk 4096
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import IRCClient
+
+WORDS = ("hello", "anyone", "around", "the", "build", "is", "green", "ok", "thanks", "later")
+MULTIBYTE = ("привет", "спасибо", "こんにちは", "ありがとう", "café", "naïve", "🙂", "👍", "你好", "谢谢")
+
+def generate_stream(count, seed=1):
+    rng = random.Random(seed)
+    nicks = [f"user{i}" for i in range(200)]
+    lines = []
+    for _ in range(count):
+        words = MULTIBYTE if rng.random() < 0.33 else WORDS
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(2, 14)))
+        lines.append(f":{rng.choice(nicks)} PRIVMSG #general :{text}\r\n")
+    return "".join(lines).encode("utf-8")
+
+def names_burst(count):
+    nicks = " ".join(f"user{i}" for i in range(40))
+    return "".join(f":server 353 me = #big :{nicks}\r\n" for _ in range(count)).encode("utf-8")
+
+def chunks(data, size, whole_characters=False):
+    out = []
+    start = 0
+    while start < len(data):
+        end = min(start + size, len(data))
+        if whole_characters:
+            # Back up over UTF-8 continuation bytes
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                end -= 1
+        out.append(data[start:end])
+        start = end
+    return out
+
+def legacy_feed(reads):
+    """receive_loop's framing as it was: decode each read, append to a str
+    buffer and split one line off the front at a time."""
+    count = 0
+    buffer = ""
+    for data in reads:
+        buffer += data.decode('utf-8')
+        while '\r\n' in buffer:
+            line, buffer = buffer.split('\r\n', 1)
+            count += 1
+    return count
+
+def current_feed(client, reads):
+    count = 0
+    buffer = bytearray()
+    for data in reads:
+        buffer += data
+        count += len(client.split_lines(buffer))
+    return count
+
+def split_characters(reads):
+    failed = 0
+    for data in reads:
+        try:
+            data.decode('utf-8')
+        except UnicodeDecodeError:
+            failed += 1
+    return failed
+
+def best(repeat, feed, *args):
+    rate = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lines = feed(*args)
+        rate = max(rate, lines / (time.perf_counter() - start))
+    return rate
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=200000, help="Lines in the chat stream")
+    parser.add_argument("--chunk", type=int, default=IRCClient.RECV_SIZE, help="Bytes per read")
+    parser.add_argument("--burst", type=int, default=20000, help="353 lines in the single-read burst")
+    parser.add_argument("--repeat", type=int, default=3, help="Best of this many runs")
+    args = parser.parse_args()
+
+    client = IRCClient()
+    stream = generate_stream(args.lines)
+    burst = [names_burst(args.burst)]
+    raw_reads = chunks(stream, args.chunk)
+    legacy_reads = chunks(stream, args.chunk, whole_characters=True)
+
+    print(f"{args.lines} lines, {len(stream):,} bytes, {args.chunk}-byte reads")
+    print(f"{'case':>8} {'legacy lines/s':>15} {'current lines/s':>16}")
+    for name, legacy_input, current_input in (("stream", legacy_reads, raw_reads), ("burst", burst, burst)):
+        legacy = best(args.repeat, legacy_feed, legacy_input)
+        current = best(args.repeat, current_feed, client, current_input)
+        print(f"{name:>8} {legacy:>15,.0f} {current:>16,.0f}  ({current / legacy:.2f}x)")
+    print(f"legacy decode would have failed on {split_characters(raw_reads)} of {len(raw_reads)} reads")
@@ -0,0 +1,112 @@
+"""Client terminal output for a burst of server lines: time to show them and
+writes/flushes to stdout, frame-batched rendering against the per-line
+redraw it replaced.
+
+stdout is swapped for a counter that sends each flush to /dev/null, so the
+numbers are the client's own cost, not a terminal's. The burst is a NAMES
+reply followed by channel chat, fed to handle_server_message as fast as
+receive_loop would after one big read.
+
+    python benchmarks/client_render.py --lines 20000
+"""
+import argparse
+import os
+import readline
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import Colors, IRCClient
+
+class CountingStdout:
+    def __init__(self):
+        self.fd = os.open(os.devnull, os.O_WRONLY)
+        self.parts = []
+        self.writes = 0
+        self.flushes = 0
+
+    def write(self, text):
+        self.writes += 1
+        self.parts.append(text)
+        # A terminal stdout is line buffered, so a newline is a flush too
+        if '\n' in text:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.flushes += 1
+            os.write(self.fd, ''.join(self.parts).encode())
+            self.parts = []
+
+def legacy_handle_server_message(self, message):
+    """handle_server_message as it was: erase, print and redraw the prompt
+    for every line."""
+    formatted = self.parse_message(message)
+    if not formatted:
+        return
+    try:
+        current_buf = readline.get_line_buffer()
+    except Exception:
+        current_buf = ''
+    sys.stdout.write('\r')
+    sys.stdout.write(' ' * (len(self.input_prompt) + len(current_buf)))
+    sys.stdout.write('\r')
+    print(formatted)
+    sys.stdout.write(self.input_prompt + current_buf)
+    sys.stdout.flush()
+
+def legacy_timestamp():
+    return f"{Colors.GRAY}[{time.strftime('%H:%M:%S')}]{Colors.RESET}"
+
+def burst(count):
+    nicks = " ".join(f"user{i}" for i in range(40))
+    lines = [f":server 353 me = #big :{nicks}" for _ in range(count // 4)]
+    lines += [f":user{i % 300} PRIVMSG #big :message number {i} in the burst" for i in range(count - len(lines))]
+    return lines
+
+def run_legacy(lines):
+    client = IRCClient()
+    client.input_prompt = "[#big]> "
+    client.timestamp = legacy_timestamp
+    out = sys.stdout = CountingStdout()
+    start = time.perf_counter()
+    for line in lines:
+        legacy_handle_server_message(client, line)
+    return time.perf_counter() - start, out
+
+def run_current(lines, frame_interval):
+    client = IRCClient(frame_interval=frame_interval)
+    client.input_prompt = "[#big]> "
+    client.running = True
+    out = sys.stdout = CountingStdout()
+    start = time.perf_counter()
+    client.render_thread = threading.Thread(target=client.render_loop, daemon=True)
+    client.render_thread.start()
+    for line in lines:
+        client.handle_server_message(line)
+    # On disconnect render_loop draws what is still queued, then returns
+    client.running = False
+    client.render_ready.set()
+    client.render_thread.join()
+    return time.perf_counter() - start, out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=20000, help="Lines in the burst")
+    parser.add_argument("--frame-interval", type=float, default=IRCClient.FRAME_INTERVAL)
+    args = parser.parse_args()
+
+    lines = burst(args.lines)
+    stdout = sys.stdout
+    try:
+        legacy_seconds, legacy = run_legacy(lines)
+        current_seconds, current = run_current(lines, args.frame_interval)
+    finally:
+        sys.stdout = stdout
+
+    print(f"{len(lines)} lines")
+    print(f"{'render':>8} {'seconds':>8} {'writes':>8} {'flushes':>8}")
+    print(f"{'legacy':>8} {legacy_seconds:>8.3f} {legacy.writes:>8} {legacy.flushes:>8}")
+    print(f"{'current':>8} {current_seconds:>8.3f} {current.writes:>8} {current.flushes:>8}")
@@ -0,0 +1,99 @@
+"""Client /search speed over a large generated chat log.
+
+Writes --lines messages spread over --channels channels and --days days of
+timestamps into a temporary log directory through ChatLog, then times:
+opening the log (what client startup pays), the first search, repeated
+searches, and a plain scan of every segment file for the same words, which
+is what searching without the index would cost.
+
+    python benchmarks/client_search.py --lines 1000000 --channels 10
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import ChatLog
+
+WORDS = ("hello", "anyone", "around", "the", "build", "is", "green", "again", "lunch", "ok", "thanks",
+         "deploying", "now", "later", "review", "merged", "release", "tests", "flaky", "rollback",
+         "coffee", "meeting", "docs", "bug", "fixed", "ticket", "prod", "staging", "cache", "latency")
+
+def fill(root, lines, channels, days, seed=1):
+    rng = random.Random(seed)
+    log = ChatLog(root)
+    start = time.time() - days * 86400
+    step = days * 86400 / lines
+    names = [f"#chan{i}" for i in range(channels)]
+    for first in range(0, lines, 50000):
+        log.pending.extend((rng.choice(names), start + i * step, f"user{rng.randrange(500)}",
+                            " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 16))))
+                           for i in range(first, min(lines, first + 50000)))
+        log.flush()
+    log.close()
+
+def scan(root, terms):
+    """Every line of every segment, checked for all terms."""
+    found = 0
+    for channel in os.listdir(root):
+        path = os.path.join(root, channel)
+        for entry in os.listdir(path):
+            if entry.endswith('.log'):
+                with open(os.path.join(path, entry), 'rb') as f:
+                    for line in f:
+                        words = set(ChatLog.WORD.findall(line.decode('utf-8', 'replace').lower()))
+                        if terms <= words:
+                            found += 1
+    return found
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=1000000)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--query", default="flaky rollback")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        fill(root, args.lines, args.channels, args.days)
+        fill_seconds = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(dirpath, name))
+                   for dirpath, _, names in os.walk(root) for name in names)
+
+        start = time.perf_counter()
+        log = ChatLog(root)
+        open_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        first = log.search(args.query)
+        first_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            log.search(args.query)
+        warm_ms = (time.perf_counter() - start) * 1000 / args.repeat
+        start = time.perf_counter()
+        log.search(args.query, "#chan0")
+        channel_ms = (time.perf_counter() - start) * 1000
+        log.close()
+
+        start = time.perf_counter()
+        matches = scan(root, set(ChatLog.WORD.findall(args.query.lower())))
+        scan_ms = (time.perf_counter() - start) * 1000
+    finally:
+        shutil.rmtree(root)
+
+    print(f"{args.lines} lines, {args.channels} channels, {args.days} days, {size / 1e6:.0f} MB on disk, "
+          f"written in {fill_seconds:.1f} s")
+    print(f"open log:            {open_ms:>9.2f} ms")
+    print(f"first search:        {first_ms:>9.2f} ms  ({len(first)} shown, {matches} match)")
+    print(f"search, warm:        {warm_ms:>9.2f} ms")
+    print(f"search, one channel: {channel_ms:>9.2f} ms")
+    print(f"scan without index:  {scan_ms:>9.2f} ms")
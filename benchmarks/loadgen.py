@@ -0,0 +1,312 @@
+"""Load generator and capacity benchmark for server.py, over loopback only.
+
+Starts the server (or uses one already listening on a loopback address),
+connects simulated clients that NICK/USER, JOIN their channel, send PRIVMSG
+at a fixed overall rate and PART, then prints the results as JSON so runs
+of different server cores can be compared:
+
+    python benchmarks/loadgen.py --mode threaded --clients 2000 --channels 50 --rate 2000
+    python benchmarks/loadgen.py --mode asyncio --distribution zipf --output asyncio.json
+
+Latency is measured from just before a PRIVMSG is written to when each other
+member of the channel reads it. All clients live in this one process, so at
+high loads the generator itself can become the bottleneck; its CPU time is
+reported next to the results to make that visible.
+"""
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.latencies = []
+        self.disconnects = 0
+        self.rss_peak = 0
+
+class LoadClient:
+    """One simulated user. The reader task parses everything the server sends,
+    the scenario coroutines only write."""
+    def __init__(self, index, channel, stats):
+        self.nick = f"load{index}"
+        self.channel = channel
+        self.stats = stats
+        self.registered = asyncio.Event()
+        self.joined = asyncio.Event()
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.quitting = False
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.task = asyncio.create_task(self.read_loop())
+        self.writer.write(f"NICK {self.nick}\r\nUSER {self.nick} 0 * :{self.nick}\r\n".encode())
+        await self.registered.wait()
+
+    async def join(self):
+        self.writer.write(f"JOIN {self.channel}\r\n".encode())
+        await self.joined.wait()
+
+    async def chat(self, interval, until, filler):
+        # Fixed schedule with a random phase, so clients don't send in lockstep
+        next_send = time.perf_counter() + random.random() * interval
+        while next_send < until:
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+            if self.writer.is_closing():
+                return
+            self.writer.write(f"PRIVMSG {self.channel} :{time.perf_counter_ns()} {filler}\r\n".encode())
+            self.stats.sent += 1
+            next_send += interval
+
+    async def leave(self):
+        self.quitting = True
+        if self.writer.is_closing():
+            return
+        self.writer.write(f"PART {self.channel}\r\nQUIT :done\r\n".encode())
+        try:
+            await asyncio.wait_for(self.task, timeout=5.0)
+        except asyncio.TimeoutError:
+            self.task.cancel()
+        self.writer.close()
+
+    async def read_loop(self):
+        own = f":{self.nick} ".encode()
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                if b" PRIVMSG " in line:
+                    if line.startswith(own):
+                        continue
+                    stamp = line.split(b" :", 1)[1].split(b" ", 1)[0]
+                    self.stats.delivered += 1
+                    self.stats.latencies.append((time.perf_counter_ns() - int(stamp)) / 1e6)
+                elif line.startswith(b"PING"):
+                    self.writer.write(b"PONG" + line[4:])
+                elif b" 001 " in line:
+                    self.registered.set()
+                elif b" 366 " in line:
+                    self.joined.set()
+        except (OSError, ValueError, IndexError):
+            pass
+        if not self.quitting:
+            self.stats.disconnects += 1
+        # Unblock whoever is waiting on this client
+        self.registered.set()
+        self.joined.set()
+
+def assign_channels(clients, channels, distribution, skew):
+    """Returns the channel name for each client."""
+    if distribution == "single":
+        picks = [0] * clients
+    elif distribution == "uniform":
+        picks = [i % channels for i in range(clients)]
+    else:
+        # Zipf-like: channel k gets a share proportional to 1/k^skew
+        weights = [1 / (rank + 1) ** skew for rank in range(channels)]
+        picks = random.Random(1).choices(range(channels), weights=weights, k=clients)
+    return [f"#load{pick}" for pick in picks]
+
+def process_rss(pid):
+    """Resident memory of pid and its children (worker processes), in bytes."""
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, ValueError, IndexError):
+                pass
+    total = 0
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+async def sample_rss(pid, stats, interval=0.5):
+    while True:
+        stats.rss_peak = max(stats.rss_peak, process_rss(pid))
+        await asyncio.sleep(interval)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 3)
+
+async def run_load(args, server_pid):
+    stats = Stats()
+    sampler = asyncio.create_task(sample_rss(server_pid, stats)) if server_pid else None
+    channels = assign_channels(args.clients, args.channels, args.distribution, args.zipf_skew)
+    clients = [LoadClient(i, channel, stats) for i, channel in enumerate(channels)]
+
+    limit = asyncio.Semaphore(args.connect_concurrency)
+    async def connect(client):
+        async with limit:
+            await client.connect(args.host, args.port)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(connect(client) for client in clients), return_exceptions=True)
+    connect_seconds = time.perf_counter() - start
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    clients = [client for client, result in zip(clients, results) if not isinstance(result, Exception)]
+
+    await asyncio.gather(*(client.join() for client in clients))
+
+    filler = "x" * max(0, args.message_size - 20)
+    interval = len(clients) / args.rate if args.rate > 0 else float("inf")
+    cpu_start = time.process_time()
+    chat_start = time.perf_counter()
+    await asyncio.gather(*(client.chat(interval, chat_start + args.duration, filler) for client in clients))
+    sent = stats.sent
+    # Sends are scheduled over the duration, only a generator falling behind takes longer
+    chat_seconds = max(args.duration, time.perf_counter() - chat_start)
+    # Let in-flight deliveries arrive before counting them
+    await asyncio.sleep(args.drain)
+    delivered = stats.delivered
+    loadgen_cpu = time.process_time() - cpu_start
+    rss_end = process_rss(server_pid) if server_pid else None
+
+    await asyncio.gather(*(client.leave() for client in clients))
+    if sampler:
+        sampler.cancel()
+
+    latencies = sorted(stats.latencies)
+    return {
+        "clients_connected": len(clients),
+        "connect_failures": failed,
+        "connect_seconds": round(connect_seconds, 3),
+        "connects_per_sec": round(len(clients) / connect_seconds, 1) if connect_seconds else None,
+        "messages_sent": sent,
+        "messages_per_sec": round(sent / chat_seconds, 1),
+        "deliveries": delivered,
+        "deliveries_per_sec": round(delivered / chat_seconds, 1),
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "max": round(latencies[-1], 3) if latencies else None,
+        },
+        "disconnects": stats.disconnects,
+        "server_rss_bytes": {"peak": stats.rss_peak or None, "end": rss_end},
+        "loadgen_cpu_seconds": round(loadgen_cpu, 3),
+    }
+
+def free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def start_server(args):
+    log_file = os.path.join(tempfile.mkdtemp(), "loadgen-server.log")
+    command = [sys.executable, SERVER, "--host", args.host, "--port", str(args.port), "--mode", args.mode,
+               "--workers", str(args.workers), "--max-sendq", str(args.max_sendq),
+               "--log-file", log_file, "--log-level", args.log_level, "--flood-rate", str(args.flood_rate)]
+    server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, cwd=os.path.dirname(log_file))
+    server.stdin.write(b"bench\n")
+    server.stdin.flush()
+    if not wait_for_port(args.host, args.port):
+        server.kill()
+        sys.exit("Server did not start listening")
+    return server
+
+def stop_server(server):
+    try:
+        server.stdin.write(b"/shutdown\n")
+        server.stdin.flush()
+        server.wait(timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        server.kill()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1", help="Loopback address to run on")
+    parser.add_argument("--port", type=int, help="Use a server already listening here instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="PID of that server, for RSS")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-sendq", type=int, default=512 * 1024)
+    parser.add_argument("--log-level", default="warning", help="Server log level, info logs every message")
+    parser.add_argument("--flood-rate", type=float, default=0,
+                        help="Server flood control rate, off by default so it doesn't cap the measured load")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--distribution", choices=["uniform", "zipf", "single"], default="uniform",
+                        help="How clients are spread over channels")
+    parser.add_argument("--zipf-skew", type=float, default=1.0)
+    parser.add_argument("--rate", type=float, default=1000, help="PRIVMSGs per second, all clients together")
+    parser.add_argument("--message-size", type=int, default=100, help="Approximate PRIVMSG text length")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of chatting")
+    parser.add_argument("--drain", type=float, default=1.0, help="Seconds to wait for deliveries after sending stops")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    if not ipaddress.ip_address(args.host).is_loopback:
+        sys.exit("The load generator only runs against loopback addresses")
+
+    # Thousands of clients need thousands of descriptors, here and in the server.
+    # An unlimited hard limit (macOS) can't be the soft one, ask for 65536 instead
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        except (ValueError, OSError) as e:
+            print(f"Could not raise the open file limit from {soft}: {e}")
+
+    server = None
+    server_pid = args.server_pid
+    if args.port is None:
+        args.port = free_port(args.host)
+        server = start_server(args)
+        server_pid = server.pid
+    try:
+        results = asyncio.run(run_load(args, server_pid))
+    finally:
+        if server:
+            stop_server(server)
+
+    report = {
+        "server": {"mode": args.mode if server else None, "workers": args.workers if server else None,
+                   "log_level": args.log_level if server else None, "max_sendq": args.max_sendq if server else None,
+                   "flood_rate": args.flood_rate if server else None},
+        "load": {"clients": args.clients, "channels": args.channels, "distribution": args.distribution,
+                 "zipf_skew": args.zipf_skew, "rate": args.rate, "message_size": args.message_size,
+                 "duration": args.duration},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
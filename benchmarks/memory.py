@@ -0,0 +1,100 @@
+"""Python heap cost of an idle client, by number of connected clients.
+
+Registers idle sessions (nick set, one channel joined) against in-memory
+connections and measures what tracemalloc sees. Sockets, kernel buffers and
+the per-client threads of threaded mode are not included, only the server's
+own bookkeeping: connection object, session, nick/IP index and membership.
+
+    python benchmarks/memory.py --sizes 10000 100000
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import Connection, IRCServer
+
+class IdleConnection(Connection):
+    __slots__ = ()
+
+    def wake(self):
+        pass
+
+    def abort(self):
+        pass
+
+class LegacyConnection:
+    """Connection and per-client state as they were before sessions were slotted:
+    attribute dicts everywhere and a plain dict of uninterned strings."""
+    def __init__(self, max_sendq):
+        self.max_sendq = max_sendq
+        self.pending = []
+        self.queued = 0
+        self.closing = False
+        self.overflowed = False
+        self.lock = threading.Lock()
+
+class LegacyBuffer:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.overflow = False
+        self.max_line = 512
+
+def make_server():
+    log_file = os.path.join(tempfile.mkdtemp(), "bench.log")
+    server = IRCServer(host='127.0.0.1', port=0, admin_password="bench", log_file=log_file)
+    server.log = lambda *args, **kwargs: None
+    server.publish = lambda event: None
+    return server
+
+def measure(build, count):
+    """Returns heap bytes per client and the objects, kept alive until measured."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(count)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / count
+
+def sessions(count):
+    server = make_server()
+    channel, _ = server.registry.get_channel('#general')
+    for i in range(count):
+        client = IdleConnection(512 * 1024)
+        session = server.registry.add_client(client, '.'.join(('127', '0', str(i % 250), '1')))
+        server.registry.set_nick(client, f"user{i}")
+        # What handle_join does, minus announcing the join to every member
+        server.registry.join(client, channel, session.prefix)
+    return server
+
+def legacy_sessions(count):
+    clients = {}
+    nicknames = {}
+    members = set()
+    for i in range(count):
+        client = LegacyConnection(512 * 1024)
+        nick = f"user{i}"
+        clients[client] = {'nick': nick, 'prefix': f":{nick}".encode(), 'ip': '.'.join(('127', '0', str(i % 250), '1')),
+                           'channels': {''.join(('#', 'general'))}, 'buffer': LegacyBuffer()}
+        nicknames[nick] = client
+        members.add(client)
+    return clients, nicknames, members
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+
+    print(f"{'clients':>8} {'bytes/client':>13} {'legacy bytes/client':>20} {'saved':>7}")
+    for size in args.sizes:
+        current = measure(sessions, size)
+        legacy = measure(legacy_sessions, size)
+        print(f"{size:>8} {current:>13.0f} {legacy:>20.0f} {1 - current / legacy:>6.0%}")
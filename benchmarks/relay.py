@@ -0,0 +1,90 @@
+"""CPU cost of relaying one PRIVMSG to a channel, by channel size.
+
+Runs IRCServer.handle_line against in-memory connections, no sockets involved.
+The log level is set so message lines aren't written, and history is off, so
+parsing, line building, queueing and the cost of skipping the log are timed.
+
+    python benchmarks/relay.py --sizes 1 10 100 1000 5000 --messages 2000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import Connection, IRCServer
+
+class MemoryConnection(Connection):
+    """Drains its queue straight away, like a socket that is always writable."""
+    def __init__(self):
+        super().__init__(max_sendq=1 << 30)
+        self.received = 0
+
+    def wake(self):
+        self.received += len(self.take())
+
+    def abort(self):
+        pass
+
+def legacy_privmsg(server):
+    """handle_privmsg as it was before relaying bytes: decode, then format and
+    encode the line again for every member, and format the log line whatever
+    the log level."""
+    def handle_privmsg(client, data, ip):
+        nick = server.registry.clients[client].nick or ip
+        target, _, message = data.decode('utf-8').partition(' :')
+        channels = server.registry.channels
+        if target in channels and client in channels[target].members:
+            for member in channels[target].members:
+                member.send(f":{nick} PRIVMSG {target} :{message}\r\n".encode())
+            server.log(f"{nick} => {target}: {message}")
+    return handle_privmsg
+
+def make_server(size):
+    log_file = os.path.join(tempfile.mkdtemp(), "bench.log")
+    server = IRCServer(host='127.0.0.1', port=0, admin_password="bench", log_file=log_file, log_level='warning',
+                       history_lines=0)
+    members = []
+    for i in range(size):
+        client = MemoryConnection()
+        server.registry.add_client(client, '127.0.0.1')
+        server.handle_nick(client, f"user{i}", '127.0.0.1')
+        server.handle_join(client, '#bench', '127.0.0.1')
+        members.append(client)
+    return server, members
+
+def time_relay(server, sender, line, messages):
+    start = time.process_time()
+    for _ in range(messages):
+        server.handle_line(sender, line, '127.0.0.1')
+    return (time.process_time() - start) / messages
+
+def run(size, messages, rounds):
+    """Best of rounds for each path, taking turns so both see the same noise."""
+    server, members = make_server(size)
+    sender = members[0]
+    line = ("PRIVMSG #bench :" + "héllo wörld " * 8).encode()
+    legacy_handler = legacy_privmsg(server)
+
+    relay = legacy = float('inf')
+    for _ in range(rounds):
+        relay = min(relay, time_relay(server, sender, line, messages))
+        server.handle_privmsg = legacy_handler
+        legacy = min(legacy, time_relay(server, sender, line, messages))
+        del server.handle_privmsg
+    return relay, legacy
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 5000])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'members':>8} {'us/msg':>10} {'ns/recipient':>13} {'legacy us/msg':>14} {'speedup':>8}")
+    for size in args.sizes:
+        messages = max(10, args.messages * 10 // max(size, 10))
+        relay, legacy = run(size, messages, args.rounds)
+        print(f"{size:>8} {relay * 1e6:>10.1f} {relay * 1e9 / size:>13.0f} {legacy * 1e6:>14.1f} {legacy / relay:>7.2f}x")
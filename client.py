@@ -6,6 +6,17 @@ import readline
 import select
 import ssl  # SSL ADDITION
 import argparse
+import codecs
+import collections
+import random
+import asyncio
+import resource
+import os
+import re
+import struct
+import mmap
+import array
+import urllib.parse
 
 # ANSI color codes
 class Colors:
@@ -21,22 +32,701 @@ class Colors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-class IRCClient:
-    def __init__(self):
+class Message:
+    """One server line split into IRCv3 tags, prefix, command and params in a
+    single pass. The trailing parameter (after ' :') is the last param."""
+    __slots__ = ('raw', 'tags', 'prefix', 'command', 'params')
+
+    TAG_ESCAPES = {':': ';', 's': ' ', 'r': '\r', 'n': '\n', '\\': '\\'}
+
+    def __init__(self, raw, tags, prefix, command, params):
+        self.raw = raw
+        self.tags = tags
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+
+    @classmethod
+    def parse(cls, raw):
+        rest = raw
+        tags = prefix = None
+        if raw[:1] == '@':
+            tag_text, _, rest = raw[1:].partition(' ')
+            tags = {}
+            for item in tag_text.split(';'):
+                key, _, value = item.partition('=')
+                tags[key] = cls.unescape(value) if '\\' in value else value
+        if rest[:1] == ':':
+            prefix, _, rest = rest[1:].partition(' ')
+        head, colon, trailing = rest.partition(' :')
+        params = head.split()
+        if not params:
+            return cls(raw, tags, prefix, '', params)
+        command = params[0].upper()
+        del params[0]
+        if colon:
+            params.append(trailing)
+        return cls(raw, tags, prefix, command, params)
+
+    @classmethod
+    def unescape(cls, value):
+        out = []
+        chars = iter(value)
+        for char in chars:
+            if char == '\\':
+                escaped = next(chars, '')
+                out.append(cls.TAG_ESCAPES.get(escaped, escaped))
+            else:
+                out.append(char)
+        return ''.join(out)
+
+    @property
+    def nick(self):
+        """Sender nick from a nick!user@host prefix."""
+        return self.prefix.split('!', 1)[0] if self.prefix else ''
+
+    def param(self, index, default=''):
+        return self.params[index] if len(self.params) > index else default
+
+def make_ssl_context(verify=False, cafile=None):
+    context = ssl.create_default_context()
+    if not verify:  # Skip verification for self-signed certs
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif cafile:  # Use custom CA cert
+        context.load_verify_locations(cafile=cafile)
+    return context
+
+class Backoff:
+    """Reconnect delays: exponential backoff with full jitter. Attempt n waits
+    a random time between 0 and min(cap, base * 2**n), so clients that were
+    dropped together, by a server restart say, don't all come back at once."""
+    __slots__ = ('base', 'cap', 'attempt')
+
+    def __init__(self, base=1.0, cap=60.0):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** min(self.attempt, 32)))
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+class TokenBucket:
+    """Paces what we send the way the server's flood control counts it: up
+    to burst tokens, refilled at rate per second, each line costs its
+    weight. A rate of 0 turns pacing off."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def reserve(self, weight):
+        """Takes weight tokens and returns 0, or takes nothing and returns the
+        seconds until there will be enough."""
+        if not self.rate or not weight:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= weight:
+            self.tokens -= weight
+            return 0
+        return (weight - self.tokens) / self.rate
+
+class ClientProtocol:
+    """What every connection does whatever its I/O: framing and decoding
+    server lines, answering PING, noticing ERROR and being kicked, tracking
+    nick and channels so a new connection can restore them, and building
+    commands. Subclasses provide send_command."""
+    __slots__ = ('nick', 'wanted_nick', 'regain', 'channels', 'encoding', 'fallback_encoding',
+                 'closing', 'quitting', 'welcomed', 'bucket')
+
+    # Big enough that a NAMES or LIST burst arrives in a few reads
+    RECV_SIZE = 65536
+    MAX_LINE = 512
+    # Room for the ":nick!user@host " a server puts in front when relaying
+    PREFIX_ROOM = 64
+    # Smallest room left for text, the longest UTF-8 character
+    MIN_PIECE = 4
+    # What server.py's flood control charges per command, unknown ones cost 1
+    SEND_WEIGHTS = {'PRIVMSG': 1.0, 'JOIN': 2.0, 'NICK': 3.0, 'PART': 1.0, 'NAMES': 2.0,
+                    'CHATHISTORY': 3.0, 'LIST': 5.0, 'USER': 1.0, 'PING': 0.0, 'PONG': 0.0, 'QUIT': 0.0}
+    # Under the server's default 5 per second with a burst of 20
+    SEND_RATE = 4.0
+    SEND_BURST = 16.0
+
+    def __init__(self, nick, encoding='utf-8', fallback_encoding='latin-1',
+                 send_rate=SEND_RATE, send_burst=SEND_BURST):
+        self.nick = nick
+        # The nick asked for, nick is what the server gave us
+        self.wanted_nick = nick
+        self.regain = False
+        self.channels = set()
+        # Look the codecs up now so a typo fails before connecting
+        self.encoding = codecs.lookup(encoding).name
+        self.fallback_encoding = codecs.lookup(fallback_encoding).name
+        # Set once the server sent ERROR or kicked us, don't reconnect then
+        self.closing = False
+        # Set once we sent QUIT
+        self.quitting = False
+        self.welcomed = False
+        self.bucket = TokenBucket(send_rate, send_burst)
+
+    def send_command(self, command):
+        raise NotImplementedError
+
+    def weight(self, command):
+        return self.SEND_WEIGHTS.get(command.partition(' ')[0].upper(), 1.0)
+
+    def split_text(self, head, text):
+        """Cuts text into pieces that each fit after head in one protocol
+        line, with room for the prefix the server relays it with. Cuts go at
+        a space where there is one late enough, and never inside a UTF-8
+        character. Raises ValueError when head and nick leave no room for
+        text."""
+        budget = (self.MAX_LINE - 2 - len(head.encode(self.encoding, 'replace'))
+                  - len(self.nick.encode(self.encoding, 'replace')) - self.PREFIX_ROOM)
+        if budget < self.MIN_PIECE:
+            raise ValueError(f"{head.split(' ')[1]!r} is too long to send messages to")
+        data = text.encode(self.encoding, 'replace')
+        if len(data) <= budget:
+            return [text]
+        pieces = []
+        while len(data) > budget:
+            cut = data.rfind(b' ', budget // 2, budget + 1)
+            if cut > 0:
+                rest = data[cut + 1:]
+            else:
+                cut = budget
+                if self.encoding == 'utf-8':
+                    # Back up to the first byte of the character, a budget of
+                    # MIN_PIECE always keeps at least one character
+                    while cut > 1 and data[cut] & 0xC0 == 0x80:
+                        cut -= 1
+                rest = data[cut:]
+            pieces.append(data[:cut].decode(self.encoding, 'replace'))
+            data = rest
+        if data:
+            pieces.append(data.decode(self.encoding, 'replace'))
+        return pieces
+
+    def start_session(self):
+        """Resets per-connection state and registers, on every new connection."""
+        self.closing = False
+        self.welcomed = False
+        self.nick = self.wanted_nick
+        self.register()
+
+    def on_registered(self, message):
+        """Called on the first 001 of each connection."""
+
+    def decode(self, raw):
+        """Decodes one line, falling back to fallback_encoding for lines that
+        aren't valid in the main encoding (latin-1 decodes any bytes)."""
+        try:
+            return raw.decode(self.encoding)
+        except UnicodeDecodeError:
+            return raw.decode(self.fallback_encoding, 'replace')
+
+    def split_lines(self, buffer):
+        """Removes the complete lines from the front of buffer and returns
+        them decoded. A partial line stays in buffer for the next read, so a
+        character split across reads is only decoded once it is whole."""
+        end = buffer.rfind(b'\n')
+        if end < 0:
+            return []
+        try:
+            # One decode for everything complete, the common case
+            lines = buffer[:end].decode(self.encoding).split('\n')
+        except UnicodeDecodeError:
+            lines = [self.decode(line) for line in buffer[:end].split(b'\n')]
+        del buffer[:end + 1]
+        # Lines end in \r\n, tolerate a bare \n
+        return [line[:-1] if line[-1:] == '\r' else line for line in lines]
+
+    def handle_protocol(self, message):
+        handler = self.HANDLERS.get(message.command)
+        if handler:
+            handler(self, message)
+
+    # Protocol handlers, keyed by command in HANDLERS
+
+    def on_ping(self, message):
+        self.send_command(f"PONG :{message.param(0)}" if message.params else "PONG")
+        # A ghost of ours may have held the nick, it has likely timed out by now
+        if self.regain:
+            self.send_command(f"NICK {self.wanted_nick}")
+
+    def on_error(self, message):
+        self.closing = True
+
+    def on_kick(self, message):
+        # Channel kicks carry the channel first, the server's own kick only the nick
+        if message.param(0).startswith('#'):
+            if message.param(1) == self.nick:
+                self.channels.discard(message.param(0))
+                self.closing = True
+        elif message.param(0) == self.nick:
+            self.closing = True
+
+    def on_welcome(self, message):
+        # 001 carries the nick the server gave us, also after a NICK change
+        self.nick = message.param(0, self.nick)
+        if self.nick == self.wanted_nick:
+            self.regain = False
+        if not self.welcomed:
+            self.welcomed = True
+            # Back into every channel we were in before the connection dropped
+            for channel in sorted(self.channels):
+                self.send_command(f"JOIN {channel}")
+            self.on_registered(message)
+
+    def on_nick_in_use(self, message):
+        if not self.welcomed:
+            # Register under another nick and take ours back later
+            self.nick = message.param(1, self.nick) + '_'
+            self.regain = True
+            self.send_command(f"NICK {self.nick}")
+
+    def on_nick(self, message):
+        if message.nick == self.nick:
+            self.nick = message.param(0)
+
+    def on_join(self, message):
+        if message.nick == self.nick:
+            self.channels.add(message.param(0))
+
+    def on_part(self, message):
+        if message.nick == self.nick:
+            self.channels.discard(message.param(0))
+
+    HANDLERS = {
+        'PING': on_ping,
+        'ERROR': on_error,
+        'KICK': on_kick,
+        '001': on_welcome,
+        '433': on_nick_in_use,
+        'NICK': on_nick,
+        'JOIN': on_join,
+        'PART': on_part,
+    }
+
+    # Commands
+
+    def register(self):
+        self.send_command(f"NICK {self.nick}")
+        self.send_command(f"USER {self.nick} 0 * :{self.nick}")
+
+    def join(self, channel):
+        """Joins channel, adding the # if missing, and returns its name."""
+        if not channel.startswith('#'):
+            channel = '#' + channel
+        self.send_command(f"JOIN {channel}")
+        return channel
+
+    def part(self, channel):
+        self.send_command(f"PART {channel}")
+
+    def privmsg(self, target, text):
+        """Sends text, over several lines if it doesn't fit in one."""
+        head = f"PRIVMSG {target} :"
+        for piece in self.split_text(head, text):
+            self.send_command(head + piece)
+
+    def action(self, target, text):
+        head = f"PRIVMSG {target} :\x01ACTION "
+        for piece in self.split_text(head + '\x01', text):
+            self.send_command(f"{head}{piece}\x01")
+
+    def change_nick(self, nick):
+        self.wanted_nick = nick
+        self.regain = False
+        self.send_command(f"NICK {nick}")
+
+    def mode(self, args):
+        self.send_command(f"MODE {args}")
+
+    def whois(self, nick):
+        self.send_command(f"WHOIS {nick}")
+
+    def list_channels(self, filters=None):
+        self.send_command(f"LIST {filters}" if filters else "LIST")
+
+    def quit(self, reason=None):
+        self.quitting = True
+        self.send_command(f"QUIT :{reason}" if reason else "QUIT")
+
+class SegmentIndex:
+    """The word index of a sealed log segment, searched in place through
+    mmap. The file is a header, a table of fixed-size entries sorted by
+    term, the term bytes, then the postings: line offsets into the segment,
+    as uint32. A lookup is a binary search over the table."""
+    __slots__ = ('file', 'map', 'count', 'terms_at', 'postings_at')
+
+    HEADER = struct.Struct('<4sII')
+    # term start, term length, first posting, posting count
+    ENTRY = struct.Struct('<IIII')
+    MAGIC = b'PIX1'
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+        magic, self.count, terms_length = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a log index")
+        self.terms_at = self.HEADER.size + self.count * self.ENTRY.size
+        self.postings_at = self.terms_at + terms_length
+
+    @classmethod
+    def write(cls, path, postings):
+        """Writes postings, a dict of term to ascending line offsets."""
+        entries = []
+        terms = bytearray()
+        offsets = array.array('I')
+        # UTF-8 byte order is code point order, the order lookup compares in
+        for term in sorted(postings):
+            raw = term.encode('utf-8')
+            entries.append(cls.ENTRY.pack(len(terms), len(raw), len(offsets), len(postings[term])))
+            terms += raw
+            offsets.extend(postings[term])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(entries), len(terms)))
+            f.write(b''.join(entries))
+            f.write(terms)
+            f.write(offsets.tobytes())
+        os.replace(tmp_path, path)
+
+    def lookup(self, term):
+        """Line offsets of the lines containing term, ascending."""
+        key = term.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start, length, first, count = self.ENTRY.unpack_from(self.map, self.HEADER.size + middle * self.ENTRY.size)
+            found = self.map[self.terms_at + start:self.terms_at + start + length]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                offsets = array.array('I')
+                offsets.frombytes(self.map[self.postings_at + first * 4:self.postings_at + (first + count) * 4])
+                return offsets
+        return ()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class ChannelLog:
+    __slots__ = ('path', 'segment', 'size')
+
+    def __init__(self, path, segment, size):
+        self.path = path
+        # Number of the segment being appended to, the ones below are sealed
+        self.segment = segment
+        self.size = size
+
+class ChatLog:
+    """Per-channel message logs with a word index, under root/<channel>/.
+
+    Messages go to numbered segment files, one "stamp<TAB>nick<TAB>text"
+    line each. A segment is sealed at SEGMENT_BYTES and its index written
+    next to it as a SegmentIndex. The active segment has no index, a search
+    scans it, which for one SEGMENT_BYTES file costs less than building one.
+    Startup reads nothing.
+
+    append() only queues. A writer thread writes what was queued every
+    FLUSH_INTERVAL seconds, one write per channel. At most OPEN_INDEXES
+    sealed indexes stay mapped, the least recently searched are closed."""
+    SEGMENT_BYTES = 1 << 20
+    FLUSH_INTERVAL = 1.0
+    OPEN_INDEXES = 32
+    WORD = re.compile(r'\w+')
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        # Held while files or indexes change or are read
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.running = True
+        self.channels = {}
+        # Index path to SegmentIndex, least recently used first
+        self.sealed = collections.OrderedDict()
+        self.thread = threading.Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, channel, nick, text):
+        with self.pending_lock:
+            self.pending.append((channel.lower(), time.time(), nick, text))
+        self.ready.set()
+
+    def write_loop(self):
+        while self.running:
+            self.ready.wait()
+            if self.running:
+                time.sleep(self.FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"{Colors.RED}[ERROR] Writing chat log: {e}{Colors.RESET}")
+
+    def flush(self):
+        # search() flushes from the input thread too. The batch is taken
+        # under the file lock so two flushes can't write theirs out of order.
+        with self.lock:
+            with self.pending_lock:
+                batch, self.pending = self.pending, []
+                self.ready.clear()
+            if not batch:
+                return
+            by_channel = collections.defaultdict(list)
+            for channel, stamp, nick, text in batch:
+                by_channel[channel].append((stamp, nick, text))
+            for name, entries in by_channel.items():
+                log = self.channel(name, create=True)
+                lines = []
+                offset = log.size
+                for stamp, nick, text in entries:
+                    line = f"{int(stamp)}\t{nick}\t{text.replace(chr(9), ' ')}\n".encode('utf-8', 'replace')
+                    lines.append(line)
+                    offset += len(line)
+                with open(self.segment_path(log, log.segment), 'ab') as f:
+                    f.write(b''.join(lines))
+                log.size = offset
+                if log.size >= self.SEGMENT_BYTES:
+                    self.seal(log)
+
+    def close(self):
+        self.running = False
+        self.ready.set()
+        self.thread.join(timeout=self.FLUSH_INTERVAL + 1.0)
+        self.flush()
+        with self.lock:
+            for index in self.sealed.values():
+                index.close()
+            self.sealed.clear()
+
+    def channel(self, name, create=False):
+        """The ChannelLog for name, found on disk the first time. None if the
+        channel has no log and create is false."""
+        log = self.channels.get(name)
+        if log is not None:
+            return log
+        path = os.path.join(self.root, urllib.parse.quote(name, safe=''))
+        if not os.path.isdir(path):
+            if not create:
+                return None
+            os.makedirs(path)
+        numbers = [int(entry[:-4]) for entry in os.listdir(path) if entry.endswith('.log') and entry[:-4].isdigit()]
+        segment = max(numbers, default=1)
+        log = ChannelLog(path, segment, 0)
+        if os.path.exists(self.index_path(log, segment)):
+            log.segment += 1
+        try:
+            log.size = os.path.getsize(self.segment_path(log, log.segment))
+        except OSError:
+            pass
+        self.channels[name] = log
+        return log
+
+    def segment_path(self, log, segment):
+        return os.path.join(log.path, f"{segment:06d}.log")
+
+    def index_path(self, log, segment):
+        return os.path.join(log.path, f"{segment:06d}.idx")
+
+    def add_terms(self, index, nick, text, offset):
+        for term in set(self.WORD.findall(text.lower())) | {nick.lower()}:
+            postings = index.get(term)
+            if postings is None:
+                index[term] = [offset]
+            else:
+                postings.append(offset)
+
+    def read_index(self, log, segment):
+        """Builds the word index of a segment from its file."""
+        index = {}
+        offset = 0
+        try:
+            with open(self.segment_path(log, segment), 'rb') as f:
+                for line in f:
+                    _, nick, text = self.parse_line(line)
+                    self.add_terms(index, nick, text, offset)
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+        return index
+
+    def seal(self, log):
+        SegmentIndex.write(self.index_path(log, log.segment), self.read_index(log, log.segment))
+        log.segment += 1
+        log.size = 0
+
+    @staticmethod
+    def parse_line(line):
+        stamp, nick, text = line.decode('utf-8', 'replace').rstrip('\n').split('\t', 2)
+        return int(stamp), nick, text
+
+    def search(self, query, channel=None, limit=20):
+        """Messages containing every word of query, newest first, as
+        (stamp, channel, nick, text). Searches one channel or all of them."""
+        terms = set(self.WORD.findall(query.lower()))
+        if not terms:
+            return []
+        # What is still queued counts too
+        self.flush()
+        with self.lock:
+            if channel:
+                names = [channel.lower()]
+            else:
+                names = [urllib.parse.unquote(entry) for entry in os.listdir(self.root)]
+            results = []
+            for name in names:
+                log = self.channel(name)
+                if log is not None:
+                    results.extend(self.search_channel(log, name, terms, limit))
+        # Segment and offset order what was logged within the same second
+        results.sort(reverse=True)
+        return [result[:1] + result[3:] for result in results[:limit]]
+
+    def search_channel(self, log, name, terms, limit):
+        results = self.scan_segment(log, name, terms, limit)
+        for segment in range(log.segment - 1, 0, -1):
+            if len(results) >= limit:
+                break
+            index = self.segment_index(log, segment)
+            if index is None:
+                continue
+            postings = [index.lookup(term) for term in terms]
+            # Intersect starting from the rarest term
+            postings.sort(key=len)
+            offsets = set(postings[0])
+            for other in postings[1:]:
+                if not offsets:
+                    break
+                offsets.intersection_update(other)
+            if offsets:
+                with open(self.segment_path(log, segment), 'rb') as f:
+                    for offset in sorted(offsets, reverse=True)[:limit - len(results)]:
+                        f.seek(offset)
+                        stamp, nick, text = self.parse_line(f.readline())
+                        results.append((stamp, segment, offset, name, nick, text))
+        return results
+
+    def scan_segment(self, log, name, terms, limit):
+        """The newest lines of the active segment holding every term, found
+        by reading it: a line must contain the longest term as a substring
+        before its words are looked at."""
+        try:
+            with open(self.segment_path(log, log.segment), 'rb') as f:
+                data = f.read().decode('utf-8', 'replace')
+        except FileNotFoundError:
+            return []
+        # lower() never adds or drops a newline, so the lines pair up
+        lines = data.split('\n')
+        lowered = data.lower().split('\n')
+        probe = max(terms, key=len)
+        results = []
+        for number in range(len(lines) - 1, -1, -1):
+            if probe not in lowered[number]:
+                continue
+            fields = lowered[number].split('\t', 2)
+            if len(fields) == 3 and terms <= set(self.WORD.findall(fields[2])) | {fields[1]}:
+                stamp, nick, text = lines[number].split('\t', 2)
+                # Line numbers order the results like offsets would
+                results.append((int(stamp), log.segment, number, name, nick, text))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def segment_index(self, log, segment):
+        """The mapped index of a sealed segment. Called with the lock held."""
+        path = self.index_path(log, segment)
+        index = self.sealed.get(path)
+        if index is not None:
+            self.sealed.move_to_end(path)
+            return index
+        try:
+            index = self.sealed[path] = SegmentIndex(path)
+        except (OSError, ValueError):
+            return None
+        if len(self.sealed) > self.OPEN_INDEXES:
+            self.sealed.popitem(last=False)[1].close()
+        return index
+
+class IRCClient(ClientProtocol):
+    # Seconds between screen redraws, lines arriving in between share one
+    FRAME_INTERVAL = 0.05
+    CONNECT_TIMEOUT = 10.0
+
+    def __init__(self, encoding='utf-8', fallback_encoding='latin-1', frame_interval=FRAME_INTERVAL,
+                 reconnect=True, backoff=None, send_rate=ClientProtocol.SEND_RATE,
+                 send_burst=ClientProtocol.SEND_BURST, log_dir=None):
+        super().__init__(f"guest{int(time.time() % 1000)}", encoding, fallback_encoding, send_rate, send_burst)
         self.sock = None
-        self.nick = f"guest{int(time.time() % 1000)}"
+        self.host = None
+        self.port = None
+        self.ssl_context = None
+        self.tls_session = None
+        self.connected = False
+        # Encoded lines and their weights, for write_loop
+        self.outbox = collections.deque()
+        self.send_ready = threading.Condition()
+        self.writer_thread = None
+        self.reconnect = reconnect
+        self.backoff = backoff or Backoff()
+        self.chat_log = ChatLog(log_dir) if log_dir else None
         self.active_channel = None
         self.running = False
         self.input_prompt = "> "
+        self.frame_interval = frame_interval
+        self.pending = []
+        self.render_lock = threading.Lock()
+        self.render_ready = threading.Event()
+        self.render_thread = None
+        self.last_frame = 0.0
+        self.stamp_second = None
+        self.stamp_text = ''
+        self.formatters = {
+            'PING': self.format_ping,
+            'ERROR': self.format_error,
+            'KICK': self.format_kick,
+            'NOTICE': self.format_notice,
+            'PRIVMSG': self.format_privmsg,
+            'JOIN': self.format_join,
+            'PART': self.format_part,
+            'QUIT': self.format_quit,
+            'NICK': self.format_nick,
+        }
         self.commands = {
             'join': "Join a channel: /join #channel",
             'nick': "Change nickname: /nick newname",
             'msg': "Send message: /msg target message",
-            'mode': "Set channel mode: /mode #channel [+/-mode] [args]",
+            'mode': "Show or set channel modes: /mode #channel [+/-nps]",
             'whois': "Get user info: /whois nickname",
             'me': "Send action: /me action",
-            'list': "List channels: /list",
+            'list': "List channels: /list [>users,<users,*mask*,!*mask*]",
             'part': "Leave channel: /part [#channel]",
+            'search': "Search logged messages: /search words [#channel]",
             'quit': "Disconnect: /quit",
             'help': "Show this help: /help"
         }
@@ -59,204 +749,288 @@ class IRCClient:
         print("="*50)
 
     def parse_message(self, raw):
+        """Parses one server line, runs its protocol handler, and returns the
+        text to show for it or None."""
         if not raw:
             return None
-        
-        if raw.startswith('PING'):
-            self.send_command(f"PONG {raw[5:]}")
+        message = Message.parse(raw)
+        self.handle_protocol(message)
+        if self.chat_log and message.command == 'PRIVMSG':
+            self.log_message(message)
+        formatter = self.formatters.get(message.command)
+        if formatter is None:
+            formatter = self.format_numeric if message.command.isdigit() else self.format_other
+        return formatter(message, self.timestamp())
+
+    def log_message(self, message):
+        target, text = message.param(0), message.param(-1)
+        # Private messages are logged under the other side's nick, the server
+        # echoes ours back with us as the sender and them as the target
+        if target.startswith('#') or (message.nick or '').lower() == self.nick.lower():
+            channel = target
+        else:
+            channel = message.nick
+        if text.startswith('\x01ACTION') and text.endswith('\x01'):
+            text = f"* {text[8:-1]}"
+        self.chat_log.append(channel, message.nick, text)
+
+    def show_search(self, query, channel=None):
+        start = time.perf_counter()
+        results = self.chat_log.search(query, channel)
+        elapsed = (time.perf_counter() - start) * 1000
+        for stamp, name, nick, text in reversed(results):
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(stamp))
+            print(f"{Colors.GRAY}[{when}]{Colors.RESET} {Colors.BLUE}{name}{Colors.RESET} {Colors.YELLOW}<{nick}>{Colors.RESET} {text}")
+        print(f"{Colors.GREEN}{len(results)} matches for '{query}' ({elapsed:.1f} ms){Colors.RESET}")
+
+    def timestamp(self):
+        """The colored [HH:MM:SS] prefix, formatted once per second."""
+        now = int(time.time())
+        if now != self.stamp_second:
+            self.stamp_text = f"{Colors.GRAY}[{time.strftime('%H:%M:%S', time.localtime(now))}]{Colors.RESET}"
+            self.stamp_second = now
+        return self.stamp_text
+
+    def format_ping(self, message, timestamp):
+        return None
+
+    def format_error(self, message, timestamp):
+        return f"{timestamp} {Colors.RED}*** ERROR: {message.param(-1).strip()}{Colors.RESET}"
+
+    def format_kick(self, message, timestamp):
+        reason = message.param(-1) if len(message.params) > 1 else "No reason given"
+        if not message.param(0).startswith('#'):
+            return f"{timestamp} {Colors.RED}*** You have been kicked: {reason}{Colors.RESET}"
+        channel, nick = message.param(0), message.param(1)
+        if nick == self.nick:
+            return f"{timestamp} {Colors.RED}*** You have been kicked from {channel}: {reason}{Colors.RESET}"
+        return f"{timestamp} {Colors.RED}<--{Colors.RESET} {Colors.YELLOW}{nick}{Colors.RESET} was kicked from {Colors.BLUE}{channel}{Colors.RESET} by {message.nick}: {reason}"
+
+    def format_numeric(self, message, timestamp):
+        code = message.command
+        text = message.param(-1)
+        if code in ('001', '002', '003', '004', '005'):
+            return f"{timestamp} {Colors.GREEN}●{Colors.RESET} {text}"
+        elif code in ('372', '375', '376'):
+            return f"{timestamp} {Colors.BLUE}●{Colors.RESET} {text}"
+        elif code == '353':
+            return f"{timestamp} {Colors.CYAN}Users in {message.param(2)}:{Colors.RESET} {text}"
+        elif code == '322':
+            return f"{timestamp} {Colors.BLUE}{message.param(1)}{Colors.RESET} {Colors.GREEN}{message.param(2)} users{Colors.RESET} {text}"
+        elif code == '324':
+            return f"{timestamp} {Colors.BLUE}{message.param(1)}{Colors.RESET} modes {message.param(2)}"
+        elif code == '311':
+            return f"{timestamp} {Colors.YELLOW}{message.param(1)}{Colors.RESET} is {message.param(2)}@{message.param(3)}"
+        elif code == '319':
+            return f"{timestamp} {Colors.YELLOW}{message.param(1)}{Colors.RESET} is on {Colors.BLUE}{text}{Colors.RESET}"
+        elif code == '317':
+            return f"{timestamp} {Colors.YELLOW}{message.param(1)}{Colors.RESET} has been idle {message.param(2)}s"
+        elif code in ('366', '321', '312', '329'):
             return None
-        
-        timestamp = f"{Colors.GRAY}[{time.strftime('%H:%M:%S')}]{Colors.RESET}"
-        
-        if raw.startswith('ERROR'):
-            try:
-                reason = raw.split(':', 1)[1].strip()
-                return f"{timestamp} {Colors.RED}*** ERROR: {reason}{Colors.RESET}"
-            except:
-                return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
-        
-        if 'KICK' in raw:
-            try:
-                parts = raw.split()
-                nick = parts[3]
-                channel = parts[2]
-                reason = raw.split(':', 1)[1] if ':' in raw else "No reason given"
-                return f"{timestamp} {Colors.RED}*** You have been kicked from {channel}: {reason}{Colors.RESET}"
-            except:
-                return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
-        
-        if raw.split()[0].isdigit():
-            parts = raw.split()
-            code = parts[0]
-            message = raw[raw.find(':', 1)+1:] if ':' in raw else ' '.join(parts[3:])
-            if code in ('001', '002', '003', '004', '005'):
-                return f"{timestamp} {Colors.GREEN}●{Colors.RESET} {message}"
-            elif code in ('372', '375', '376'):
-                return f"{timestamp} {Colors.BLUE}●{Colors.RESET} {message}"
-            elif code == '353':
-                channel = parts[4]
-                names = message
-                return f"{timestamp} {Colors.CYAN}Users in {channel}:{Colors.RESET} {names}"
-            elif code == '366':
-                return None
-            else:
-                return f"{timestamp} {Colors.YELLOW}●{Colors.RESET} {message}"
-        
-        if 'NOTICE' in raw:
-            try:
-                if ':' in raw:
-                    message = raw.split(':', 1)[1].strip()
-                else:
-                    message = raw
-                return f"{timestamp} {Colors.GRAY}-NOTICE- {message}{Colors.RESET}"
-            except:
-                return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
-        
-        if 'PRIVMSG' in raw:
-            try:
-                sender_start = raw.find(':') + 1
-                prefix_end = raw.find(' ', sender_start)
-                if prefix_end == -1:
-                    prefix_end = len(raw)
-                prefix = raw[sender_start:prefix_end]
-                nick_end = prefix.find('!')
-                if nick_end == -1:
-                    sender = prefix
-                else:
-                    sender = prefix[:nick_end]
-                
-                msg_start = raw.find('PRIVMSG ') + 8
-                target_end = raw.find(' ', msg_start)
-                if target_end == -1:
-                    target_end = raw.find(':', msg_start)
-                target = raw[msg_start:target_end].strip()
-                
-                content_start = raw.find(':', target_end) + 1
-                message = raw[content_start:]
-                
-                if message.startswith('\x01ACTION') and message.endswith('\x01'):
-                    action = message[7:-1]
-                    return f"{timestamp} {Colors.MAGENTA}*{Colors.RESET} {Colors.YELLOW}{sender}{Colors.RESET} {action}"
-                
-                if target.startswith('#'):
-                    return f"{timestamp} {Colors.BLUE}<{target}>{Colors.RESET} {Colors.YELLOW}<{sender}>{Colors.RESET}: {message}"
-                else:
-                    return f"{timestamp} {Colors.MAGENTA}*{sender}*{Colors.RESET} {message}"
-            except Exception:
-                return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
-        
-        elif 'JOIN' in raw:
-            try:
-                sender_start = raw.find(':') + 1
-                sender_end = raw.find('!', sender_start)
-                if sender_end == -1:
-                    sender_end = raw.find(' ', sender_start)
-                sender = raw[sender_start:sender_end]
-                
-                channel_start = raw.find('JOIN') + 5
-                channel = raw[channel_start:].strip()
-                if channel.startswith(':'):
-                    channel = channel[1:]
-                return f"{timestamp} {Colors.GREEN}-->{Colors.RESET} {Colors.YELLOW}{sender}{Colors.RESET} joined {Colors.BLUE}{channel}{Colors.RESET}"
-            except:
-                return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
-        
-        elif 'PART' in raw:
-            try:
-                sender_start = raw.find(':') + 1
-                sender_end = raw.find('!', sender_start)
-                if sender_end == -1:
-                    sender_end = raw.find(' ', sender_start)
-                sender = raw[sender_start:sender_end]
-                
-                channel_start = raw.find('PART') + 5
-                channel = raw[channel_start:].strip()
-                if channel.startswith(':'):
-                    channel = channel[1:]
-                return f"{timestamp} {Colors.RED}<--{Colors.RESET} {Colors.YELLOW}{sender}{Colors.RESET} left {Colors.BLUE}{channel}{Colors.RESET}"
-            except:
-                return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
-        
-        elif 'QUIT' in raw:
-            try:
-                sender_start = raw.find(':') + 1
-                sender_end = raw.find('!', sender_start)
-                if sender_end == -1:
-                    sender_end = raw.find(' ', sender_start)
-                sender = raw[sender_start:sender_end]
-                return f"{timestamp} {Colors.RED}<--{Colors.RESET} {Colors.YELLOW}{sender}{Colors.RESET} disconnected"
-            except:
-                return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
-        
-        elif 'NICK' in raw:
-            try:
-                sender_start = raw.find(':') + 1
-                sender_end = raw.find('!', sender_start)
-                if sender_end == -1:
-                    sender_end = raw.find(' ', sender_start)
-                old_nick = raw[sender_start:sender_end]
-                
-                new_nick = raw.split(':')[-1]
-                return f"{timestamp} {Colors.YELLOW}{old_nick}{Colors.RESET} is now known as {Colors.YELLOW}{new_nick}{Colors.RESET}"
-            except:
-                return f"{timestamp} {Colors.RED}{raw}{Colors.RESET}"
-        
-        if raw.strip().startswith(':') and len(raw.strip().split()) == 1:
+        return f"{timestamp} {Colors.YELLOW}●{Colors.RESET} {text}"
+
+    def format_notice(self, message, timestamp):
+        return f"{timestamp} {Colors.GRAY}-NOTICE- {message.param(-1).strip()}{Colors.RESET}"
+
+    def format_privmsg(self, message, timestamp):
+        sender = message.nick
+        target, text = message.params if len(message.params) == 2 else (message.param(0), message.param(-1))
+        if text.startswith('\x01ACTION') and text.endswith('\x01'):
+            return f"{timestamp} {Colors.MAGENTA}*{Colors.RESET} {Colors.YELLOW}{sender}{Colors.RESET} {text[8:-1]}"
+        if target.startswith('#'):
+            return f"{timestamp} {Colors.BLUE}<{target}>{Colors.RESET} {Colors.YELLOW}<{sender}>{Colors.RESET}: {text}"
+        return f"{timestamp} {Colors.MAGENTA}*{sender}*{Colors.RESET} {text}"
+
+    def format_join(self, message, timestamp):
+        return f"{timestamp} {Colors.GREEN}-->{Colors.RESET} {Colors.YELLOW}{message.nick}{Colors.RESET} joined {Colors.BLUE}{message.param(0)}{Colors.RESET}"
+
+    def format_part(self, message, timestamp):
+        return f"{timestamp} {Colors.RED}<--{Colors.RESET} {Colors.YELLOW}{message.nick}{Colors.RESET} left {Colors.BLUE}{message.param(0)}{Colors.RESET}"
+
+    def format_quit(self, message, timestamp):
+        return f"{timestamp} {Colors.RED}<--{Colors.RESET} {Colors.YELLOW}{message.nick}{Colors.RESET} disconnected"
+
+    def format_nick(self, message, timestamp):
+        return f"{timestamp} {Colors.YELLOW}{message.nick}{Colors.RESET} is now known as {Colors.YELLOW}{message.param(0)}{Colors.RESET}"
+
+    def format_other(self, message, timestamp):
+        # A bare prefix carries nothing to show
+        if not message.command:
             return None
-        return f"{timestamp} {raw}"
+        return f"{timestamp} {message.raw}"
 
     def handle_server_message(self, message):
         formatted = self.parse_message(message)
         if not formatted:
             return
-    
+        self.show(formatted)
+        if self.closing and self.running:
+            self.show(f"{Colors.RED}Disconnecting from server...{Colors.RESET}")
+            self.running = False
+
+    def show(self, text):
+        """Queues a line for the next frame of render_loop."""
+        with self.render_lock:
+            self.pending.append(text)
+        self.render_ready.set()
+
+    def render_loop(self):
+        """Draws queued lines once per frame: the prompt is erased, every line
+        written and the prompt redrawn in a single write and flush. After
+        disconnecting it draws what is left, without the prompt."""
+        while True:
+            self.render_ready.wait()
+            # A line after a quiet spell shows at once, a burst waits for the frame
+            delay = self.last_frame + self.frame_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            running = self.running
+            with self.render_lock:
+                lines, self.pending = self.pending, []
+                self.render_ready.clear()
+            if lines:
+                self.draw(lines, prompt=running)
+            self.last_frame = time.monotonic()
+            if not running:
+                break
+
+    def draw(self, lines, prompt=True):
         try:
             current_buf = readline.get_line_buffer()
         except Exception:
             current_buf = ''
-    
-        sys.stdout.write('\r')
-        sys.stdout.write(' ' * (len(self.input_prompt) + len(current_buf)))
-        sys.stdout.write('\r')
-    
-        print(formatted)
-    
-        if formatted and any(x in formatted for x in [Colors.RED + "*** ERROR", Colors.RED + "*** You have been kicked"]):
-            print(f"{Colors.RED}Disconnecting from server...{Colors.RESET}")
-            self.running = False
-            return
-    
-        sys.stdout.write(self.input_prompt + current_buf)
+
+        frame = ['\r', ' ' * (len(self.input_prompt) + len(current_buf)), '\r', '\n'.join(lines), '\n']
+        if prompt:
+            frame.append(self.input_prompt + current_buf)
+        sys.stdout.write(''.join(frame))
         sys.stdout.flush()
 
     def send_command(self, command):
+        """Queues a line for write_loop. Lines the server's flood control
+        doesn't charge for (PONG, QUIT) go to the front."""
+        if not self.connected:
+            print(f"{Colors.RED}[ERROR] Not connected, not sent: {command.strip()}{Colors.RESET}")
+            return
+        if not command.endswith('\r\n'):
+            command += '\r\n'
+        data = command.encode(self.encoding, 'replace')
+        weight = self.weight(command)
+        with self.send_ready:
+            if weight:
+                self.outbox.append((data, weight))
+            else:
+                self.outbox.appendleft((data, weight))
+            self.send_ready.notify()
+
+    def write_loop(self):
+        """Sends the queued lines: all the bucket can pay for go out in one
+        sendall, then it waits for tokens or more lines. After disconnect()
+        it keeps going only while there is something left to send."""
+        while True:
+            with self.send_ready:
+                while not (self.outbox and self.connected):
+                    if not self.running:
+                        return
+                    self.send_ready.wait()
+                batch = []
+                wait = 0
+                while self.outbox:
+                    wait = self.bucket.reserve(self.outbox[0][1])
+                    if wait:
+                        break
+                    batch.append(self.outbox.popleft()[0])
+                if not batch:
+                    # New lines at the front may cost nothing, so wake for them
+                    self.send_ready.wait(wait)
+                    continue
+            try:
+                self.sock.sendall(b''.join(batch))
+            except OSError as e:
+                if not self.running:
+                    return
+                self.show(f"{Colors.RED}[ERROR] Send error: {e}{Colors.RESET}")
+                # With reconnecting on, the receive loop notices the drop
+                if not self.reconnect:
+                    self.running = False
+
+    def open_connection(self):
+        """Connects, over TLS if configured, and registers. The TLS session of
+        the last connection is offered for resumption, which skips the full
+        handshake while the server still has it."""
+        sock = socket.create_connection((self.host, self.port), timeout=self.CONNECT_TIMEOUT)
         try:
-            if not command.endswith('\r\n'):
-                command += '\r\n'
-            self.sock.send(command.encode('utf-8'))
-        except Exception as e:
-            print(f"{Colors.RED}[ERROR] Send error: {e}{Colors.RESET}")
-            self.running = False
+            if self.ssl_context:
+                sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host, session=self.tls_session)
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+        self.connected = True
+        self.start_session()
 
     def receive_loop(self):
-        buffer = ""
+        """Reads the connection until it drops, then reconnects with backoff
+        unless we quit, the server closed us with ERROR or reconnecting is off."""
+        while self.running:
+            self.read_connection()
+            if not self.running or self.closing or self.quitting or not self.reconnect:
+                self.running = False
+                break
+            self.reconnect_loop()
+
+    def read_connection(self):
+        buffer = bytearray()
         while self.running:
             try:
-                data = self.sock.recv(4096).decode('utf-8')
+                data = self.sock.recv(self.RECV_SIZE)
                 if not data:
-                    self.running = False
-                    print(f"{Colors.RED}Connection closed by server{Colors.RESET}")
+                    self.show(f"{Colors.RED}Connection closed by server{Colors.RESET}")
                     break
-                    
+
                 buffer += data
-                while '\r\n' in buffer:
-                    line, buffer = buffer.split('\r\n', 1)
+                for line in self.split_lines(buffer):
                     self.handle_server_message(line)
             except Exception as e:
                 if self.running:
-                    print(f"{Colors.RED}[ERROR] Receive error: {e}{Colors.RESET}")
-                self.running = False
+                    self.show(f"{Colors.RED}[ERROR] Receive error: {e}{Colors.RESET}")
                 break
+        with self.send_ready:
+            self.connected = False
+            unsent = len(self.outbox)
+            self.outbox.clear()
+        if unsent:
+            self.show(f"{Colors.YELLOW}{unsent} queued lines were not sent{Colors.RESET}")
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def on_registered(self, message):
+        if self.ssl_context:
+            # Kept from here: TLS 1.3 tickets come after the handshake, and a
+            # connection that drops without close_notify no longer has one
+            self.tls_session = self.sock.session
+
+    def reconnect_loop(self):
+        if self.welcomed:
+            # The connection that dropped had worked, start the delays over
+            self.backoff.reset()
+        while self.running:
+            delay = self.backoff.next()
+            self.show(f"{Colors.YELLOW}Reconnecting in {delay:.1f}s...{Colors.RESET}")
+            time.sleep(delay)
+            if not self.running:
+                return
+            try:
+                self.open_connection()
+            except OSError as e:
+                self.show(f"{Colors.RED}Reconnect failed: {e}{Colors.RESET}")
+                continue
+            resumed = " (TLS session resumed)" if self.ssl_context and self.sock.session_reused else ""
+            self.show(f"{Colors.GREEN}Reconnected to {self.host}:{self.port}{resumed}{Colors.RESET}")
+            return
 
     def handle_command(self, command):
         parts = command.split()
@@ -269,10 +1043,7 @@ class IRCClient:
             self.show_help()
         elif cmd == 'join':
             if len(parts) > 1:
-                channel = parts[1]
-                if not channel.startswith('#'):
-                    channel = '#' + channel
-                self.send_command(f"JOIN {channel}")
+                channel = self.join(parts[1])
                 self.active_channel = channel
                 self.input_prompt = f"{Colors.BLUE}[{channel}]{Colors.RESET}> "
                 print(f"{Colors.GREEN}Joined {channel}{Colors.RESET}")
@@ -281,42 +1052,56 @@ class IRCClient:
         elif cmd == 'nick':
             if len(parts) > 1:
                 new_nick = parts[1]
-                self.send_command(f"NICK {new_nick}")
-                self.nick = new_nick
-                print(f"{Colors.GREEN}Nickname changed to {new_nick}{Colors.RESET}")
+                self.change_nick(new_nick)
+                print(f"{Colors.GREEN}Changing nickname to {new_nick}{Colors.RESET}")
             else:
                 print(f"{Colors.RED}Usage: /nick newname{Colors.RESET}")
-        elif cmd == 'mode':
+        elif cmd == 'msg':
             if len(parts) > 2:
-                self.send_command(f"MODE {' '.join(parts[1:])}")
+                text = ' '.join(parts[2:])
+                self.privmsg(parts[1], text)
+                print(f"{Colors.MAGENTA}-> *{parts[1]}*{Colors.RESET} {text}")
             else:
-                print(f"{Colors.RED}Usage: /mode #channel [+/-mode] [args]{Colors.RESET}")
+                print(f"{Colors.RED}Usage: /msg target message{Colors.RESET}")
+        elif cmd == 'mode':
+            if len(parts) > 1:
+                self.mode(' '.join(parts[1:]))
+            else:
+                print(f"{Colors.RED}Usage: /mode #channel [+/-nps]{Colors.RESET}")
         elif cmd == 'whois':
             if len(parts) > 1:
-                self.send_command(f"WHOIS {parts[1]}")
+                self.whois(parts[1])
             else:
                 print(f"{Colors.RED}Usage: /whois nickname{Colors.RESET}")
         elif cmd == 'me':
             if len(parts) > 1 and self.active_channel:
-                action = ' '.join(parts[1:])
-                self.send_command(f"PRIVMSG {self.active_channel} :\x01ACTION {action}\x01")
+                self.action(self.active_channel, ' '.join(parts[1:]))
             else:
                 print(f"{Colors.RED}Usage: /me action{Colors.RESET}")
         elif cmd == 'list':
-            self.send_command("LIST")
+            self.list_channels(' '.join(parts[1:]))
             print(f"{Colors.GREEN}Requested channel list{Colors.RESET}")
         elif cmd == 'part':
             channel = parts[1] if len(parts) > 1 else self.active_channel
             if channel:
-                self.send_command(f"PART {channel}")
+                self.part(channel)
                 if channel == self.active_channel:
                     self.active_channel = None
                     self.input_prompt = "> "
                 print(f"{Colors.GREEN}Left {channel}{Colors.RESET}")
             else:
                 print(f"{Colors.RED}Not in any channel to part{Colors.RESET}")
+        elif cmd == 'search':
+            channel = parts[-1] if len(parts) > 2 and parts[-1].startswith('#') else None
+            words = parts[1:-1] if channel else parts[1:]
+            if not self.chat_log:
+                print(f"{Colors.RED}Logging is off, start with --log-dir to search{Colors.RESET}")
+            elif words:
+                self.show_search(' '.join(words), channel)
+            else:
+                print(f"{Colors.RED}Usage: /search words [#channel]{Colors.RESET}")
         elif cmd == 'quit':
-            self.send_command("QUIT")
+            self.quit()
             self.running = False
             print(f"{Colors.GREEN}Disconnecting...{Colors.RESET}")
         else:
@@ -333,11 +1118,11 @@ class IRCClient:
                     self.handle_command(command[1:])
                 else:
                     if self.active_channel:
-                        self.send_command(f"PRIVMSG {self.active_channel} :{command}")
+                        self.privmsg(self.active_channel, command)
                     else:
                         print(f"{Colors.RED}Not in any channel. Use /join #channel{Colors.RESET}")
             except KeyboardInterrupt:
-                self.send_command("QUIT")
+                self.quit()
                 print(f"\n{Colors.GREEN}Disconnecting...{Colors.RESET}")
                 self.running = False
                 break
@@ -345,28 +1130,28 @@ class IRCClient:
                 print(f"{Colors.RED}Input error: {e}{Colors.RESET}")
 
     def connect(self, host, port, use_ssl=False, ssl_verify=False, ssl_cert=None):  # SSL PARAMS ADDED
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.host = host
+        self.port = port
         try:
             if use_ssl:
-                context = ssl.create_default_context()
-                if not ssl_verify:  # Skip verification for self-signed certs
-                    context.check_hostname = False
-                    context.verify_mode = ssl.CERT_NONE
-                elif ssl_cert:  # Use custom CA cert
-                    context.load_verify_locations(cafile=ssl_cert)
-                self.sock = context.wrap_socket(self.sock, server_hostname=host)
-            
-            nickname = input(f"Nickname [{self.nick}]: ") or self.nick
-            self.nick = nickname
-            self.sock.connect((host, port))
+                self.ssl_context = make_ssl_context(ssl_verify, ssl_cert)
+
+            self.wanted_nick = input(f"Nickname [{self.nick}]: ") or self.nick
+            self.open_connection()
             self.running = True
             self.show_welcome()
-            self.send_command(f"NICK {self.nick}")
-            self.send_command(f"USER {self.nick} 0 * :{self.nick}")
             
             receive_thread = threading.Thread(target=self.receive_loop)
             receive_thread.daemon = True
             receive_thread.start()
+
+            self.render_thread = threading.Thread(target=self.render_loop)
+            self.render_thread.daemon = True
+            self.render_thread.start()
+
+            self.writer_thread = threading.Thread(target=self.write_loop)
+            self.writer_thread.daemon = True
+            self.writer_thread.start()
             
             self.input_loop()
         except Exception as e:
@@ -376,6 +1161,18 @@ class IRCClient:
 
     def disconnect(self):
         self.running = False
+        if self.writer_thread:
+            # Give the QUIT, queued in front, a moment to go out
+            with self.send_ready:
+                self.send_ready.notify()
+            self.writer_thread.join(timeout=1.0)
+        self.connected = False
+        if self.chat_log:
+            self.chat_log.close()
+        if self.render_thread:
+            # Let the last frame out before saying goodbye
+            self.render_ready.set()
+            self.render_thread.join(timeout=1.0)
         if self.sock:
             try:
                 self.sock.close()
@@ -383,16 +1180,266 @@ class IRCClient:
                 pass
         print(f"{Colors.GREEN}Disconnected from server{Colors.RESET}")
 
+class AsyncIRCClient(ClientProtocol):
+    """One connection run by an asyncio event loop, for bots. Thousands fit in
+    one process: no threads, no terminal, one read task each.
+
+    Events go to callbacks registered with on(): an IRC command ('PRIVMSG',
+    '353', ...), '*' for every line, 'registered' once the server accepted
+    the nick, and 'disconnected'. Callbacks are called as callback(client,
+    message), message is None for 'disconnected'. A coroutine function runs
+    as its own task. Clients can share one callbacks dict.
+
+    connect() makes one connection, run() keeps reconnecting with backoff
+    and restores nick and channels each time. Sends are paced like the
+    interactive client's, lines the bucket can't pay for yet wait in an
+    outbox that only exists while there is a backlog."""
+    __slots__ = ('callbacks', 'reader', 'writer', 'task', 'registered', 'outbox', 'flusher')
+
+    # Keeps callback tasks alive until they finish
+    tasks = set()
+
+    def __init__(self, nick, callbacks=None, encoding='utf-8', fallback_encoding='latin-1',
+                 send_rate=ClientProtocol.SEND_RATE, send_burst=ClientProtocol.SEND_BURST):
+        super().__init__(nick, encoding, fallback_encoding, send_rate, send_burst)
+        self.callbacks = {} if callbacks is None else callbacks
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.registered = asyncio.Event()
+        self.outbox = None
+        self.flusher = None
+
+    def on(self, event, callback):
+        self.callbacks.setdefault(event, []).append(callback)
+        return callback
+
+    def emit(self, event, message):
+        for callback in self.callbacks.get(event, ()):
+            try:
+                result = callback(self, message)
+            except Exception as e:
+                print(f"{Colors.RED}[ERROR] {self.nick}: {event} callback failed: {e!r}{Colors.RESET}")
+                continue
+            if asyncio.iscoroutine(result):
+                task = asyncio.ensure_future(result)
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def connect(self, host, port, ssl_context=None):
+        """Opens the connection, registers the nick and starts reading.
+        Returns once connected, wait on registered for the server's 001."""
+        self.reader, self.writer = await asyncio.open_connection(
+            host, port, ssl=ssl_context, server_hostname=host if ssl_context else None)
+        # Nothing queued for the last connection belongs on this one
+        if self.flusher:
+            self.flusher.cancel()
+        self.outbox = self.flusher = None
+        self.registered.clear()
+        self.start_session()
+        self.task = asyncio.ensure_future(self.receive_loop())
+
+    def send_command(self, command):
+        if self.writer is None or self.writer.is_closing():
+            return
+        if not command.endswith('\r\n'):
+            command += '\r\n'
+        data = command.encode(self.encoding, 'replace')
+        weight = self.weight(command)
+        # PONG and QUIT skip the queue, the rest keeps its order
+        if not weight or (not self.outbox and not self.bucket.reserve(weight)):
+            self.writer.write(data)
+            return
+        if self.outbox is None:
+            self.outbox = collections.deque()
+        self.outbox.append((data, weight))
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_outbox())
+
+    async def flush_outbox(self):
+        """Writes the backlog as the bucket refills, everything it can pay
+        for at once in one write."""
+        try:
+            while self.outbox and not self.writer.is_closing():
+                wait = self.bucket.reserve(self.outbox[0][1])
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                batch = [self.outbox.popleft()[0]]
+                while self.outbox and not self.bucket.reserve(self.outbox[0][1]):
+                    batch.append(self.outbox.popleft()[0])
+                self.writer.write(b''.join(batch))
+        finally:
+            # A reconnect may already have replaced this task
+            if self.flusher is asyncio.current_task():
+                self.outbox = self.flusher = None
+
+    async def drain(self):
+        """Waits while the socket's send buffer is full, for bulk senders."""
+        if self.writer and not self.writer.is_closing():
+            await self.writer.drain()
+
+    async def receive_loop(self):
+        buffer = bytearray()
+        try:
+            while True:
+                data = await self.reader.read(self.RECV_SIZE)
+                if not data:
+                    break
+                buffer += data
+                for line in self.split_lines(buffer):
+                    if line:
+                        self.dispatch(Message.parse(line))
+        except OSError:
+            pass
+        finally:
+            self.writer.close()
+            self.emit('disconnected', None)
+
+    def dispatch(self, message):
+        self.handle_protocol(message)
+        self.emit(message.command, message)
+        self.emit('*', message)
+
+    async def run(self, host, port, ssl_context=None, backoff=None):
+        """Stays connected: connects if not connected and reconnects after a
+        backoff delay whenever the connection drops. Returns after close(),
+        or once the server closed us with ERROR."""
+        backoff = backoff or Backoff()
+        while not self.quitting:
+            if self.task is None or self.task.done():
+                try:
+                    await self.connect(host, port, ssl_context)
+                except OSError:
+                    await asyncio.sleep(backoff.next())
+                    continue
+            await self.task
+            if self.quitting or self.closing:
+                break
+            if self.welcomed:
+                # The connection that dropped had worked, start the delays over
+                backoff.reset()
+            await asyncio.sleep(backoff.next())
+
+    async def close(self, reason=None, timeout=5.0):
+        """Sends QUIT and waits for the server to hang up."""
+        self.quit(reason)
+        if self.task:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.task), timeout)
+            except asyncio.TimeoutError:
+                self.writer.close()
+
+    def on_registered(self, message):
+        self.registered.set()
+        self.emit('registered', message)
+
+async def run_bots(args):
+    """Headless mode: args.bots connections in this one event loop, each
+    joining args.join, with a status line every args.status_interval
+    seconds until they have all disconnected or Ctrl-C."""
+    # Thousands of connections need thousands of descriptors. An unlimited
+    # hard limit (macOS) can't be the soft one, ask for 65536 instead
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        except (ValueError, OSError) as e:
+            print(f"{Colors.YELLOW}Could not raise the open file limit from {soft}: {e}{Colors.RESET}")
+
+    received = [0]
+    def count(client, message):
+        received[0] += 1
+    channels = [channel if channel.startswith('#') else '#' + channel for channel in args.join]
+    def join_channels(client, message):
+        # After a reconnect the client is already rejoining what it was in
+        for channel in channels:
+            if channel not in client.channels:
+                client.join(channel)
+    def show(client, message):
+        print(f"{client.nick} {message.param(0)} <{message.nick}> {message.param(-1)}")
+    callbacks = {'*': [count], 'registered': [join_channels]}
+    if args.print_messages:
+        callbacks['PRIVMSG'] = [show]
+
+    context = make_ssl_context(not args.no_ssl_verify, args.ssl_cert) if args.ssl else None
+    clients = [AsyncIRCClient(f"{args.nick}{i}", callbacks, args.encoding, args.fallback_encoding,
+                              args.send_rate, args.send_burst)
+               for i in range(args.bots)]
+    limit = asyncio.Semaphore(args.connect_concurrency)
+    async def supervise(client):
+        async with limit:
+            try:
+                await client.connect(args.host, args.port, context)
+            except OSError as e:
+                print(f"{Colors.RED}{client.nick}: connect failed: {e}{Colors.RESET}")
+        if args.no_reconnect:
+            if client.task:
+                await client.task
+            return
+        await client.run(args.host, args.port, context, Backoff(args.reconnect_delay, args.reconnect_max))
+
+    supervisors = [asyncio.ensure_future(supervise(client)) for client in clients]
+    try:
+        last = 0
+        while any(not supervisor.done() for supervisor in supervisors):
+            await asyncio.sleep(args.status_interval)
+            connected = sum(1 for client in clients if client.registered.is_set() and not client.task.done())
+            print(f"{Colors.GRAY}[{time.strftime('%H:%M:%S')}]{Colors.RESET} {connected}/{len(clients)} connected, "
+                  f"{received[0]} lines received ({(received[0] - last) / args.status_interval:.0f}/s)")
+            last = received[0]
+    finally:
+        await asyncio.gather(*(client.close() for client in clients if client.task and not client.task.done()))
+        for supervisor in supervisors:
+            supervisor.cancel()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--ssl", action="store_true", help="Enable SSL/TLS")
     parser.add_argument("--no-ssl-verify", action="store_true", help="Disable SSL certificate verification (for testing)")
     parser.add_argument("--ssl-cert", help="Path to custom CA cert (e.g., self-signed cert.pem)")
+    parser.add_argument("--encoding", default="utf-8", help="Encoding of server lines and of what we send")
+    parser.add_argument("--fallback-encoding", default="latin-1",
+                        help="Decodes lines that aren't valid in --encoding")
+    parser.add_argument("--frame-interval", type=float, default=IRCClient.FRAME_INTERVAL,
+                        help="Seconds between screen redraws while lines are arriving")
+    parser.add_argument("--host", help="Server address, asked for if not given")
+    parser.add_argument("--port", type=int, help="Server port, asked for if not given")
+    parser.add_argument("--send-rate", type=float, default=ClientProtocol.SEND_RATE,
+                        help="Lines per second we send at most, JOIN and NICK count more, 0 for no pacing")
+    parser.add_argument("--send-burst", type=float, default=ClientProtocol.SEND_BURST,
+                        help="Lines sent at once before pacing starts")
+    parser.add_argument("--log-dir",
+                        help="Log channel and private messages here for /search, e.g. ~/.py-irc/logs (off by default)")
+    parser.add_argument("--no-reconnect", action="store_true", help="Exit when the connection drops")
+    parser.add_argument("--reconnect-delay", type=float, default=1.0,
+                        help="Longest wait before the first reconnect, doubling after each failure")
+    parser.add_argument("--reconnect-max", type=float, default=60.0, help="Cap on the reconnect wait")
+    headless = parser.add_argument_group("headless bots", "Run many connections without a terminal UI")
+    headless.add_argument("--bots", type=int, default=0, help="Number of connections, 0 for the interactive client")
+    headless.add_argument("--nick", default="bot", help="Bot nicks are this plus a number")
+    headless.add_argument("--join", nargs="*", default=[], help="Channels every bot joins")
+    headless.add_argument("--connect-concurrency", type=int, default=200, help="Connections opened at once")
+    headless.add_argument("--status-interval", type=float, default=10.0, help="Seconds between status lines")
+    headless.add_argument("--print-messages", action="store_true", help="Print every PRIVMSG each bot receives")
     args = parser.parse_args()
 
-    client = IRCClient()
-    host = input("Server address [127.0.0.1]: ") or "127.0.0.1"
-    port = int(input("Server port [6667]: ") or 6667)
+    if args.bots:
+        args.host = args.host or "127.0.0.1"
+        args.port = args.port or 6667
+        try:
+            asyncio.run(run_bots(args))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    client = IRCClient(encoding=args.encoding, fallback_encoding=args.fallback_encoding,
+                       frame_interval=args.frame_interval, reconnect=not args.no_reconnect,
+                       backoff=Backoff(args.reconnect_delay, args.reconnect_max),
+                       send_rate=args.send_rate, send_burst=args.send_burst, log_dir=args.log_dir)
+    host = args.host or input("Server address [127.0.0.1]: ") or "127.0.0.1"
+    port = args.port or int(input("Server port [6667]: ") or 6667)
     client.connect(
         host=host,
         port=port,
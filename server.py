@@ -3,8 +3,24 @@ import threading
 import time
 import datetime
 import sys
-import select
 import ssl
+import asyncio
+import os
+import queue
+import signal
+import subprocess
+import tempfile
+import ipaddress
+import bisect
+import hmac
+import http.server
+import json
+import collections
+import itertools
+import re
+import mmap
+import struct
+import urllib.parse
 
 # ANSI color codes
 class Colors:
@@ -20,228 +36,2469 @@ class Colors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+class NamesChunk:
+    """One 353 line worth of a channel's NAMES reply. A chunk holds a few
+    dozen names, so members and their ":nick" prefixes are two parallel
+    lists in join order, cheaper than a dict and quick enough to search."""
+    __slots__ = ('members', 'names', 'length', 'payload')
+
+    def __init__(self):
+        self.members = []
+        self.names = []
+        self.length = 0
+        self.payload = None
+
 class Channel:
+    """Membership changes happen under the channel lock. Fan-out iterates
+    snapshot(), an immutable tuple rebuilt only after membership changed, so
+    senders never hold the lock and never see the set change under them.
+
+    The NAMES reply is kept the same way: members are packed into chunks
+    that each fit one 353 line, a join, part or rename only touches its own
+    chunk, and names() rejoins just the chunks that changed. members and
+    remote map each member to its chunk, and chunks hold the session's own
+    ":nick" prefix bytes, so a membership costs one dict entry and no copy
+    of the name.
+
+    Channel modes are bits of one int, MODES maps each letter to its bit."""
+    __slots__ = ('name', 'members', 'remote', 'created', 'lock', 'members_snapshot',
+                 'names_budget', 'names_chunks', 'names_snapshot', 'history', 'modes', 'founder')
+
+    # ":server 353 <nick> = <channel> :<names>\r\n", the nick sized for NICKLEN
+    NAMES_OVERHEAD = len(b":server 353  =  :\r\n") + 30
+    NO_EXTERNAL = 1  # +n: only members can send to the channel
+    PRIVATE = 2      # +p and +s: left out of LIST, WHOIS and NAMES for non-members
+    SECRET = 4
+    MODES = {'n': NO_EXTERNAL, 'p': PRIVATE, 's': SECRET}
+    HIDDEN = PRIVATE | SECRET
+    DEFAULT_MODES = NO_EXTERNAL
+
     def __init__(self, name):
-        self.name = name
-        self.members = set()
+        self.name = sys.intern(name)
+        self.members = {}
+        self.remote = {}
         self.created = datetime.datetime.now()
+        self.lock = threading.Lock()
+        self.members_snapshot = ()
+        self.names_budget = 512 - self.NAMES_OVERHEAD - len(name.encode())
+        self.names_chunks = []
+        self.names_snapshot = ()
+        # Scrollback, see IRCServer.history_of
+        self.history = None
+        self.modes = self.DEFAULT_MODES
+        # Connection of the local user whose JOIN created the channel, the
+        # only one who may change its modes. None for channels made otherwise.
+        self.founder = None
+
+    def add(self, client, prefix):
+        """Adds a local member, prefix is its ":nick" as in Session.prefix."""
+        with self.lock:
+            if client not in self.members:
+                self.members[client] = self.add_name(client, prefix)
+                self.members_snapshot = None
+
+    def discard(self, client):
+        """Removes a local member, returns False if it wasn't one."""
+        with self.lock:
+            chunk = self.members.pop(client, None)
+            if chunk is None:
+                return False
+            self.members_snapshot = None
+            self.discard_name(client, chunk)
+            return True
+
+    def add_remote(self, user):
+        with self.lock:
+            if user not in self.remote:
+                self.remote[user] = self.add_name(user, f":{user.nick}".encode())
+
+    def discard_remote(self, user):
+        with self.lock:
+            chunk = self.remote.pop(user, None)
+            if chunk is not None:
+                self.discard_name(user, chunk)
+
+    def rename(self, member, prefix):
+        """Updates a member's entry in the NAMES reply after a nick change."""
+        with self.lock:
+            index = self.members if member in self.members else self.remote
+            chunk = index.get(member)
+            if chunk is None:
+                return
+            position = chunk.members.index(member)
+            old = chunk.names[position]
+            if chunk.length - len(old) + len(prefix) <= self.names_budget:
+                chunk.names[position] = prefix
+                chunk.length += len(prefix) - len(old)
+                chunk.payload = None
+                self.names_snapshot = None
+            else:
+                self.discard_name(member, chunk)
+                index[member] = self.add_name(member, prefix)
+
+    def add_name(self, member, prefix):
+        """Packs a name into the last chunk, or a new one. Returns the chunk.
+        Called with the lock held."""
+        # The ':' of the prefix makes up for the space between names
+        size = len(prefix)
+        chunks = self.names_chunks
+        if not chunks or chunks[-1].length + size > self.names_budget:
+            chunks.append(NamesChunk())
+        chunk = chunks[-1]
+        chunk.members.append(member)
+        chunk.names.append(prefix)
+        chunk.length += size
+        chunk.payload = None
+        self.names_snapshot = None
+        return chunk
+
+    def discard_name(self, member, chunk):
+        # Called with the lock held
+        position = chunk.members.index(member)
+        del chunk.members[position]
+        chunk.length -= len(chunk.names.pop(position))
+        chunk.payload = None
+        if not chunk.names:
+            self.names_chunks.remove(chunk)
+        self.names_snapshot = None
+
+    def names(self):
+        """Returns the NAMES reply as a tuple of space separated payloads, one
+        per 353 line."""
+        snapshot = self.names_snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.names_snapshot
+                if snapshot is None:
+                    for chunk in self.names_chunks:
+                        if chunk.payload is None:
+                            # ":a :b :c" to "a b c", nicks never hold a space
+                            chunk.payload = b' '.join(chunk.names)[1:].replace(b' :', b' ')
+                    snapshot = self.names_snapshot = tuple(chunk.payload for chunk in self.names_chunks)
+        return snapshot
+
+    def snapshot(self):
+        snapshot = self.members_snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.members_snapshot
+                if snapshot is None:
+                    snapshot = self.members_snapshot = tuple(self.members)
+        return snapshot
+
+    def size(self):
+        return len(self.members) + len(self.remote)
+
+    def mode_string(self):
+        return '+' + ''.join(letter for letter, bit in self.MODES.items() if self.modes & bit)
+
+    def visible_to(self, client):
+        return not self.modes & self.HIDDEN or client in self.members
+
+class Scrollback:
+    """Recent messages of one channel as (time.time(), wire line) pairs, the
+    exact bytes that were relayed, so a replay is one joined write. Capped by
+    line count and bytes. Going over either drops the oldest quarter at once
+    and, with a spill path, appends that segment to the channel's file in a
+    single write. The file is only read back by history requests reaching
+    past what is still in memory, through mmap.
+    Shares the channel lock, queries copy the entries under it and do the
+    filtering and file reading outside. The spill is written outside it
+    too, under spill_lock, which keeps segments in eviction order without
+    holding up joins and fan-out on the channel."""
+    __slots__ = ('lock', 'entries', 'size', 'max_lines', 'max_bytes', 'spill', 'spill_lock')
+
+    # Spill records: timestamp, line length, then the line itself
+    RECORD = struct.Struct('<dH')
+
+    def __init__(self, lock, max_lines, max_bytes, spill=None):
+        self.lock = lock
+        self.entries = collections.deque()
+        self.size = 0
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.spill_lock = threading.Lock() if spill else None
+
+    def append(self, stamp, line):
+        with self.lock:
+            self.entries.append((stamp, line))
+            self.size += len(line)
+            if len(self.entries) <= self.max_lines and self.size <= self.max_bytes:
+                return
+            dropped = self.evict(self.max_lines * 3 // 4, self.max_bytes * 3 // 4)
+            if not self.spill:
+                return
+            # Taken before the channel lock is let go, so a later eviction
+            # can't write its segment first
+            self.spill_lock.acquire()
+        try:
+            record = self.RECORD.pack
+            with open(self.spill, 'ab') as f:
+                f.write(b''.join(record(stamp, len(line)) + line for stamp, line in dropped))
+        except OSError:
+            pass
+        finally:
+            self.spill_lock.release()
+
+    def copy(self):
+        with self.lock:
+            return list(self.entries)
+
+    def evict(self, lines, size):
+        """Drops the oldest entries down to the limits and returns them.
+        Called with the lock held."""
+        entries = self.entries
+        dropped = []
+        while entries and (len(entries) > lines or self.size > size):
+            entry = entries.popleft()
+            self.size -= len(entry[1])
+            dropped.append(entry)
+        return dropped
+
+    def spilled(self):
+        """Yields the (stamp, line) entries in the spill file, oldest first."""
+        if not self.spill:
+            return
+        try:
+            with open(self.spill, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset, end = 0, len(data)
+                header = self.RECORD.size
+                while offset + header <= end:
+                    stamp, length = self.RECORD.unpack_from(data, offset)
+                    offset += header
+                    if offset + length > end:
+                        # A segment still being appended
+                        break
+                    yield stamp, data[offset:offset + length]
+                    offset += length
+        except (OSError, ValueError):
+            # Missing or empty file (mmap refuses zero length)
+            return
+
+    def latest(self, limit):
+        return self.copy()[-limit:] if limit > 0 else []
+
+    def before(self, stamp, limit):
+        """The last limit entries older than stamp, oldest first."""
+        found = [entry for entry in self.copy() if entry[0] < stamp]
+        # Everything in the file is older than what is in memory
+        if len(found) < limit:
+            older = collections.deque((entry for entry in self.spilled() if entry[0] < stamp), maxlen=limit - len(found))
+            found[:0] = older
+        return found[-limit:]
+
+    def after(self, stamp, limit):
+        """The first limit entries newer than stamp, oldest first."""
+        entries = self.copy()
+        found = []
+        if not entries or entries[0][0] > stamp:
+            for entry in self.spilled():
+                if entry[0] > stamp:
+                    found.append(entry)
+                    if len(found) >= limit:
+                        return found
+        for entry in entries:
+            if entry[0] > stamp:
+                found.append(entry)
+                if len(found) >= limit:
+                    break
+        return found
+
+class Session:
+    """Everything the server keeps for one local client. Slotted, and nick,
+    channel names and IP are interned, so idle clients share their strings
+    instead of each carrying a dict of copies."""
+    __slots__ = ('conn', 'ip', 'nick', 'prefix', 'channels', 'buffer',
+                 'connected', 'last_seen', 'last_active', 'ping_sent', 'timer',
+                 'flood', 'tokens', 'stamp', 'strikes', 'struck', 'backlog', 'backlog_pos', 'paid', 'listing')
+
+    def __init__(self, conn, ip):
+        self.conn = conn
+        self.ip = sys.intern(ip)
+        self.nick = None
+        self.prefix = None
+        # Names of joined channels. A tuple, a set would cost 216 bytes per
+        # client; only Registry.join and part replace it, under its lock
+        self.channels = ()
+        self.buffer = LineBuffer()
+        # time.monotonic() stamps for the liveness timer
+        self.connected = self.last_seen = self.last_active = time.monotonic()
+        self.ping_sent = 0
+        self.timer = None
+        # Flood control bucket, see FloodControl
+        self.flood = None
+        self.tokens = 0.0
+        self.stamp = self.connected
+        self.strikes = 0.0
+        self.struck = 0.0
+        # Lines of the last read, run from backlog_pos on. paid: the line
+        # there was charged already and was only waiting for its turn.
+        self.backlog = ()
+        self.backlog_pos = 0
+        self.paid = False
+        # Lines of a LIST reply still to send, see IRCServer.send_listing
+        self.listing = None
+
+class Registry:
+    """Owns the connected clients, nick table and channels. Every change goes
+    through a method that holds the registry lock, so the client threads, the
+    admin console and the bus never interleave a check with its update.
+    Lookups read the dicts directly."""
+    def __init__(self, default_channels=()):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.nicknames = {}
+        self.remote_users = {}
+        self.channels = {name: Channel(name) for name in default_channels}
+        # ip -> set of local clients / remote users, kept in step with the tables above
+        self.ip_clients = {}
+        self.ip_remote_users = {}
+
+    def add_client(self, client, ip):
+        session = Session(client, ip)
+        with self.lock:
+            self.clients[client] = session
+            self.ip_clients.setdefault(session.ip, set()).add(client)
+        return session
+
+    def remove_client(self, client):
+        """Unregisters a client and its nick. Returns its session, or None if
+        another thread already removed it. join() and part() leave the
+        session's channels alone from then on."""
+        with self.lock:
+            session = self.clients.pop(client, None)
+            if session is None:
+                return None
+            if session.nick and self.nicknames.get(session.nick) is client:
+                del self.nicknames[session.nick]
+            self.unindex(self.ip_clients, session.ip, client)
+            return session
+
+    @staticmethod
+    def unindex(index, ip, item):
+        items = index.get(ip)
+        if items is not None:
+            items.discard(item)
+            if not items:
+                del index[ip]
+
+    def join(self, client, channel, prefix):
+        """Adds a client to a channel. Under the lock, so it can't land after
+        remove_client() has taken the client's channels. Returns the session,
+        or None if the client is gone."""
+        with self.lock:
+            session = self.clients.get(client)
+            if session is None:
+                return None
+            channel.add(client, prefix)
+            if channel.name not in session.channels:
+                session.channels += (channel.name,)
+            return session
+
+    def part(self, client, channel):
+        """Removes a client from a channel, returns False if it wasn't in it."""
+        with self.lock:
+            session = self.clients.get(client)
+            if session is None or not channel.discard(client):
+                return False
+            session.channels = tuple(name for name in session.channels if name != channel.name)
+            return True
+
+    def clients_from(self, ip):
+        """Returns [(client, session)] for every local session from ip."""
+        with self.lock:
+            return [(client, self.clients[client]) for client in self.ip_clients.get(ip, ())]
+
+    def remote_users_from(self, ip):
+        with self.lock:
+            return list(self.ip_remote_users.get(ip, ()))
+
+    def connected_ips(self):
+        with self.lock:
+            return list(self.ip_clients)
+
+    def client_items(self):
+        with self.lock:
+            return list(self.clients.items())
+
+    def set_nick(self, client, nick):
+        """Claims nick for client. Returns (True, old_nick) or (False, None) if taken."""
+        nick = sys.intern(nick)
+        with self.lock:
+            session = self.clients.get(client)
+            if session is None or nick in self.nicknames or nick in self.remote_users:
+                return False, None
+            old_nick = session.nick
+            if old_nick and self.nicknames.get(old_nick) is client:
+                del self.nicknames[old_nick]
+            session.nick = nick
+            session.prefix = f":{nick}".encode()
+            self.nicknames[nick] = client
+            return True, old_nick
+
+    def revert_nick(self, nick, old_nick):
+        """Takes nick back from its local owner after a collision, restoring
+        old_nick if it is still free. Returns the client, or None."""
+        with self.lock:
+            client = self.nicknames.pop(nick, None)
+            if client is None or client not in self.clients:
+                return None
+            session = self.clients[client]
+            if old_nick and old_nick not in self.nicknames and old_nick not in self.remote_users:
+                session.nick = old_nick
+                session.prefix = f":{old_nick}".encode()
+                self.nicknames[old_nick] = client
+            else:
+                session.nick = None
+                session.prefix = None
+            return client
+
+    def get_channel(self, name, create=False):
+        """Returns (channel, created), channel is None if missing and not created."""
+        channel = self.channels.get(name)
+        if channel is not None or not create:
+            return channel, False
+        with self.lock:
+            channel = self.channels.get(name)
+            if channel is not None:
+                return channel, False
+            channel = self.channels[name] = Channel(name)
+            return channel, True
+
+    def remove_channel(self, name):
+        """Deletes an empty channel. Returns None if missing, False if in use."""
+        with self.lock:
+            channel = self.channels.get(name)
+            if channel is None:
+                return None
+            if channel.size():
+                return False
+            del self.channels[name]
+            return True
+
+    def set_remote_nick(self, old_nick, nick, ip):
+        nick = sys.intern(nick)
+        with self.lock:
+            user = self.remote_users.pop(old_nick, None)
+            if user is None:
+                user = RemoteUser(nick, ip)
+                self.ip_remote_users.setdefault(ip, set()).add(user)
+            user.nick = nick
+            self.remote_users[nick] = user
+            return user
+
+    def remove_remote_user(self, nick):
+        with self.lock:
+            user = self.remote_users.pop(nick, None)
+            if user is not None:
+                self.unindex(self.ip_remote_users, user.ip, user)
+            return user
+
+class RemoteUser:
+    """A user connected to another worker process, known from the state bus."""
+    __slots__ = ('nick', 'ip', 'channels')
+
+    def __init__(self, nick, ip):
+        self.nick = nick
+        self.ip = sys.intern(ip)
+        self.channels = set()
+
+class PrefixTrie:
+    """IP and CIDR networks kept in a binary trie per address family, one
+    level per prefix bit. A lookup walks at most 32 (IPv4) or 128 (IPv6)
+    nodes no matter how many entries exist, and a /16 is a single entry.
+    Holds the bans, and the flood control classes as a network -> value map.
+    Nodes are [zero_child, one_child, value_or_None]."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.networks = set()
+
+    @staticmethod
+    def parse(text):
+        """Turns '1.2.3.4' or '10.0.0.0/16' into a network, raises ValueError."""
+        return ipaddress.ip_network(text, strict=False)
+
+    @staticmethod
+    def bits(network):
+        value = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            yield (value >> (width - 1 - i)) & 1
+
+    def add(self, network, value=None):
+        """Returns False if the exact network was already present. match()
+        returns value for addresses inside it, the network itself by default."""
+        with self.lock:
+            if network in self.networks:
+                return False
+            node = self.roots[network.version]
+            for bit in self.bits(network):
+                if node[bit] is None:
+                    node[bit] = [None, None, None]
+                node = node[bit]
+            node[2] = network if value is None else value
+            self.networks.add(network)
+            return True
+
+    def remove(self, network):
+        """Returns False if the exact network was not present."""
+        with self.lock:
+            if network not in self.networks:
+                return False
+            path = [self.roots[network.version]]
+            for bit in self.bits(network):
+                path.append(path[-1][bit])
+            path[-1][2] = None
+            # Drop the nodes that no longer lead to a ban
+            for bit, parent, node in reversed(list(zip(self.bits(network), path, path[1:]))):
+                if node[0] is None and node[1] is None and node[2] is None:
+                    parent[bit] = None
+                else:
+                    break
+            self.networks.discard(network)
+            return True
+
+    def match(self, ip, longest=False):
+        """Returns the value of a network covering ip, or None: the widest one
+        found first, or the most specific with longest. Lock-free: nodes are
+        only ever swapped in or out whole."""
+        if not self.networks:
+            return None
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        value = int(address)
+        node = self.roots[address.version]
+        shift = address.max_prefixlen - 1
+        found = None
+        while node is not None:
+            if node[2] is not None:
+                if not longest:
+                    return node[2]
+                found = node[2]
+            if shift < 0:
+                break
+            node = node[(value >> shift) & 1]
+            shift -= 1
+        return found
+
+    def __contains__(self, ip):
+        return self.match(ip) is not None
+
+    @staticmethod
+    def describe(network):
+        """'1.2.3.4' for a single host, '10.0.0.0/16' for a range."""
+        if network.num_addresses == 1:
+            return str(network.network_address)
+        return network.with_prefixlen
+
+class FloodProfile:
+    """Token bucket settings for one class of clients. rate 0 means unlimited."""
+    __slots__ = ('rate', 'burst', 'weights', 'max_strikes')
+
+    def __init__(self, rate, burst, weights, max_strikes):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.weights = weights
+        self.max_strikes = max_strikes
+
+class FloodControl:
+    """Per-client token buckets on incoming commands. A bucket holds up to
+    burst tokens and refills at rate tokens per second, each command takes
+    its weight out. The refill is worked out from the time since the last
+    command, so a charge is a few float operations and needs no timer.
+
+    A command the bucket can't cover is held back for as long as the bucket
+    needs to pay for it. The first command held after the client was back
+    under the limit counts a strike, the rest of that burst is only paced,
+    so a long paste costs one strike however many lines it has. Strikes leak
+    away at one per minute, a client holding more than max_strikes (flooding
+    again and again) is disconnected.
+    Profiles come per IP class (most specific CIDR wins) and channels can
+    give PRIVMSG a weight of its own."""
+    WEIGHTS = {b'PRIVMSG': 1.0, b'JOIN': 2.0, b'NICK': 3.0, b'PART': 1.0, b'NAMES': 2.0,
+               b'CHATHISTORY': 3.0, b'LIST': 5.0, b'USER': 1.0, b'PING': 0.0, b'PONG': 0.0, b'QUIT': 0.0}
+    DEFAULT_WEIGHT = 1.0
+    STRIKE_DECAY = 1 / 60
+
+    def __init__(self, rate=5.0, burst=20.0, max_strikes=10, weights=None):
+        self.default = FloodProfile(rate, burst, self.weights(weights), max_strikes)
+        self.classes = PrefixTrie()
+        self.channels = {}
+
+    def weights(self, overrides=None, base=None):
+        weights = dict(base or self.WEIGHTS)
+        for command, weight in (overrides or {}).items():
+            weights[command.upper().encode()] = float(weight)
+        return weights
+
+    def load(self, path):
+        """Reads a JSON file like
+            {"rate": 5, "burst": 20, "max_strikes": 10, "weights": {"NICK": 5},
+             "classes": {"10.0.0.0/8": {"rate": 50, "burst": 200}, "127.0.0.1": {"rate": 0}},
+             "channels": {"#announcements": 10}}
+        Top-level settings replace the defaults, classes fill in what they
+        leave out from them. Raises OSError or ValueError."""
+        with open(path) as f:
+            config = json.load(f)
+        default = self.default
+        if 'weights' in config:
+            default.weights = self.weights(config['weights'])
+        default.rate = float(config.get('rate', default.rate))
+        default.burst = float(config.get('burst', default.burst))
+        default.max_strikes = config.get('max_strikes', default.max_strikes)
+        for network, settings in config.get('classes', {}).items():
+            self.classes.add(PrefixTrie.parse(network), FloodProfile(
+                settings.get('rate', default.rate), settings.get('burst', default.burst),
+                self.weights(settings.get('weights'), default.weights),
+                settings.get('max_strikes', default.max_strikes)))
+        self.channels = {name.encode(): float(weight) for name, weight in config.get('channels', {}).items()}
+
+    def assign(self, session):
+        """Picks the profile for the session's IP and starts with a full bucket."""
+        profile = self.classes.match(session.ip, longest=True) or self.default
+        session.flood = profile
+        session.tokens = profile.burst
+
+    def charge(self, session, line):
+        """Takes one command's weight out of the bucket. Returns 0 if it can
+        run now, otherwise the seconds it has to wait."""
+        profile = session.flood
+        if profile is None or not profile.rate:
+            return 0
+        if line.startswith(b':'):
+            line = line.partition(b' ')[2]
+        command, _, params = line.partition(b' ')
+        command = command.upper()
+        weight = profile.weights.get(command, self.DEFAULT_WEIGHT)
+        if command == b'PRIVMSG' and self.channels:
+            weight = self.channels.get(params.partition(b' ')[0], weight)
+        if not weight:
+            return 0
+        now = time.monotonic()
+        # A bucket left below zero means the last command was held too
+        held = session.tokens < 0
+        tokens = min(profile.burst, session.tokens + (now - session.stamp) * profile.rate) - weight
+        session.tokens = tokens
+        session.stamp = now
+        if tokens >= 0:
+            return 0
+        if not held:
+            session.strikes = max(0.0, session.strikes - (now - session.struck) * self.STRIKE_DECAY) + 1
+            session.struck = now
+        return -tokens / profile.rate
+
+class Timer:
+    __slots__ = ('expires', 'callback', 'args', 'slot')
+
+class TimerWheel:
+    """Hierarchical timing wheel. Level 0 has one slot per tick, each slot of
+    level n covers a whole turn of level n-1, so schedule() and cancel() are
+    O(1) and a timer is moved down at most once per level before it fires.
+    One thread or task calls advance() for the whole server; clients never
+    wake up on their own."""
+    BITS = 6  # 64 slots per level
+
+    def __init__(self, tick=1.0, levels=4):
+        self.tick = tick
+        self.mask = (1 << self.BITS) - 1
+        self.wheels = [[set() for _ in range(1 << self.BITS)] for _ in range(levels)]
+        self.lock = threading.Lock()
+        self.origin = time.monotonic()
+        self.current = 0  # last tick processed
+
+    def schedule(self, delay, callback, *args):
+        timer = Timer()
+        timer.expires = int((time.monotonic() + delay - self.origin) / self.tick) + 1
+        timer.callback = callback
+        timer.args = args
+        with self.lock:
+            self.place(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+
+    def place(self, timer):
+        # Called with the lock held. A timer goes on the lowest level whose
+        # current turn still reaches its tick.
+        expires = max(timer.expires, self.current + 1)
+        for level, wheel in enumerate(self.wheels):
+            shift = self.BITS * (level + 1)
+            if expires >> shift == self.current >> shift or level == len(self.wheels) - 1:
+                timer.slot = wheel[(expires >> (self.BITS * level)) & self.mask]
+                timer.slot.add(timer)
+                return
+
+    def advance(self):
+        """Moves the wheel up to now. Returns the timers that came due, for
+        the caller to run outside the lock."""
+        target = int((time.monotonic() - self.origin) / self.tick)
+        due = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                # Moving into a new turn of a level: spread its slot over the levels below
+                for level in range(1, len(self.wheels)):
+                    if self.current & ((1 << (self.BITS * level)) - 1):
+                        break
+                    slot = self.wheels[level][(self.current >> (self.BITS * level)) & self.mask]
+                    timers = list(slot)
+                    slot.clear()
+                    for timer in timers:
+                        if timer.expires <= self.current:
+                            timer.slot = None
+                            due.append(timer)
+                        else:
+                            self.place(timer)
+                slot = self.wheels[0][self.current & self.mask]
+                for timer in slot:
+                    timer.slot = None
+                due.extend(slot)
+                slot.clear()
+        return due
+
+class LogWriter:
+    """Background log writer. log() calls only enqueue, a thread formats the
+    lines and writes them in batches, flushing every batch_size lines or
+    flush_interval seconds, and rotates the file once it passes max_bytes.
+    When the queue is full lines are dropped rather than blocking the caller."""
+    LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+    STOP = object()
+
+    def __init__(self, path, level='info', max_bytes=10 * 1024 * 1024, backups=5,
+                 batch_size=256, flush_interval=0.5, max_queue=100000):
+        self.path = path
+        self.level = self.LEVELS[level]
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.stamp_second = None
+        self.stamp = ''
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def enabled(self, level):
+        return self.LEVELS[level] >= self.level
+
+    def write(self, message, show=True, level='info'):
+        if self.LEVELS[level] < self.level:
+            return
+        try:
+            self.queue.put_nowait((time.time(), message, show))
+        except queue.Full:
+            self.dropped += 1
+
+    def write_raw(self, text):
+        try:
+            self.queue.put_nowait((None, text, False))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=2.0):
+        try:
+            self.queue.put(self.STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+    def timestamp(self, when):
+        second = int(when)
+        if second != self.stamp_second:
+            self.stamp_second = second
+            self.stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        return self.stamp
+
+    def run(self):
+        pending = []
+        first = 0.0
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0.0, self.flush_interval - (time.monotonic() - first))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self.STOP:
+                self.flush(pending)
+                self.file.close()
+                return
+            if item is not None:
+                if not pending:
+                    first = time.monotonic()
+                pending.append(item)
+            if pending and (len(pending) >= self.batch_size or time.monotonic() - first >= self.flush_interval):
+                self.flush(pending)
+                pending = []
+
+    def flush(self, pending):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            pending.append((time.time(), f"Log queue full, dropped {dropped} lines", True))
+
+        lines = []
+        shown = []
+        for when, message, show in pending:
+            if when is None:
+                lines.append(message)
+                continue
+            entry = f"[{self.timestamp(when)}] {message}\n"
+            lines.append(entry)
+            if show:
+                shown.append(f"{Colors.GRAY}{entry[:-1]}{Colors.RESET}\n")
+
+        try:
+            self.file.write(''.join(lines))
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self.rotate()
+        except OSError as e:
+            print(f"{Colors.RED}Log write error: {e}{Colors.RESET}")
+        if shown:
+            sys.stdout.write(''.join(shown))
+            sys.stdout.flush()
+
+    def rotate(self):
+        self.file.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+class Histogram:
+    """Fixed-bucket histogram, observe() is one bisect and three increments."""
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """Counters and histograms behind /stats and the Prometheus endpoint.
+    Updates are unlocked increments so they can stay on the hot path; two
+    threads bumping the same counter at once can very rarely lose a count,
+    which is fine for monitoring. Gauges are read when rendering instead."""
+    LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+    HANDSHAKE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    SENDQ_BUCKETS = (0, 512, 4096, 16384, 65536, 262144, 1048576, 4194304)
+    COUNTERS = {
+        'bytes_in': "Bytes read from clients",
+        'bytes_out': "Bytes written to clients",
+        'connections': "Connections accepted",
+        'banned_rejects': "Connections refused by a ban",
+        'tls_handshakes': "TLS handshakes completed",
+        'tls_handshake_failures': "TLS handshakes that failed or timed out",
+        'disconnects': "Clients disconnected",
+        'sendq_drops': "Clients dropped for exceeding max_sendq",
+        'timeouts': "Clients dropped by the ping, registration or idle timeout",
+        'unknown_commands': "Lines with a command the server doesn't handle",
+        'flood_delays': "Commands held back by flood control",
+        'flood_disconnects': "Clients disconnected for flooding",
+    }
+
+    def __init__(self, commands):
+        self.started = time.time()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.commands = {name: Histogram(self.LATENCY_BUCKETS) for name in commands}
+        # Local recipients per channel message, tallied by count and only
+        # bucketed when read, a plain dict update is cheaper on the relay path
+        self.fanout_sizes = {}
+        self.handshake = Histogram(self.HANDSHAKE_BUCKETS)
+
+    def inc(self, name, amount=1):
+        self.counters[name] += amount
+
+    def fanout(self):
+        """The fan-out tally as a Histogram."""
+        hist = Histogram(self.FANOUT_BUCKETS)
+        for size, times in list(self.fanout_sizes.items()):
+            hist.counts[bisect.bisect_left(hist.bounds, size)] += times
+            hist.total += size * times
+            hist.count += times
+        return hist
+
+    def render(self, gauges, sendq):
+        """Prometheus text exposition format. gauges is {name: (help, value)},
+        sendq a Histogram of current outbound queue depths."""
+        out = []
+        for name, text in self.COUNTERS.items():
+            out.append(f"# HELP pyirc_{name}_total {text}")
+            out.append(f"# TYPE pyirc_{name}_total counter")
+            out.append(f"pyirc_{name}_total {self.counters[name]}")
+        self.render_histograms(out, 'command_seconds', "Time spent handling a command",
+                               [(f'command="{name}"', hist) for name, hist in self.commands.items()])
+        self.render_histograms(out, 'fanout_recipients', "Local recipients per channel message", [('', self.fanout())])
+        self.render_histograms(out, 'tls_handshake_seconds', "TLS handshake duration", [('', self.handshake)])
+        self.render_histograms(out, 'sendq_bytes', "Outbound queue depth per client, at scrape time", [('', sendq)])
+        gauges = dict(gauges, uptime_seconds=("Seconds since the server started", round(time.time() - self.started, 3)))
+        for name, (text, value) in gauges.items():
+            out.append(f"# HELP pyirc_{name} {text}")
+            out.append(f"# TYPE pyirc_{name} gauge")
+            out.append(f"pyirc_{name} {value}")
+        return '\n'.join(out) + '\n'
+
+    @staticmethod
+    def render_histograms(out, name, text, series):
+        out.append(f"# HELP pyirc_{name} {text}")
+        out.append(f"# TYPE pyirc_{name} histogram")
+        for labels, hist in series:
+            sep = ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(hist.bounds + (float('inf'),), hist.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                out.append(f'pyirc_{name}_bucket{{{labels}{sep}le="{le}"}} {cumulative}')
+            labels = f'{{{labels}}}' if labels else ''
+            out.append(f"pyirc_{name}_sum{labels} {hist.total}")
+            out.append(f"pyirc_{name}_count{labels} {hist.count}")
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves GET /metrics for the server in self.server.irc."""
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.irc.render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class LineBuffer:
+    """Per-connection receive buffer that splits the byte stream into IRC lines."""
+    MAX_LINE = 512  # including the trailing \r\n
+    __slots__ = ('buffer', 'overflow', 'max_line')
+
+    def __init__(self, max_line=MAX_LINE):
+        self.buffer = bytearray()
+        self.overflow = False
+        self.max_line = max_line
+
+    def feed(self, data):
+        """Returns every complete line in data, with None standing in for lines
+        over the protocol limit."""
+        buf = self.buffer
+        buf += data
+        lines = []
+        start = 0
+        while True:
+            end = buf.find(b'\n', start)
+            if end == -1:
+                break
+            if self.overflow or end + 1 - start > self.max_line:
+                self.overflow = False
+                lines.append(None)
+            else:
+                line = bytes(buf[start:end - 1] if end > start and buf[end - 1] == 13 else buf[start:end])
+                if line:
+                    lines.append(line)
+            start = end + 1
+        del buf[:start]
+
+        # No terminator within the limit, drop what we have up to the next one
+        if len(buf) > self.max_line:
+            self.overflow = True
+            buf.clear()
+        return lines
+
+class Connection:
+    """Outbound side of a client. send() only queues, the queue is drained on its
+    own so a client with a full TCP window never stalls whoever is sending to it.
+    Clients whose queue passes max_sendq bytes are dropped."""
+    __slots__ = ('max_sendq', 'pending', 'queued', 'closing', 'overflowed', 'lock', 'metrics')
+
+    def __init__(self, max_sendq, metrics=None):
+        self.max_sendq = max_sendq
+        self.metrics = metrics
+        self.pending = []
+        self.queued = 0
+        self.closing = False
+        self.overflowed = False
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            if self.closing:
+                return 0
+            if self.queued + len(data) > self.max_sendq:
+                self.overflowed = True
+                self.closing = True
+                self.pending = []
+                self.queued = 0
+            else:
+                self.pending.append(data)
+                self.queued += len(data)
+        if self.overflowed:
+            if self.metrics:
+                self.metrics.inc('sendq_drops')
+            self.abort()
+        else:
+            self.wake()
+        return len(data)
+
+    def close(self):
+        """Closes the connection once everything queued so far is written."""
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+        self.wake()
+
+    def take(self):
+        """Returns everything queued as one buffer so it goes out in one write."""
+        with self.lock:
+            if not self.pending:
+                return b''
+            data = self.pending[0] if len(self.pending) == 1 else b''.join(self.pending)
+            self.pending = []
+            self.queued = 0
+        return data
+
+    def wake(self):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+class ThreadedConnection(Connection):
+    __slots__ = ('sock', 'ready', 'writer')
+
+    def __init__(self, sock, max_sendq, metrics=None):
+        super().__init__(max_sendq, metrics)
+        self.sock = sock
+        self.ready = threading.Event()
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
+
+    def wake(self):
+        self.ready.set()
+
+    def abort(self):
+        # Plain socket shutdown, safe from any thread even on an SSL socket;
+        # unblocks both the writer's sendall and the reader's recv
+        try:
+            socket.socket.shutdown(self.sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def writer_loop(self):
+        try:
+            while True:
+                self.ready.wait()
+                self.ready.clear()
+                data = self.take()
+                if data:
+                    self.sock.sendall(data)
+                    if self.metrics:
+                        self.metrics.inc('bytes_out', len(data))
+                if self.closing and not self.pending:
+                    break
+        except OSError:
+            pass
+        finally:
+            # The reader thread sees EOF and closes the socket once it is done
+            self.abort()
+
+class AsyncConnection(Connection):
+    __slots__ = ('reader', 'writer', 'loop', 'loop_thread', 'ready', 'task')
+
+    def __init__(self, writer, loop, max_sendq, metrics=None, reader=None):
+        super().__init__(max_sendq, metrics)
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        self.task = loop.create_task(self.writer_loop())
+
+    def call(self, callback):
+        # Admin console runs in its own thread, everything else on the loop
+        if threading.get_ident() == self.loop_thread:
+            callback()
+        else:
+            self.loop.call_soon_threadsafe(callback)
+
+    def wake(self):
+        self.call(self.ready.set)
+
+    def abort(self):
+        self.call(self.writer.transport.abort)
+
+    async def writer_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                data = self.take()
+                if data:
+                    self.writer.write(data)
+                    if self.metrics:
+                        self.metrics.inc('bytes_out', len(data))
+                    await self.writer.drain()
+                if self.closing and not self.pending:
+                    break
+        except OSError:
+            pass
+        finally:
+            self.writer.close()
+
+class BusHub:
+    """Runs in the master process when the server is split into workers. Every
+    event a worker publishes is relayed to all the others, and since the hub
+    sees each nick claim in order it also settles nick collisions."""
+    MAX_LINE = 64 * 1024
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.links = set()
+        self.owners = {}
+        self.done = None
+
+    async def serve(self):
+        self.done = asyncio.Event()
+        server = await asyncio.start_unix_server(self.handle_worker, sock=self.sock)
+        async with server:
+            await self.done.wait()
+
+    async def handle_worker(self, reader, writer):
+        self.links.add(writer)
+        buffer = LineBuffer(self.MAX_LINE)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for line in buffer.feed(data):
+                    if line is None or not self.accept(writer, line):
+                        continue
+                    line += b'\n'
+                    for link in self.links:
+                        if link is not writer:
+                            link.write(line)
+        except OSError:
+            pass
+        finally:
+            self.links.discard(writer)
+            # The worker's users are gone with it, tell the others so they
+            # drop them from channels and free the nicks
+            gone = [nick for nick, owner in self.owners.items() if owner is writer]
+            for nick in gone:
+                del self.owners[nick]
+                line = b'QUIT ' + nick + b' :Worker exited\n'
+                for link in self.links:
+                    link.write(line)
+            if not self.links:
+                self.done.set()
+
+    def accept(self, writer, line):
+        """Tracks nick ownership, returns False for events that must not be relayed."""
+        event, _, args = line.partition(b' ')
+        if event == b'NICK':
+            old, new, _ = args.split(b' ', 2)
+            owner = self.owners.get(new)
+            if owner is not None and owner is not writer:
+                writer.write(b'COLLIDE ' + new + b' ' + old + b'\n')
+                return False
+            if self.owners.get(old) is writer:
+                del self.owners[old]
+            self.owners[new] = writer
+        elif event == b'QUIT':
+            self.owners.pop(args.partition(b' ')[0], None)
+        return True
+
+def run_workers(workers, options):
+    """Forks workers that all accept on the same port through SO_REUSEPORT and
+    share channel state over a Unix socket bus, then runs the bus hub."""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        sys.exit(f"{Colors.RED}--workers needs SO_REUSEPORT, which this platform doesn't have{Colors.RESET}")
+
+    options['admin_password'] = options.get('admin_password') or input("Set admin password [admin123]:") or "admin123"
+    bus_path = os.path.join(tempfile.mkdtemp(prefix='py-irc-'), 'bus.sock')
+    hub_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    hub_sock.bind(bus_path)
+    hub_sock.listen()
+
+    # Made before forking so every worker shares its session ticket key and
+    # a client can resume on whichever worker it lands on next
+    if options.get('ssl_cert') and options.get('ssl_key'):
+        options['ssl_context'] = IRCServer.make_ssl_context(options['ssl_cert'], options['ssl_key'])
+    options['cloak_key'] = os.urandom(16)
+    root, ext = os.path.splitext(options.get('log_file', "server.log"))
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            hub_sock.close()
+            log_file = f"{root}{ext}" if worker == 0 else f"{root}-w{worker}{ext}"
+            server = IRCServer(**dict(options, log_file=log_file), worker_id=worker, workers=workers,
+                               bus_path=bus_path, console=(worker == 0))
+            try:
+                server.start()
+            except KeyboardInterrupt:
+                server.stop()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    try:
+        asyncio.run(BusHub(hub_sock).serve())
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    finally:
+        for pid in pids:
+            os.waitpid(pid, 0)
+        os.unlink(bus_path)
+        os.rmdir(os.path.dirname(bus_path))
 
 class IRCServer:
-    def __init__(self, host='0.0.0.0', port=6667, ssl_cert=None, ssl_key=None):  # SSL PARAMS ADDED
+    BUS_SENDQ = 64 * 1024 * 1024
+    NICKLEN = 30  # Channel.NAMES_OVERHEAD leaves room for this much
+    CHATHISTORY_LIMIT = 100
+    HANDOFF_BATCH = 200  # client sockets per message, SCM_RIGHTS takes at most 253
+    ACCEPT_POLL = 0.5  # seconds accept() waits before checking for /upgrade
+    LIST_BATCH = 100  # 322 lines per write of a LIST reply
+    LIST_WAIT = 0.01  # seconds to let the writer drain a client's queue mid-LIST
+    ISUPPORT = f"CHANTYPES=# CHANMODES=,,,{''.join(Channel.MODES)} ELIST=MNU NICKLEN={NICKLEN}"
+
+    def __init__(self, host='0.0.0.0', port=6667, ssl_cert=None, ssl_key=None, mode='threaded', max_sendq=512 * 1024,
+                 admin_password=None, log_file="server.log", log_level='info', log_max_bytes=10 * 1024 * 1024,
+                 log_backups=5, log_recv_sample=1, tls_handshake_timeout=10.0,
+                 worker_id=None, workers=1, bus_path=None, console=True, metrics_port=None,
+                 metrics_host='127.0.0.1', ping_interval=120.0, ping_timeout=60.0, registration_timeout=60.0,
+                 idle_timeout=0, flood_rate=5.0, flood_burst=20.0, flood_config=None,
+                 history_lines=100, history_bytes=32 * 1024, history_replay=20, history_dir=None,
+                 snapshot_file=None, snapshot_interval=60.0, upgrade_fd=None, ssl_context=None,
+                 cloak_key=None):  # SSL PARAMS ADDED
         self.host = host
         self.port = port
+        self.mode = mode
+        self.max_sendq = max_sendq
         self.ssl_cert = ssl_cert
         self.ssl_key = ssl_key
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if bus_path:
+            # Every worker listens on the same port, the kernel spreads connections
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.worker_id = worker_id
+        self.workers = workers
+        self.bus_path = bus_path
+        self.bus = None
+        self.console = console
+        # Each worker serves its own numbers, on metrics_port + worker id
+        self.metrics_port = metrics_port + (worker_id or 0) if metrics_port else None
+        self.metrics_host = metrics_host
+        self.metrics_server = None
+        # Liveness, all driven by one timer wheel. 0 turns a check off.
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.registration_timeout = registration_timeout
+        self.idle_timeout = idle_timeout
+        self.timers = TimerWheel()
+        self.flood = FloodControl(flood_rate, flood_burst)
+        if flood_config:
+            self.flood.load(flood_config)
+        # Channel scrollback, at most history_bytes per channel. 0 lines turns it off.
+        self.history_lines = history_lines
+        self.history_bytes = history_bytes
+        self.history_replay = history_replay
+        self.history_dir = history_dir
+        if history_dir:
+            os.makedirs(history_dir, exist_ok=True)
+        # Channels and bans survive restarts through the snapshot file
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_saved = None
+        # Set when started by /upgrade: the Unix socket to the process handing over
+        self.upgrade_channel = None
+        self.restored = []
+        self.handing_off = False
+        self.accept_paused = threading.Event()
+        self.listener = None
+        if upgrade_fd is not None:
+            self.upgrade_channel = socket.socket(fileno=upgrade_fd)
+            handover = json.loads(self.recv_message(self.upgrade_channel)[0])
+            admin_password = handover['admin_password']
+            if 'cloak_key' in handover:
+                cloak_key = bytes.fromhex(handover['cloak_key'])
+        # Keys the WHOIS host cloaks, shared by the workers and kept by /upgrade
+        self.cloak_key = cloak_key or os.urandom(16)
         
         # SSL CONTEXT ADDED
-        if self.ssl_cert and self.ssl_key:
-            self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            self.context.load_cert_chain(certfile=self.ssl_cert, keyfile=self.ssl_key)
+        self.context = ssl_context
+        self.tls_handshake_timeout = tls_handshake_timeout
+        if self.context is None and self.ssl_cert and self.ssl_key:
+            self.context = self.make_ssl_context(self.ssl_cert, self.ssl_key)
             
-        self.channels = {}
         self.default_channels = ['#main', '#general', '#help']
-        for channel in self.default_channels:
-            self.channels[channel] = Channel(channel)
+        self.registry = Registry(self.default_channels)
             
-        self.clients = {}
-        self.nicknames = {}
-        self.banned_ips = set()
+        self.bans = PrefixTrie()
         self.running = True
-        self.log_file = "server.log"
-        self.admin_password = input("Set admin password [admin123]:") or "admin123"
+        self.loop = None
+        self.stop_event = None
+        self.client_tasks = set()
+        self.log_file = log_file
+        self.logger = LogWriter(log_file, level=log_level, max_bytes=log_max_bytes, backups=log_backups)
+        self.log_recv_sample = log_recv_sample
+        self.recv_count = 0
+        self.commands = {
+            'NICK': self.cmd_nick,
+            'USER': self.cmd_user,
+            'JOIN': self.cmd_join,
+            'PRIVMSG': self.cmd_privmsg,
+            'PART': self.cmd_part,
+            'PING': self.cmd_ping,
+            'QUIT': self.cmd_quit,
+            'NAMES': self.cmd_names,
+            'PONG': self.cmd_pong,
+            'CHATHISTORY': self.cmd_chathistory,
+            'LIST': self.cmd_list,
+            'WHOIS': self.cmd_whois,
+            'MODE': self.cmd_mode,
+        }
+        self.metrics = Metrics(self.commands)
+        self.bus_events = {
+            b'NICK': self.bus_nick,
+            b'COLLIDE': self.bus_collide,
+            b'JOIN': self.bus_join,
+            b'PART': self.bus_part,
+            b'QUIT': self.bus_quit,
+            b'CMSG': self.bus_channel_message,
+            b'UMSG': self.bus_user_message,
+            b'KILL': self.bus_kill,
+            b'BAN': self.bus_ban,
+            b'UNBAN': self.bus_unban,
+            b'CHANNEL': self.bus_channel,
+            b'MODE': self.bus_mode,
+            b'BROADCAST': self.bus_broadcast,
+            b'SHUTDOWN': self.bus_shutdown,
+        }
+        self.admin_password = admin_password or input("Set admin password [admin123]:") or "admin123"
         
-        with open(self.log_file, 'a') as f:
-            f.write(f"\n\n=== Server started at {datetime.datetime.now()} ===\n")
+        self.logger.write_raw(f"\n\n=== Server started at {datetime.datetime.now()} ===\n")
 
-    def log(self, message, show=True):
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        
-        with open(self.log_file, 'a') as f:
-            f.write(log_entry + "\n")
-            
-        if show:
-            print(f"{Colors.GRAY}{log_entry}{Colors.RESET}")
+    def log(self, message, show=True, level='info'):
+        self.logger.write(message, show, level)
+
+    @staticmethod
+    def make_ssl_context(cert, key):
+        """The server's TLS context. It issues session tickets under a key
+        OpenSSL makes at random when the context is created, so a ticket can
+        only be resumed by a process holding this context: the workers forked
+        after it is made, but not a restarted or /upgrade'd server. The ssl
+        module has no way to set or save that key."""
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile=cert, keyfile=key)
+        return context
 
     def start(self):
-        # SSL WRAP ADDED
-        if self.ssl_cert and self.ssl_key:
-            self.server = self.context.wrap_socket(self.server, server_side=True)
-        
-        self.server.bind((self.host, self.port))
-        self.server.listen()
+        if self.upgrade_channel:
+            self.take_over()
+        else:
+            self.server.bind((self.host, self.port))
+            self.server.listen()
+            self.load_snapshot()
+        if self.snapshot_file and self.snapshot_interval and not self.worker_id:
+            self.timers.schedule(self.snapshot_interval, self.snapshot_timer)
+        if self.metrics_port:
+            self.start_metrics_server()
+        if self.mode == 'threaded':
+            threading.Thread(target=self.timer_loop, daemon=True).start()
+        if self.bus_path and self.mode == 'threaded':
+            self.connect_bus()
+        if not self.console:
+            self.log(f"Worker {self.worker_id} started on {self.host}:{self.port} ({self.mode} mode)", show=False)
+            if self.mode == 'asyncio':
+                asyncio.run(self.serve_async())
+            else:
+                self.accept_connections()
+            return
+
         print("="*70)
         print(f"{Colors.BLUE} py-IRC Server {Colors.RESET}".center(70, '#'))
         print("="*70)
         ssl_status = f"{Colors.GREEN}Enabled{Colors.RESET}" if self.ssl_cert else f"{Colors.RED}Disabled{Colors.RESET}"
         print(f"{Colors.GREEN}●{Colors.RESET} Server started on {Colors.CYAN}{self.host}:{self.port}{Colors.RESET}")
         print(f"{Colors.GREEN}●{Colors.RESET} SSL/TLS: {ssl_status}")
+        print(f"{Colors.GREEN}●{Colors.RESET} Server mode: {Colors.CYAN}{self.mode}{Colors.RESET}")
+        if self.bus_path:
+            print(f"{Colors.GREEN}●{Colors.RESET} Worker processes: {Colors.CYAN}{self.workers}{Colors.RESET}")
         print(f"{Colors.GREEN}●{Colors.RESET} Default channels: {Colors.BLUE}{', '.join(self.default_channels)}{Colors.RESET}")
         print(f"{Colors.GREEN}●{Colors.RESET} Logging to: {Colors.YELLOW}{self.log_file}{Colors.RESET}")
+        limits = [f"{name} {f'{value:g}s' if value else 'off'}" for name, value in
+                  (("ping", self.ping_interval), ("registration", self.registration_timeout), ("idle", self.idle_timeout))]
+        print(f"{Colors.GREEN}●{Colors.RESET} Timeouts: {Colors.CYAN}{', '.join(limits)}{Colors.RESET}")
+        if self.metrics_port:
+            print(f"{Colors.GREEN}●{Colors.RESET} Metrics: {Colors.CYAN}http://{self.metrics_host}:{self.metrics_port}/metrics{Colors.RESET}")
         print(f"{Colors.GREEN}●{Colors.RESET} Admin password: {Colors.RED}{self.admin_password}{Colors.RESET}")
-        print(f"{Colors.GREEN}●{Colors.RESET} Available admin commands: /kick, /ban, /unban, /channels, /addchannel, /removechannel, /msg, /broadcast, /shutdown")
+        print(f"{Colors.GREEN}●{Colors.RESET} Available admin commands: /kick, /ban, /unban, /channels, /addchannel, /removechannel, /msg, /broadcast, /stats, /upgrade, /shutdown")
         print("="*70)
         
         admin_thread = threading.Thread(target=self.admin_console)
         admin_thread.daemon = True
         admin_thread.start()
         
-        self.log(f"Server started on {self.host}:{self.port}")
-        self.accept_connections()
+        self.log(f"Server started on {self.host}:{self.port} ({self.mode} mode)")
+        if self.mode == 'asyncio':
+            asyncio.run(self.serve_async())
+        else:
+            self.accept_connections()
 
     def accept_connections(self):
+        # accept() times out now and then so the loop sees /upgrade taking the
+        # listener over, after which only the new process accepts
+        self.server.settimeout(self.ACCEPT_POLL)
         while self.running:
+            if self.handing_off:
+                self.accept_paused.set()
+                time.sleep(self.ACCEPT_POLL)
+                continue
             try:
                 client, addr = self.server.accept()
                 ip = addr[0]
                 
-                if ip in self.banned_ips:
-                    client.send(f"ERROR :Your IP has been banned from this server\r\n".encode())
+                if ip in self.bans:
+                    self.metrics.inc('banned_rejects')
+                    # No handshake has happened yet, TLS clients just get closed
+                    if not self.context:
+                        client.send(f"ERROR :Your IP has been banned from this server\r\n".encode())
                     client.close()
                     self.log(f"Banned IP tried to connect: {ip}")
                     continue
                     
+                self.metrics.inc('connections')
                 self.log(f"New connection from {ip}")
                 threading.Thread(target=self.handle_client, args=(client, ip)).start()
+            except socket.timeout:
+                continue
             except OSError:
                 break
 
-    def handle_client(self, client, ip):
-        self.clients[client] = {'nick': None, 'channels': set(), 'ip': ip}
+    def start_metrics_server(self):
+        """Serves /metrics in Prometheus text format, on localhost by default."""
+        try:
+            self.metrics_server = http.server.ThreadingHTTPServer((self.metrics_host, self.metrics_port), MetricsHandler)
+        except OSError as e:
+            self.log(f"Metrics endpoint unavailable on {self.metrics_host}:{self.metrics_port}: {e}", level='warning')
+            return
+        self.metrics_server.daemon_threads = True
+        self.metrics_server.irc = self
+        threading.Thread(target=self.metrics_server.serve_forever, daemon=True).start()
+
+    def metric_gauges(self):
+        """Values read at scrape time instead of on every change: returns
+        ({name: (help, value)}, histogram of outbound queue depths)."""
+        sendq = Histogram(Metrics.SENDQ_BUCKETS)
+        for client, _ in self.registry.client_items():
+            sendq.observe(client.queued)
+        tasks = 0
+        if self.loop and not self.loop.is_closed():
+            tasks = len(asyncio.all_tasks(self.loop))
+        gauges = {
+            'clients': ("Connected local clients", len(self.registry.clients)),
+            'remote_users': ("Users connected to other workers", len(self.registry.remote_users)),
+            'channels': ("Existing channels", len(self.registry.channels)),
+            'bans': ("Banned IPs and ranges", len(self.bans.networks)),
+            'threads': ("Live threads", threading.active_count()),
+            'asyncio_tasks': ("Live asyncio tasks", tasks),
+            'log_dropped': ("Log lines dropped because the log queue was full", self.logger.dropped),
+        }
+        return gauges, sendq
+
+    def render_metrics(self):
+        gauges, sendq = self.metric_gauges()
+        return self.metrics.render(gauges, sendq)
+
+    def tls_handshake(self, sock, ip):
+        """Runs the TLS handshake on the client's own thread, so a stalled
+        handshake only holds up that client and never the accept loop."""
+        start = time.perf_counter()
+        try:
+            sock.settimeout(self.tls_handshake_timeout)
+            sock = self.context.wrap_socket(sock, server_side=True)
+            sock.settimeout(None)
+            self.metrics.inc('tls_handshakes')
+            self.metrics.handshake.observe(time.perf_counter() - start)
+            return sock
+        except (ssl.SSLError, OSError) as e:
+            self.metrics.inc('tls_handshake_failures')
+            self.log(f"TLS handshake failed for {ip}: {e}")
+            sock.close()
+            return None
+
+    def handle_client(self, sock, ip):
+        if self.context:
+            sock = self.tls_handshake(sock, ip)
+            if sock is None:
+                return
+
+        client = ThreadedConnection(sock, self.max_sendq, self.metrics)
+        session = self.registry.add_client(client, ip)
+        if self.handing_off:
+            # Accepted just before /upgrade, too late for its sweep
+            client.send(b":server NOTICE * :Server is restarting, please reconnect\r\n")
+            client.close()
+        self.flood.assign(session)
+        self.watch(client, session)
         
-        nick = None
         try:
+            # Blocks until data arrives, timeouts and shutdown come from other
+            # threads shutting the socket down
             while self.running:
-                rlist, _, _ = select.select([client], [], [], 1.0)
-                if not rlist:
-                    continue
-                    
-                data = client.recv(4096).decode('utf-8').strip()
+                data = sock.recv(4096)
                 if not data:
                     break
                     
-                self.log(f"RECV [{ip}]: {data}")
-
-                if data.startswith('NICK '):
-                    nick = self.handle_nick(client, data[5:], ip)
-                    if nick:
-                        client.send(f":server 001 {nick} :Welcome to the IRC server!\r\n".encode())
-                        client.send(f":server 422 {nick} :MOTD file is missing\r\n".encode())
-                elif data.startswith('USER '):
-                    pass
-                elif data.startswith('JOIN '):
-                    self.handle_join(client, data[5:], ip)
-                elif data.startswith('PRIVMSG '):
-                    self.handle_privmsg(client, data[8:], ip)
-                elif data.startswith('PING'):
-                    client.send(f"PONG {data[5:]}\r\n".encode())
-                elif data == 'QUIT':
+                delay = self.handle_data(client, session, data, ip)
+                # Over the flood limit: stop reading from this client until the
+                # bucket has paid for the held line, TCP pushes back on the sender
+                while delay and self.running:
+                    time.sleep(delay)
+                    delay = self.resume(client, session, ip)
+                if delay is None:
+                    break
+        except Exception as e:
+            if not client.overflowed:
+                self.log(f"Client error: {e}")
+        finally:
+            self.remove_client(client, None, ip, "SendQ exceeded" if client.overflowed else "Connection closed")
+            client.writer.join(5.0)
+            client.abort()
+            sock.close()
+
+    async def serve_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        if self.bus_path:
+            await self.connect_bus_async()
+        server = self.listener = await asyncio.start_server(
+            self.handle_client_async, sock=self.server, ssl=self.context,
+            ssl_handshake_timeout=self.tls_handshake_timeout if self.context else None)
+        for record, sock in self.restored:
+            reader, writer = await asyncio.open_connection(sock=sock)
+            asyncio.create_task(self.handle_client_async(reader, writer, record))
+        self.restored = []
+        timers = asyncio.create_task(self.timer_task())
+        async with server:
+            await self.stop_event.wait()
+        timers.cancel()
+
+        # stop() has asked every connection to close, let them finish flushing
+        if self.client_tasks:
+            await asyncio.wait(self.client_tasks, timeout=2.0)
+        if self.bus:
+            await asyncio.wait([self.bus.task], timeout=1.0)
+
+    async def handle_client_async(self, reader, writer, restored=None):
+        """Serves one connection. restored is a client handed over by /upgrade,
+        see take_over()."""
+        ip = writer.get_extra_info('peername')[0]
+        if restored is None and ip in self.bans:
+            self.metrics.inc('banned_rejects')
+            writer.write(f"ERROR :Your IP has been banned from this server\r\n".encode())
+            writer.close()
+            self.log(f"Banned IP tried to connect: {ip}")
+            return
+
+        # asyncio finishes the TLS handshake before handing over the connection
+        if restored is None:
+            self.metrics.inc('connections')
+            if self.context:
+                self.metrics.inc('tls_handshakes')
+            self.log(f"New connection from {ip}")
+        client = AsyncConnection(writer, self.loop, self.max_sendq, self.metrics, reader)
+        session = self.registry.add_client(client, ip)
+        self.flood.assign(session)
+        data = self.restore_session(client, session, restored) if restored else b''
+        self.watch(client, session)
+        task = asyncio.current_task()
+        self.client_tasks.add(task)
+        
+        try:
+            while self.running:
+                if not data:
+                    data = await reader.read(4096)
+                    if not data:
+                        break
+
+                delay = self.handle_data(client, session, data, ip)
+                while delay and self.running:
+                    await asyncio.sleep(delay)
+                    delay = self.resume(client, session, ip)
+                if delay is None:
                     break
-                elif data.startswith('PART'):
-                    channel = data.split()[1] if len(data.split()) > 1 else None
-                    if channel:
-                        self.handle_part(client, channel, ip)
+                data = None
+                # read() doesn't yield while data is buffered, give the writers
+                # a turn so a burst from one client doesn't overflow everyone
+                await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            # Stopped for /upgrade, see quiesce()
+            if not self.handing_off:
+                raise
         except Exception as e:
-            self.log(f"Client error: {e}")
+            if not client.overflowed:
+                self.log(f"Client error: {e}")
         finally:
-            self.remove_client(client, nick, ip)
+            # A client being handed over stays connected and registered
+            if not self.handing_off:
+                self.remove_client(client, None, ip, "SendQ exceeded" if client.overflowed else "Connection closed")
+            self.client_tasks.discard(task)
+
+    def handle_data(self, client, session, data, ip):
+        """Runs the complete lines in a read. Returns 0 when all of them ran,
+        None when the client quit, or the seconds to wait before resume() when
+        flood control is holding the rest back."""
+        self.metrics.inc('bytes_in', len(data))
+        # Any input proves the connection alive, only real commands end idleness
+        session.last_seen = now = time.monotonic()
+        lines = session.buffer.feed(data)
+        for line in lines:
+            if line is not None and line[:4].upper() not in (b'PING', b'PONG'):
+                session.last_active = now
+                break
+        session.backlog = lines
+        session.backlog_pos = 0
+        return self.resume(client, session, ip)
+
+    def resume(self, client, session, ip):
+        """Runs the session's backlog until it is empty or a line is over the
+        flood limit, with handle_data()'s return values. A LIST reply being
+        streamed finishes before the next line runs."""
+        lines = session.backlog
+        while session.listing or session.backlog_pos < len(lines):
+            if session.listing:
+                delay = self.send_listing(client, session)
+                if delay:
+                    return delay
+                continue
+            line = lines[session.backlog_pos]
+            if line is None:
+                session.backlog_pos += 1
+                client.send(f":server 417 {session.nick or '*'} :Input line was too long\r\n".encode())
+                continue
+            if not session.paid:
+                delay = self.flood.charge(session, line)
+                if delay:
+                    if session.strikes > session.flood.max_strikes:
+                        self.metrics.inc('flood_disconnects')
+                        client.send(b"ERROR :Closing link: Excess Flood\r\n")
+                        self.remove_client(client, None, ip, "Excess Flood")
+                        return None
+                    self.metrics.inc('flood_delays')
+                    session.paid = True
+                    return delay
+            session.paid = False
+            session.backlog_pos += 1
+            if not self.handle_line(client, line, ip):
+                return None
+        session.backlog = ()
+        return 0
+
+    def handle_line(self, client, line, ip):
+        """Dispatches one raw command line, returns False when the client quits.
+        Parameters stay bytes, handlers decode only what they need to read."""
+        # RECV logging is sampled, 1 in log_recv_sample lines (0 turns it off).
+        # Messages below the log level aren't even formatted.
+        if self.log_recv_sample and self.logger.enabled('info'):
+            self.recv_count += 1
+            if self.recv_count >= self.log_recv_sample:
+                self.recv_count = 0
+                self.log(f"RECV [{ip}]: {line.decode('utf-8', errors='replace')}")
+
+        if line.startswith(b':'):
+            line = line.partition(b' ')[2]
+        command, _, params = line.strip().partition(b' ')
+        name = command.upper().decode('ascii', errors='replace')
+        handler = self.commands.get(name)
+        if handler is None:
+            self.metrics.inc('unknown_commands')
+            return True
+        start = time.perf_counter()
+        result = handler(client, params, ip)
+        self.metrics.commands[name].observe(time.perf_counter() - start)
+        return result is not False
+
+    def cmd_nick(self, client, params, ip):
+        if not params:
+            client.send(":server 431 * :No nickname given\r\n".encode())
+            return
+        nick = params.split()[0].lstrip(b':').decode('utf-8', errors='replace')
+        # Measured after decoding, a replaced byte grows to three
+        if len(nick.encode()) > self.NICKLEN:
+            client.send(f":server 432 * {nick} :Erroneous nickname\r\n".encode())
+            return
+        nick = self.handle_nick(client, nick, ip)
+        if nick:
+            client.send(f":server 001 {nick} :Welcome to the IRC server!\r\n".encode())
+            client.send(f":server 005 {nick} {self.ISUPPORT} :are supported by this server\r\n".encode())
+            client.send(f":server 422 {nick} :MOTD file is missing\r\n".encode())
+
+    def cmd_user(self, client, params, ip):
+        pass
+
+    def cmd_join(self, client, params, ip):
+        if params:
+            self.handle_join(client, params.split()[0].decode('utf-8', errors='replace'), ip)
+
+    def cmd_privmsg(self, client, params, ip):
+        if params:
+            self.handle_privmsg(client, params, ip)
+
+    def cmd_part(self, client, params, ip):
+        if params:
+            self.handle_part(client, params.split()[0].decode('utf-8', errors='replace'), ip)
+
+    def cmd_names(self, client, params, ip):
+        session = self.registry.clients.get(client)
+        if session is None:
+            return
+        nick = session.nick or '*'
+        if not params:
+            client.send(f":server 366 {nick} * :End of /NAMES list\r\n".encode())
+            return
+        for channel_name in params.split()[0].decode('utf-8', errors='replace').split(','):
+            channel = self.registry.channels.get(channel_name)
+            if channel and channel.visible_to(client):
+                self.send_names(client, nick, channel)
+            else:
+                client.send(f":server 366 {nick} {channel_name} :End of /NAMES list\r\n".encode())
+
+    def cmd_ping(self, client, params, ip):
+        client.send(b'PONG ' + params + b'\r\n')
+
+    def cmd_pong(self, client, params, ip):
+        # handle_data already counted the line as a sign of life
+        pass
+
+    def cmd_chathistory(self, client, params, ip):
+        """CHATHISTORY LATEST <channel> <* or timestamp=...> <limit>, or
+        BEFORE/AFTER <channel> timestamp=<ISO 8601 UTC> <limit>, for a
+        channel the client is in."""
+        session = self.registry.clients.get(client)
+        if session is None:
+            return
+        parts = params.decode('utf-8', errors='replace').split()
+        if len(parts) < 4 or parts[0].upper() not in ('LATEST', 'BEFORE', 'AFTER'):
+            client.send(b":server FAIL CHATHISTORY INVALID_PARAMS :Use LATEST <channel> * <limit> "
+                        b"or BEFORE|AFTER <channel> timestamp=<time> <limit>\r\n")
+            return
+        subcommand, target, reference, limit = parts[0].upper(), parts[1], parts[2], parts[3]
+        channel = self.registry.channels.get(target)
+        history = self.history_of(channel) if channel and client in channel.members else None
+        if history is None:
+            client.send(f":server FAIL CHATHISTORY INVALID_TARGET {subcommand} {target} :No history for that channel\r\n".encode())
+            return
+        try:
+            limit = min(int(limit), self.CHATHISTORY_LIMIT)
+            stamp = None if reference == '*' and subcommand == 'LATEST' else self.parse_timestamp(reference)
+        except ValueError:
+            client.send(f":server FAIL CHATHISTORY INVALID_PARAMS {subcommand} :Bad limit or timestamp\r\n".encode())
+            return
+        if subcommand == 'BEFORE':
+            entries = history.before(stamp, limit)
+        elif subcommand == 'AFTER':
+            entries = history.after(stamp, limit)
+        else:
+            entries = history.latest(limit)
+            if stamp is not None:
+                entries = [entry for entry in entries if entry[0] > stamp]
+        self.send_history(client, session.nick or '*', channel.name, entries, always=True)
+
+    def cmd_list(self, client, params, ip):
+        """LIST [filter,...] with ELIST filters: channel names, masks using * and
+        ? (!mask leaves matches out) and member counts (>n, <n). Channels
+        named outright are looked up, not scanned for. The 322 lines are
+        made as send_listing writes them, never all at once."""
+        session = self.registry.clients.get(client)
+        if session is None:
+            return
+        names, include, exclude = [], [], []
+        above, below = -1, None
+        text = params.split()[0].decode('utf-8', errors='replace') if params else ''
+        for item in text.split(','):
+            if item[:1] in ('>', '<') and item[1:].isdigit():
+                if item[0] == '>':
+                    above = max(above, int(item[1:]))
+                else:
+                    below = int(item[1:]) if below is None else min(below, int(item[1:]))
+            elif item.startswith('!'):
+                exclude.append(item[1:])
+            elif '*' in item or '?' in item:
+                include.append(item)
+            elif item:
+                names.append(item)
+        if names:
+            channels = [self.registry.channels.get(name) for name in names]
+        else:
+            channels = list(self.registry.channels.values())
+        nick = session.nick or '*'
+        client.send(f":server 321 {nick} Channel :Users  Name\r\n".encode())
+        session.listing = self.list_replies(client, nick, channels, above, below,
+                                            self.mask_pattern(include), self.mask_pattern(exclude))
+
+    def list_replies(self, client, nick, channels, above, below, include, exclude):
+        """Yields the 322 line of every channel that passes the filters and
+        the client may see, then 323."""
+        head = f":server 322 {nick} ".encode()
+        for channel in channels:
+            if channel is None or not channel.visible_to(client):
+                continue
+            size = channel.size()
+            if size <= above or (below is not None and size >= below):
+                continue
+            if (include and not include.fullmatch(channel.name)) or (exclude and exclude.fullmatch(channel.name)):
+                continue
+            yield head + f"{channel.name} {size} :[{channel.mode_string()}]\r\n".encode()
+        yield f":server 323 {nick} :End of /LIST\r\n".encode()
+
+    @staticmethod
+    def mask_pattern(masks):
+        """One case-insensitive regex for a list of IRC masks, None for none."""
+        if not masks:
+            return None
+        return re.compile('|'.join(re.escape(mask).replace(r'\*', '.*').replace(r'\?', '.') for mask in masks),
+                          re.IGNORECASE)
+
+    def send_listing(self, client, session):
+        """Writes a LIST reply LIST_BATCH lines at a time while the client's
+        send queue is under a quarter full, so a long list never overflows it.
+        Returns 0 once the reply is done, otherwise LIST_WAIT for the writer
+        to catch up."""
+        while client.queued < client.max_sendq // 4:
+            batch = list(itertools.islice(session.listing, self.LIST_BATCH))
+            if batch:
+                client.send(b''.join(batch))
+            if len(batch) < self.LIST_BATCH or client.closing:
+                session.listing = None
+                return 0
+        return self.LIST_WAIT
+
+    def cmd_whois(self, client, params, ip):
+        """WHOIS [server] nick[,nick...], a nick table lookup per nick."""
+        session = self.registry.clients.get(client)
+        if session is None:
+            return
+        nick = session.nick or '*'
+        parts = params.split()
+        if not parts:
+            client.send(f":server 431 {nick} :No nickname given\r\n".encode())
+            return
+        lines = []
+        for target in parts[-1].decode('utf-8', errors='replace').split(','):
+            lines += self.whois_lines(client, nick, target)
+        client.send(''.join(lines).encode())
+
+    def whois_lines(self, client, nick, target):
+        registry = self.registry
+        user = registry.nicknames.get(target)
+        user = registry.clients.get(user) if user is not None else registry.remote_users.get(target)
+        if user is None:
+            return [f":server 401 {nick} {target} :No such nick/channel\r\n",
+                    f":server 318 {nick} {target} :End of /WHOIS list\r\n"]
+        name = user.nick or target
+        # Only the user themselves sees their address, everyone else a cloak
+        host = user.ip if user is registry.clients.get(client) else self.cloak(user.ip)
+        lines = [f":server 311 {nick} {name} {name} {host} * :{name}\r\n",
+                 f":server 312 {nick} {name} server :py-IRC server\r\n"]
+        # Channels the asker may see, as many per 319 line as fit
+        visible, length = [], 0
+        for channel_name in sorted(user.channels):
+            channel = registry.channels.get(channel_name)
+            if channel is None or not channel.visible_to(client):
+                continue
+            if length + len(channel_name) > 400:
+                lines.append(f":server 319 {nick} {name} :{' '.join(visible)}\r\n")
+                visible, length = [], 0
+            visible.append(channel_name)
+            length += len(channel_name) + 1
+        if visible:
+            lines.append(f":server 319 {nick} {name} :{' '.join(visible)}\r\n")
+        if isinstance(user, Session):
+            now = time.monotonic()
+            signon = int(time.time() - (now - user.connected))
+            lines.append(f":server 317 {nick} {name} {int(now - user.last_active)} {signon} :seconds idle, signon time\r\n")
+        lines.append(f":server 318 {nick} {name} :End of /WHOIS list\r\n")
+        return lines
+
+    def cloak(self, ip):
+        """A stand-in host for ip, the same on every worker of this run but
+        not reversible without cloak_key."""
+        digest = hmac.new(self.cloak_key, ip.encode(), 'sha256').hexdigest()
+        return f"{digest[:8]}.{digest[8:16]}.cloak"
+
+    def cmd_mode(self, client, params, ip):
+        """MODE <channel> shows its modes, MODE <channel> +flags-flags changes
+        them for the user who created the channel (there are no other channel
+        operators). MODE <own nick> shows the user modes, of which there are none."""
+        session = self.registry.clients.get(client)
+        if session is None:
+            return
+        nick = session.nick or '*'
+        parts = params.decode('utf-8', errors='replace').split()
+        if not parts:
+            client.send(f":server 461 {nick} MODE :Not enough parameters\r\n".encode())
+            return
+        target = parts[0]
+        if not target.startswith('#'):
+            if target != session.nick:
+                client.send(f":server 502 {nick} :Can't change mode for other users\r\n".encode())
+            elif len(parts) > 1:
+                client.send(f":server 501 {nick} :Unknown MODE flag\r\n".encode())
+            else:
+                client.send(f":server 221 {nick} +\r\n".encode())
+            return
+        channel = self.registry.channels.get(target)
+        if channel is None:
+            client.send(f":server 403 {nick} {target} :No such channel\r\n".encode())
+            return
+        if len(parts) == 1:
+            client.send(f":server 324 {nick} {channel.name} {channel.mode_string()}\r\n"
+                        f":server 329 {nick} {channel.name} {int(channel.created.timestamp())}\r\n".encode())
+            return
+        if client not in channel.members:
+            client.send(f":server 442 {nick} {channel.name} :You're not on that channel\r\n".encode())
+            return
+        if client is not channel.founder:
+            client.send(f":server 482 {nick} {channel.name} :You're not channel operator\r\n".encode())
+            return
+        with channel.lock:
+            old = modes = channel.modes
+            adding = True
+            for letter in parts[1]:
+                if letter in '+-':
+                    adding = letter == '+'
+                elif letter in Channel.MODES:
+                    bit = Channel.MODES[letter]
+                    modes = modes | bit if adding else modes & ~bit
+                else:
+                    client.send(f":server 472 {nick} {letter} :is unknown mode char to me for {channel.name}\r\n".encode())
+            channel.modes = modes
+        changed = old ^ modes
+        if not changed:
+            return
+        text = ''.join(sign + ''.join(letter for letter, bit in Channel.MODES.items() if bits & bit)
+                       for sign, bits in (('+', modes & changed), ('-', old & changed)) if bits)
+        line = f":{session.nick or ip} MODE {channel.name} {text}\r\n".encode()
+        for member in channel.snapshot():
+            member.send(line)
+        self.publish(f"MODE {channel.name} {modes} ".encode() + line[:-2])
+        self.log(f"{nick} set {channel.name} {text}")
+
+    def cmd_quit(self, client, params, ip):
+        return False
 
     def handle_nick(self, client, nick, ip):
-        if nick in self.nicknames:
+        ok, old_nick = self.registry.set_nick(client, nick)
+        if not ok:
             client.send(f":server 433 * {nick} :Nickname is already in use\r\n".encode())
             return None
         
-        if client in self.clients:
-            old_nick = self.clients[client].get('nick')
-            if old_nick and old_nick in self.nicknames:
-                del self.nicknames[old_nick]
-        
-        self.clients[client]['nick'] = nick
-        self.nicknames[nick] = client
+        self.publish(f"NICK {old_nick or '*'} {nick} {ip}".encode())
+        session = self.registry.clients.get(client)
+        if session:
+            self.rename_member(client, session.channels, session.prefix)
+            # Channels joined before the first NICK were never published
+            if not old_nick:
+                for channel_name in list(session.channels):
+                    self.publish(f"JOIN {nick} {channel_name}".encode())
         self.log(f"Nick registered: {nick} ({ip})")
         return nick
 
+    def rename_member(self, member, channel_names, prefix):
+        for channel_name in list(channel_names):
+            channel = self.registry.channels.get(channel_name)
+            if channel:
+                channel.rename(member, prefix)
+
+    def send_names(self, client, nick, channel):
+        """Sends the cached NAMES reply, one 353 line per chunk, then 366.
+        Chunks leave room for a NICKLEN requester, a longer one (an IPv6
+        address before NICK) gets them split to fit."""
+        head = b''.join((b':server 353 ', nick.encode(), b' = ', channel.name.encode(), b' :'))
+        room = 510 - len(head)
+        lines = []
+        for payload in channel.names():
+            if len(payload) <= room:
+                lines.append(b''.join((head, payload, b'\r\n')))
+                continue
+            names, length = [], 0
+            for name in payload.split(b' '):
+                if names and length + len(name) > room:
+                    lines.append(b''.join((head, b' '.join(names), b'\r\n')))
+                    names, length = [], 0
+                names.append(name)
+                length += len(name) + 1
+            lines.append(b''.join((head, b' '.join(names), b'\r\n')))
+        lines.append(f":server 366 {nick} {channel.name} :End of /NAMES list\r\n".encode())
+        client.send(b''.join(lines))
+
     def handle_join(self, client, channel_name, ip):
         if not channel_name.startswith('#'):
             channel_name = '#' + channel_name
 
-        if client not in self.clients:
+        session = self.registry.clients.get(client)
+        if session is None:
             return
 
-        nick = self.clients[client]['nick'] or ip
+        nick = session.nick or ip
         
-        if channel_name not in self.channels:
-            self.channels[channel_name] = Channel(channel_name)
+        channel, created = self.registry.get_channel(channel_name, create=True)
+        if created:
+            channel.founder = client
             self.log(f"New channel created: {channel_name} by {nick}")
         
-        channel = self.channels[channel_name]
-        channel.members.add(client)
-        self.clients[client]['channels'].add(channel_name)
+        if self.registry.join(client, channel, session.prefix or f":{ip}".encode()) is None:
+            return
         
-        for member in channel.members:
-            member.send(f":{nick} JOIN {channel_name}\r\n".encode())
+        line = f":{nick} JOIN {channel_name}\r\n".encode()
+        members = channel.snapshot()
+        for member in members:
+            member.send(line)
+        if session.nick:
+            self.publish(f"JOIN {nick} {channel_name}".encode())
         
-        names = ' '.join([self.clients[m]['nick'] or self.clients[m]['ip'] for m in channel.members])
-        client.send(f":server 353 {nick} = {channel_name} :{names}\r\n".encode())
-        client.send(f":server 366 {nick} {channel_name} :End of /NAMES list\r\n".encode())
+        self.send_names(client, nick, channel)
+        history = self.history_of(channel)
+        if history and self.history_replay:
+            self.send_history(client, nick, channel.name, history.latest(self.history_replay))
         
         self.log(f"{nick} joined {channel_name}")
 
     def handle_privmsg(self, client, data, ip):
-        if client not in self.clients:
+        session = self.registry.clients.get(client)
+        if session is None:
             return
 
-        nick = self.clients[client]['nick'] or ip
-        target, _, message = data.partition(' :')
+        # The relayed line is built once from the received bytes and the same
+        # buffer is queued for every recipient
+        prefix = session.prefix or f":{ip}".encode()
+        raw_target, _, message = data.partition(b' ')
+        if not message.startswith(b':'):
+            message = b':' + message
+        line = b''.join((prefix, b' PRIVMSG ', raw_target, b' ', message, b'\r\n'))
+        target = raw_target.decode('utf-8', 'replace')
         
         if target.startswith('#'):
-            if target in self.channels and client in self.channels[target].members:
-                for member in self.channels[target].members:
-                    member.send(f":{nick} PRIVMSG {target} :{message}\r\n".encode())
-                self.log(f"{nick} => {target}: {message}")
+            channel = self.registry.channels.get(target)
+            if channel and (client in channel.members or not channel.modes & Channel.NO_EXTERNAL):
+                members = channel.members_snapshot or channel.snapshot()
+                for member in members:
+                    member.send(line)
+                fanout, size = self.metrics.fanout_sizes, len(members)
+                fanout[size] = fanout.get(size, 0) + 1
+                if self.history_lines:
+                    self.record_history(channel, line)
+                # With history on every worker keeps the channel's scrollback,
+                # including those with no member in it yet
+                if self.bus and (channel.remote or self.history_lines):
+                    self.publish(b'CMSG ' + raw_target + b' ' + line[:-2])
+            else:
+                if channel:
+                    client.send(f":server 404 {session.nick or '*'} {channel.name} :Cannot send to channel\r\n".encode())
+                return
         else:
-            if target in self.nicknames:
-                target_client = self.nicknames[target]
-                target_client.send(f":{nick} PRIVMSG {target} :{message}\r\n".encode())
+            target_client = self.registry.nicknames.get(target)
+            if target_client:
+                target_client.send(line)
                 if client != target_client:
-                    client.send(f":{nick} PRIVMSG {target} :{message}\r\n".encode())
-                self.log(f"{nick} => {target}: {message}")
+                    client.send(line)
+            elif target in self.registry.remote_users:
+                self.publish(b'UMSG ' + raw_target + b' ' + line[:-2])
+                client.send(line)
+            else:
+                return
+        # Only formatted when it will be written, the relay itself never decodes the text
+        if self.logger.enabled('info'):
+            self.log(f"{prefix[1:].decode()} => {target}: {message[1:].decode('utf-8', errors='replace')}")
+
+    def history_of(self, channel):
+        """The channel's Scrollback, made on first use. None when it is off."""
+        if not self.history_lines:
+            return None
+        if channel.history is None:
+            spill = None
+            if self.history_dir:
+                suffix = f".{self.worker_id}" if self.worker_id is not None else ""
+                spill = os.path.join(self.history_dir, urllib.parse.quote(channel.name, safe='') + suffix + ".history")
+            with channel.lock:
+                if channel.history is None:
+                    channel.history = Scrollback(channel.lock, self.history_lines, self.history_bytes, spill)
+        return channel.history
+
+    def record_history(self, channel, line):
+        history = self.history_of(channel)
+        if history:
+            history.append(time.time(), line)
+
+    def send_history(self, client, nick, channel_name, entries, always=False):
+        """Replays the stored lines in one write, between two NOTICEs that
+        carry their timestamps, which CHATHISTORY takes to page further."""
+        if not entries:
+            if always:
+                client.send(f":server NOTICE {nick} :*** No history for {channel_name}\r\n".encode())
+            return
+        head = (f":server NOTICE {nick} :*** {len(entries)} messages of {channel_name} history, "
+                f"timestamp={self.format_timestamp(entries[0][0])} to timestamp={self.format_timestamp(entries[-1][0])}\r\n")
+        tail = f":server NOTICE {nick} :*** End of {channel_name} history\r\n"
+        client.send(b''.join([head.encode()] + [line for _, line in entries] + [tail.encode()]))
+
+    @staticmethod
+    def format_timestamp(stamp):
+        return datetime.datetime.fromtimestamp(stamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    @staticmethod
+    def parse_timestamp(reference):
+        """'timestamp=2026-01-02T03:04:05.678Z' to time.time() seconds, raises ValueError."""
+        if not reference.startswith('timestamp='):
+            raise ValueError(reference)
+        when = datetime.datetime.fromisoformat(reference[10:].replace('Z', '+00:00'))
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=datetime.timezone.utc)
+        return when.timestamp()
 
     def handle_part(self, client, channel_name, ip):
-        if client not in self.clients:
+        session = self.registry.clients.get(client)
+        if session is None:
             return
             
-        nick = self.clients[client]['nick'] or ip
-        if channel_name in self.channels and client in self.channels[channel_name].members:
-            self.channels[channel_name].members.remove(client)
-            self.clients[client]['channels'].remove(channel_name)
+        nick = session.nick or ip
+        channel = self.registry.channels.get(channel_name)
+        if channel and self.registry.part(client, channel):
             
-            for member in self.channels[channel_name].members:
-                member.send(f":{nick} PART {channel_name}\r\n".encode())
-            client.send(f":{nick} PART {channel_name}\r\n".encode())
+            line = f":{nick} PART {channel_name}\r\n".encode()
+            for member in channel.snapshot():
+                member.send(line)
+            client.send(line)
+            if session.nick:
+                self.publish(f"PART {nick} {channel_name}".encode())
             
             self.log(f"{nick} left {channel_name}")
 
-    def remove_client(self, client, nick, ip):
-        if client in self.clients:
-            if not nick:
-                nick = self.clients[client].get('nick', ip)
-                
-            for channel in list(self.clients[client]['channels']):
-                if channel in self.channels and client in self.channels[channel].members:
-                    self.channels[channel].members.remove(client)
-                    for member in self.channels[channel].members:
-                        if member != client:
-                            member.send(f":{nick} QUIT :Connection closed\r\n".encode())
-                            
-            if 'nick' in self.clients[client] and self.clients[client]['nick'] in self.nicknames:
-                del self.nicknames[self.clients[client]['nick']]
-                
-            del self.clients[client]
-            client.close()
-            self.log(f"Client disconnected: {nick} ({ip})")
+    def remove_client(self, client, nick, ip, reason="Connection closed"):
+        # Only the first caller gets the session back, so a kick racing the
+        # client's own disconnect cleans up once
+        session = self.registry.remove_client(client)
+        if session is None:
+            return
+        self.metrics.inc('disconnects')
+        if session.timer:
+            self.timers.cancel(session.timer)
+
+        if not nick:
+            nick = session.nick or ip
+            
+        line = f":{nick} QUIT :{reason}\r\n".encode()
+        for channel_name in list(session.channels):
+            channel = self.registry.channels.get(channel_name)
+            if channel and channel.discard(client):
+                for member in channel.snapshot():
+                    member.send(line)
+                        
+        if session.nick:
+            self.publish(f"QUIT {session.nick} :{reason}".encode())
+            
+        client.close()
+        self.log(f"Client disconnected: {nick} ({ip}) - {reason}")
+
+    def timer_loop(self):
+        """Drives the timer wheel in threaded mode, the server's only periodic wakeup."""
+        while self.running:
+            time.sleep(self.timers.tick)
+            self.run_timers()
+
+    async def timer_task(self):
+        while self.running:
+            await asyncio.sleep(self.timers.tick)
+            self.run_timers()
+
+    def run_timers(self):
+        for timer in self.timers.advance():
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self.log(f"Timer error: {e}")
+
+    def watch(self, client, session):
+        """Arms the liveness timer of a new client. Each client has at most one
+        timer pending; traffic only updates timestamps, never the wheel."""
+        delay = self.next_check(session, session.connected)
+        if delay is not None:
+            session.timer = self.timers.schedule(delay, self.check_client, client)
+
+    def next_check(self, session, now):
+        """Seconds until the earliest liveness deadline of session, or None."""
+        deadlines = []
+        if session.nick is None and self.registration_timeout:
+            deadlines.append(session.connected + self.registration_timeout)
+        if self.idle_timeout:
+            deadlines.append(session.last_active + self.idle_timeout)
+        if session.ping_sent:
+            deadlines.append(session.ping_sent + self.ping_timeout)
+        elif self.ping_interval:
+            deadlines.append(session.last_seen + self.ping_interval)
+        return max(min(deadlines) - now, 0) if deadlines else None
+
+    def check_client(self, client):
+        session = self.registry.clients.get(client)
+        if session is None:
+            return
+        now = time.monotonic()
+        if session.nick is None and self.registration_timeout and now - session.connected >= self.registration_timeout:
+            return self.expire_client(client, session, "Registration timed out")
+        if self.idle_timeout and now - session.last_active >= self.idle_timeout:
+            return self.expire_client(client, session, "Idle timeout")
+        if session.ping_sent:
+            if session.last_seen >= session.ping_sent:
+                session.ping_sent = 0
+            elif now - session.ping_sent >= self.ping_timeout:
+                # The peer may be gone for good, don't wait to flush to it
+                return self.expire_client(client, session, "Ping timeout", abort=True)
+        if not session.ping_sent and self.ping_interval and now - session.last_seen >= self.ping_interval:
+            session.ping_sent = now
+            client.send(b"PING :server\r\n")
+        session.timer = None
+        delay = self.next_check(session, now)
+        if delay is not None:
+            session.timer = self.timers.schedule(delay, self.check_client, client)
+
+    def expire_client(self, client, session, reason, abort=False):
+        self.metrics.inc('timeouts')
+        client.send(f"ERROR :Closing link: {reason}\r\n".encode())
+        self.remove_client(client, None, session.ip, reason)
+        if abort:
+            client.abort()
+
+    def connect_bus(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.bus_path)
+        self.bus = ThreadedConnection(sock, self.BUS_SENDQ)
+        threading.Thread(target=self.bus_loop, args=(sock,), daemon=True).start()
+
+    def bus_loop(self, sock):
+        buffer = LineBuffer(BusHub.MAX_LINE)
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                for line in buffer.feed(data):
+                    if line:
+                        self.handle_bus_line(line)
+        except OSError:
+            pass
+        if self.running:
+            self.log("Lost connection to the state bus, stopping")
+            self.stop()
+
+    async def connect_bus_async(self):
+        reader, writer = await asyncio.open_unix_connection(self.bus_path)
+        self.bus = AsyncConnection(writer, self.loop, self.BUS_SENDQ)
+        self.bus_task = self.loop.create_task(self.bus_loop_async(reader))
+
+    async def bus_loop_async(self, reader):
+        buffer = LineBuffer(BusHub.MAX_LINE)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for line in buffer.feed(data):
+                    if line:
+                        self.handle_bus_line(line)
+        except OSError:
+            pass
+        if self.running:
+            self.log("Lost connection to the state bus, stopping")
+            self.stop()
+
+    def publish(self, event):
+        """Sends a state change to the other workers, a no-op without a bus."""
+        if self.bus:
+            self.bus.send(event + b'\n')
+
+    def handle_bus_line(self, line):
+        event, _, args = line.partition(b' ')
+        handler = self.bus_events.get(event)
+        if handler is None:
+            return
+        try:
+            handler(args)
+        except Exception as e:
+            self.log(f"Bus error on {event.decode(errors='replace')}: {e}")
+
+    def bus_nick(self, args):
+        old, new, ip = args.decode('utf-8', errors='replace').split(' ', 2)
+        user = self.registry.set_remote_nick(old, new, ip)
+        self.rename_member(user, user.channels, f":{new}".encode())
+
+    def bus_collide(self, args):
+        # Another worker claimed the nick first, undo our registration
+        nick, old = args.decode('utf-8', errors='replace').split(' ', 1)
+        client = self.registry.revert_nick(nick, None if old == '*' else old)
+        if client is None:
+            return
+        session = self.registry.clients.get(client)
+        if session:
+            self.rename_member(client, session.channels, session.prefix or f":{session.ip}".encode())
+        client.send(f":server 433 * {nick} :Nickname is already in use\r\n".encode())
+        self.log(f"Nick collision on {nick}, reverted")
+
+    def bus_join(self, args):
+        nick, channel_name = args.decode('utf-8', errors='replace').split(' ', 1)
+        user = self.registry.remote_users.get(nick)
+        if user is None:
+            return
+        channel, _ = self.registry.get_channel(channel_name, create=True)
+        channel.add_remote(user)
+        user.channels.add(channel.name)
+        line = f":{nick} JOIN {channel_name}\r\n".encode()
+        for member in channel.snapshot():
+            member.send(line)
+
+    def bus_part(self, args):
+        nick, channel_name = args.decode('utf-8', errors='replace').split(' ', 1)
+        user = self.registry.remote_users.get(nick)
+        channel = self.registry.channels.get(channel_name)
+        if user is None or channel is None:
+            return
+        channel.discard_remote(user)
+        user.channels.discard(channel_name)
+        line = f":{nick} PART {channel_name}\r\n".encode()
+        for member in channel.snapshot():
+            member.send(line)
+
+    def bus_quit(self, args):
+        nick, _, reason = args.decode('utf-8', errors='replace').partition(' :')
+        user = self.registry.remove_remote_user(nick)
+        if user is None:
+            return
+        line = f":{nick} QUIT :{reason}\r\n".encode()
+        for channel_name in user.channels:
+            channel = self.registry.channels.get(channel_name)
+            if channel:
+                channel.discard_remote(user)
+                for member in channel.snapshot():
+                    member.send(line)
+
+    def bus_channel_message(self, args):
+        target, _, line = args.partition(b' ')
+        channel, _ = self.registry.get_channel(target.decode('utf-8', errors='replace'),
+                                               create=bool(self.history_lines))
+        if channel:
+            line += b'\r\n'
+            for member in channel.snapshot():
+                member.send(line)
+            self.record_history(channel, line)
+
+    def bus_user_message(self, args):
+        target, _, line = args.partition(b' ')
+        client = self.registry.nicknames.get(target.decode('utf-8', errors='replace'))
+        if client:
+            client.send(line + b'\r\n')
+
+    def bus_kill(self, args):
+        nick, _, reason = args.decode('utf-8', errors='replace').partition(' :')
+        client = self.registry.nicknames.get(nick)
+        session = self.registry.clients.get(client)
+        if session:
+            self.kick_client(client, nick, session.ip, reason)
+
+    def bus_ban(self, args):
+        self.ban(PrefixTrie.parse(args.decode()))
+
+    def bus_unban(self, args):
+        self.bans.remove(PrefixTrie.parse(args.decode()))
+
+    def bus_channel(self, args):
+        op, name = args.decode('utf-8', errors='replace').split(' ', 1)
+        if op == '+':
+            self.registry.get_channel(name, create=True)
+        elif op == '-':
+            self.registry.remove_channel(name)
+
+    def bus_mode(self, args):
+        name, modes, line = args.split(b' ', 2)
+        channel, _ = self.registry.get_channel(name.decode('utf-8', errors='replace'), create=True)
+        channel.modes = int(modes)
+        line += b'\r\n'
+        for member in channel.snapshot():
+            member.send(line)
+
+    def bus_broadcast(self, args):
+        line = args + b'\r\n'
+        for client, _ in self.registry.client_items():
+            client.send(line)
+
+    def bus_shutdown(self, args):
+        self.stop()
+
+    def ban(self, network):
+        """Bans a network and drops the local sessions inside it. Returns the
+        nicks (or IPs) that were disconnected."""
+        self.bans.add(network)
+        if network.num_addresses == 1:
+            ips = [str(network.network_address)]
+        else:
+            ips = [ip for ip in self.registry.connected_ips() if ipaddress.ip_address(ip) in network]
+        dropped = []
+        for ip in ips:
+            for client, session in self.registry.clients_from(ip):
+                client.send(b"ERROR :Your IP has been banned from the server\r\n")
+                self.remove_client(client, session.nick, ip)
+                dropped.append(session.nick or ip)
+        return dropped
+
+    def kick_client(self, client, nick, ip, reason):
+        client.send(f":server KICK {nick} :{reason}\r\n".encode())
+        client.send(f"ERROR :You have been kicked from the server: {reason}\r\n".encode())
+        self.remove_client(client, nick, ip)
 
     def admin_console(self):
         print()
@@ -272,14 +2529,14 @@ class IRCServer:
                             identifier = parts[1]
                             self.admin_ban(identifier)
                         else:
-                            print(f"{Colors.RED}Usage: /ban <nick|ip>{Colors.RESET}")
+                            print(f"{Colors.RED}Usage: /ban <nick|ip|cidr>{Colors.RESET}")
                     
                     elif action == 'unban':
                         if len(parts) > 1:
                             ip = parts[1]
                             self.admin_unban(ip)
                         else:
-                            print(f"{Colors.RED}Usage: /unban <ip>{Colors.RESET}")
+                            print(f"{Colors.RED}Usage: /unban <ip|cidr>{Colors.RESET}")
                     
                     elif action == 'channels':
                         self.admin_list_channels()
@@ -313,6 +2570,12 @@ class IRCServer:
                         else:
                             print(f"{Colors.RED}Usage: /broadcast <message>{Colors.RESET}")
                     
+                    elif action == 'stats':
+                        self.admin_stats()
+                    
+                    elif action == 'upgrade':
+                        self.admin_upgrade()
+                    
                     elif action == 'shutdown':
                         print(f"{Colors.RED}Shutting down server...{Colors.RESET}")
                         self.stop()
@@ -320,95 +2583,103 @@ class IRCServer:
                     
                     else:
                         print(f"{Colors.RED}Unknown admin command{Colors.RESET}")
+            except EOFError:
+                # No console attached (stdin closed), keep serving without one
+                break
             except Exception as e:
                 print(f"{Colors.RED}Admin error: {e}{Colors.RESET}")
 
     def admin_kick(self, identifier, reason):
-        if identifier in self.nicknames:
-            client = self.nicknames[identifier]
+        client = self.registry.nicknames.get(identifier)
+        session = self.registry.clients.get(client)
+        if session:
             nick = identifier
-            client.send(f":server KICK {nick} :{reason}\r\n".encode())
-            client.send(f"ERROR :You have been kicked from the server: {reason}\r\n".encode())
-            self.remove_client(client, nick, self.clients[client]['ip'])
+            self.kick_client(client, nick, session.ip, reason)
             self.log(f"ADMIN: Kicked {nick} - {reason}", show=False)
             print(f"{Colors.GREEN}Kicked {nick}{Colors.RESET}")
             return
+
+        if identifier in self.registry.remote_users:
+            self.publish(f"KILL {identifier} :{reason}".encode())
+            self.log(f"ADMIN: Kicked {identifier} - {reason}", show=False)
+            print(f"{Colors.GREEN}Kicked {identifier}{Colors.RESET}")
+            return
             
-        client_to_kick = None
-        for client, info in self.clients.items():
-            if info['ip'] == identifier:
-                client_to_kick = client
-                break
-        
-        if client_to_kick:
-            ip = self.clients[client_to_kick]['ip']
-            nick = self.clients[client_to_kick].get('nick', ip)
-            client_to_kick.send(f":server KICK {nick} :{reason}\r\n".encode())
-            client_to_kick.send(f"ERROR :You have been kicked from the server: {reason}\r\n".encode())
-            self.remove_client(client_to_kick, nick, ip)
-            self.log(f"ADMIN: Kicked {ip} - {reason}", show=False)
-            print(f"{Colors.GREEN}Kicked {ip}{Colors.RESET}")
+        # Not a nick, kick every session from that IP
+        clients = self.registry.clients_from(identifier)
+        remote = self.registry.remote_users_from(identifier)
+        for client, session in clients:
+            self.kick_client(client, session.nick or identifier, identifier, reason)
+        for user in remote:
+            self.publish(f"KILL {user.nick} :{reason}".encode())
+        if clients or remote:
+            count = len(clients) + len(remote)
+            self.log(f"ADMIN: Kicked {identifier} ({count} sessions) - {reason}", show=False)
+            print(f"{Colors.GREEN}Kicked {count} session(s) from {identifier}{Colors.RESET}")
         else:
             print(f"{Colors.RED}User not found: {identifier}{Colors.RESET}")
 
     def admin_ban(self, identifier):
-        if identifier in self.nicknames:
-            client = self.nicknames[identifier]
-            ip = self.clients[client]['ip']
-            self.banned_ips.add(ip)
-            client.send(f"ERROR :Your IP has been banned from the server\r\n".encode())
-            self.remove_client(client, identifier, ip)
-            self.log(f"ADMIN: Banned {identifier} ({ip})", show=False)
-            print(f"{Colors.GREEN}Banned {identifier} ({ip}){Colors.RESET}")
+        client = self.registry.nicknames.get(identifier)
+        session = self.registry.clients.get(client)
+        user = self.registry.remote_users.get(identifier)
+        try:
+            if session:
+                network = PrefixTrie.parse(session.ip)
+            elif user:
+                network = PrefixTrie.parse(user.ip)
+            else:
+                network = PrefixTrie.parse(identifier)
+        except ValueError:
+            print(f"{Colors.RED}Not a nick, IP or CIDR range: {identifier}{Colors.RESET}")
             return
-            
-        client_to_ban = None
-        for client, info in self.clients.items():
-            if info['ip'] == identifier:
-                client_to_ban = client
-                break
-        
-        if client_to_ban:
-            ip = identifier
-            self.banned_ips.add(ip)
-            nick = self.clients[client_to_ban].get('nick', ip)
-            client_to_ban.send(f"ERROR :Your IP has been banned from the server\r\n".encode())
-            self.remove_client(client_to_ban, nick, ip)
-            self.log(f"ADMIN: Banned {ip}", show=False)
-            print(f"{Colors.GREEN}Banned {ip}{Colors.RESET}")
-        else:
-            self.banned_ips.add(identifier)
-            self.log(f"ADMIN: Banned IP: {identifier}", show=False)
-            print(f"{Colors.GREEN}Banned IP: {identifier}{Colors.RESET}")
+
+        self.publish(f"BAN {network}".encode())
+        dropped = self.ban(network)
+        target = PrefixTrie.describe(network)
+        if session or user:
+            target = f"{identifier} ({target})"
+        self.log(f"ADMIN: Banned {target}, {len(dropped)} local sessions dropped", show=False)
+        print(f"{Colors.GREEN}Banned {target}{Colors.RESET}")
+        if dropped:
+            print(f"{Colors.GREEN}Disconnected: {', '.join(dropped)}{Colors.RESET}")
 
     def admin_unban(self, ip):
-        if ip in self.banned_ips:
-            self.banned_ips.remove(ip)
+        try:
+            network = PrefixTrie.parse(ip)
+        except ValueError:
+            print(f"{Colors.RED}Not an IP or CIDR range: {ip}{Colors.RESET}")
+            return
+
+        if self.bans.remove(network):
+            self.publish(f"UNBAN {network}".encode())
             self.log(f"ADMIN: Unbanned {ip}", show=False)
             print(f"{Colors.GREEN}Unbanned {ip}{Colors.RESET}")
         else:
             print(f"{Colors.RED}IP not banned: {ip}{Colors.RESET}")
 
     def admin_list_channels(self):
-        if not self.channels:
+        if not self.registry.channels:
             print(f"{Colors.YELLOW}No channels exist{Colors.RESET}")
             return
             
         print(f"{Colors.BLUE}Channels:{Colors.RESET}")
-        for name, channel in self.channels.items():
-            members = len(channel.members)
+        for name, channel in list(self.registry.channels.items()):
+            members = channel.size()
             created = channel.created.strftime("%Y-%m-%d %H:%M")
-            print(f"  {Colors.CYAN}{name}{Colors.RESET} - Members: {Colors.GREEN}{members}{Colors.RESET}, Created: {Colors.GRAY}{created}{Colors.RESET}")
+            print(f"  {Colors.CYAN}{name}{Colors.RESET} - Members: {Colors.GREEN}{members}{Colors.RESET}, "
+                  f"Modes: {channel.mode_string()}, Created: {Colors.GRAY}{created}{Colors.RESET}")
 
     def admin_add_channel(self, channel):
         if not channel.startswith('#'):
             channel = '#' + channel
             
-        if channel in self.channels:
+        _, created = self.registry.get_channel(channel, create=True)
+        if not created:
             print(f"{Colors.YELLOW}Channel already exists{Colors.RESET}")
             return
             
-        self.channels[channel] = Channel(channel)
+        self.publish(f"CHANNEL + {channel}".encode())
         self.log(f"ADMIN: Created channel {channel}", show=False)
         print(f"{Colors.GREEN}Created channel {channel}{Colors.RESET}")
 
@@ -416,50 +2687,374 @@ class IRCServer:
         if not channel.startswith('#'):
             channel = '#' + channel
             
-        if channel in self.channels:
-            if self.channels[channel].members:
-                print(f"{Colors.RED}Channel has active members{Colors.RESET}")
-            else:
-                del self.channels[channel]
-                self.log(f"ADMIN: Removed channel {channel}", show=False)
-                print(f"{Colors.GREEN}Removed channel {channel}{Colors.RESET}")
+        removed = self.registry.remove_channel(channel)
+        if removed:
+            self.publish(f"CHANNEL - {channel}".encode())
+            self.log(f"ADMIN: Removed channel {channel}", show=False)
+            print(f"{Colors.GREEN}Removed channel {channel}{Colors.RESET}")
+        elif removed is False:
+            print(f"{Colors.RED}Channel has active members{Colors.RESET}")
         else:
             print(f"{Colors.RED}Channel not found{Colors.RESET}")
 
     def admin_message(self, target, message):
         if target.startswith('#'):
-            if target in self.channels:
-                for client in self.channels[target].members:
-                    client.send(f":server PRIVMSG {target} :[ADMIN] {message}\r\n".encode())
+            channel = self.registry.channels.get(target)
+            if channel:
+                line = f":server PRIVMSG {target} :[ADMIN] {message}\r\n".encode()
+                for client in channel.snapshot():
+                    client.send(line)
+                self.publish(f"CMSG {target} ".encode() + line[:-2])
                 print(f"{Colors.GREEN}Sent to {target}{Colors.RESET}")
             else:
                 print(f"{Colors.RED}Channel not found{Colors.RESET}")
         else:
-            if target in self.nicknames:
-                self.nicknames[target].send(f":server PRIVMSG {target} :[ADMIN] {message}\r\n".encode())
+            client = self.registry.nicknames.get(target)
+            if client:
+                client.send(f":server PRIVMSG {target} :[ADMIN] {message}\r\n".encode())
+                print(f"{Colors.GREEN}Sent to {target}{Colors.RESET}")
+            elif target in self.registry.remote_users:
+                self.publish(f"UMSG {target} :server PRIVMSG {target} :[ADMIN] {message}".encode())
                 print(f"{Colors.GREEN}Sent to {target}{Colors.RESET}")
             else:
                 print(f"{Colors.RED}User not found{Colors.RESET}")
 
     def admin_broadcast(self, message):
-        for client in self.clients.keys():
+        line = f":server NOTICE * :[BROADCAST] {message}\r\n".encode()
+        for client, _ in self.registry.client_items():
             try:
-                client.send(f":server NOTICE * :[BROADCAST] {message}\r\n".encode())
+                client.send(line)
             except:
                 pass
+        self.publish(b'BROADCAST ' + line[:-2])
         print(f"{Colors.GREEN}Broadcast sent{Colors.RESET}")
 
+    def admin_stats(self):
+        metrics = self.metrics
+        counters = metrics.counters
+        gauges, sendq = self.metric_gauges()
+        uptime = max(time.time() - metrics.started, 1e-9)
+
+        def ms(value):
+            return '-' if value is None else f"<={value * 1000:g}ms"
+
+        print(f"{Colors.CYAN}Uptime:{Colors.RESET} {uptime:.0f}s  "
+              + "  ".join(f"{Colors.CYAN}{name}:{Colors.RESET} {value}" for name, (_, value) in gauges.items()))
+        print(f"{Colors.CYAN}Connections:{Colors.RESET} {counters['connections']} ({counters['connections'] / uptime:.2f}/s), "
+              f"disconnects {counters['disconnects']}, banned {counters['banned_rejects']}, "
+              f"SendQ drops {counters['sendq_drops']}, timeouts {counters['timeouts']}")
+        print(f"{Colors.CYAN}Flood control:{Colors.RESET} {counters['flood_delays']} commands delayed, "
+              f"{counters['flood_disconnects']} clients disconnected")
+        if self.context:
+            print(f"{Colors.CYAN}TLS handshakes:{Colors.RESET} {counters['tls_handshakes']} ok, "
+                  f"{counters['tls_handshake_failures']} failed, p50 {ms(metrics.handshake.percentile(0.5))}, "
+                  f"p99 {ms(metrics.handshake.percentile(0.99))}")
+        print(f"{Colors.CYAN}Traffic:{Colors.RESET} in {counters['bytes_in']} bytes ({counters['bytes_in'] / uptime:.0f}/s), "
+              f"out {counters['bytes_out']} bytes ({counters['bytes_out'] / uptime:.0f}/s)")
+        print(f"{Colors.CYAN}Outbound queues:{Colors.RESET} {sendq.total} bytes queued, "
+              f"p99 depth <= {sendq.percentile(0.99) or 0} bytes")
+        fanout = metrics.fanout()
+        print(f"{Colors.CYAN}Fan-out:{Colors.RESET} {fanout.count} channel messages, "
+              f"p50 <= {fanout.percentile(0.5) or 0}, p99 <= {fanout.percentile(0.99) or 0} recipients")
+        print(f"{Colors.CYAN}Commands:{Colors.RESET} ({counters['unknown_commands']} unknown)")
+        for name, hist in metrics.commands.items():
+            if hist.count:
+                print(f"  {Colors.BLUE}{name:<8}{Colors.RESET} {hist.count:>10}  "
+                      f"p50 {ms(hist.percentile(0.5)):>12}  p99 {ms(hist.percentile(0.99)):>12}")
+
+    def snapshot_state(self):
+        return {
+            'version': 1,
+            'channels': [[channel.name, channel.created.timestamp(), channel.modes]
+                         for channel in list(self.registry.channels.values())],
+            'bans': sorted(PrefixTrie.describe(network) for network in list(self.bans.networks)),
+        }
+
+    def apply_snapshot(self, state):
+        for name, created, *modes in state.get('channels', ()):
+            channel, _ = self.registry.get_channel(name, create=True)
+            channel.created = datetime.datetime.fromtimestamp(created)
+            channel.modes = modes[0] if modes else Channel.DEFAULT_MODES
+        for network in state.get('bans', ()):
+            self.bans.add(PrefixTrie.parse(network))
+        for name, entries in state.get('history', {}).items():
+            channel, _ = self.registry.get_channel(name, create=True)
+            history = self.history_of(channel)
+            if history:
+                for stamp, line in entries:
+                    history.append(stamp, line.encode('latin-1'))
+
+    def load_snapshot(self):
+        if not self.snapshot_file:
+            return
+        try:
+            with open(self.snapshot_file) as f:
+                state = json.load(f)
+            self.apply_snapshot(state)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError) as e:
+            self.log(f"Could not load snapshot {self.snapshot_file}: {e}", level='warning')
+            return
+        self.log(f"Loaded {len(state.get('channels', ()))} channels and {len(state.get('bans', ()))} bans "
+                 f"from {self.snapshot_file}", show=False)
+
+    def save_snapshot(self):
+        """Writes channels and bans through a temporary file and a rename, so a
+        crash never leaves half a snapshot. Skipped when nothing changed."""
+        if not self.snapshot_file or self.worker_id:
+            return
+        data = json.dumps(self.snapshot_state(), separators=(',', ':'))
+        if data == self.snapshot_saved:
+            return
+        temp = self.snapshot_file + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(data)
+        os.replace(temp, self.snapshot_file)
+        self.snapshot_saved = data
+
+    def snapshot_timer(self):
+        try:
+            self.save_snapshot()
+        except OSError as e:
+            self.log(f"Could not save snapshot {self.snapshot_file}: {e}", level='warning')
+        if self.running:
+            self.timers.schedule(self.snapshot_interval, self.snapshot_timer)
+
+    @staticmethod
+    def send_message(sock, payload, fds=()):
+        """One length-prefixed message on the upgrade channel, any file
+        descriptors ride along with its first bytes."""
+        data = struct.pack('!I', len(payload)) + payload
+        sent = socket.send_fds(sock, [data], list(fds)) if fds else 0
+        sock.sendall(data[sent:])
+
+    @staticmethod
+    def recv_message(sock, max_fds=0):
+        """Returns (payload, fds) of the next message, raises OSError if the
+        other process went away."""
+        def exactly(size, max_fds=0):
+            data, fds = b'', []
+            while len(data) < size:
+                if max_fds:
+                    chunk, received, _, _ = socket.recv_fds(sock, size - len(data), max_fds)
+                    fds += received
+                else:
+                    chunk = sock.recv(size - len(data))
+                if not chunk:
+                    raise OSError("upgrade channel closed")
+                data += chunk
+            return data, fds
+        header, fds = exactly(4, max_fds)
+        return exactly(struct.unpack('!I', header)[0])[0], fds
+
+    def admin_upgrade(self):
+        """Starts server.py again as a new process and hands it the listening
+        socket, the channels and bans and, in asyncio mode, the connected
+        plaintext clients, then exits. Nothing changes if the new process
+        fails to start."""
+        if self.bus_path:
+            print(f"{Colors.RED}/upgrade doesn't support --workers{Colors.RESET}")
+            return
+        argv = list(sys.argv)
+        if '--upgrade-fd' in argv:
+            index = argv.index('--upgrade-fd')
+            del argv[index:index + 2]
+        ours, theirs = socket.socketpair()
+        try:
+            child = subprocess.Popen([sys.executable] + argv + ['--upgrade-fd', str(theirs.fileno())],
+                                     pass_fds=[theirs.fileno()])
+        except OSError as e:
+            print(f"{Colors.RED}Upgrade failed: {e}{Colors.RESET}")
+            ours.close()
+            return
+        finally:
+            theirs.close()
+        ours.settimeout(30.0)
+        try:
+            self.send_message(ours, json.dumps({'admin_password': self.admin_password,
+                                                'cloak_key': self.cloak_key.hex()}).encode())
+            if self.recv_message(ours)[0] != b'READY':
+                raise OSError("unexpected reply")
+        except OSError as e:
+            print(f"{Colors.RED}Upgrade aborted, the new process didn't start: {e}{Colors.RESET}")
+            child.kill()
+            child.wait()
+            ours.close()
+            return
+
+        print(f"{Colors.GREEN}New server process {child.pid} is ready, handing over{Colors.RESET}")
+        self.handing_off = True
+        listener = self.server.dup()
+        handed = []
+        if self.mode == 'asyncio':
+            handed = asyncio.run_coroutine_threadsafe(self.quiesce(), self.loop).result(30.0)
+        else:
+            # Connections accepted from here on would be dropped by os._exit
+            self.accept_paused.wait(self.ACCEPT_POLL * 2)
+        try:
+            self.save_snapshot()
+        except OSError as e:
+            self.log(f"Could not save snapshot {self.snapshot_file}: {e}", level='warning')
+        # Scrollback only goes over to the new process, snapshots leave it to --history-dir
+        state = self.snapshot_state()
+        state['history'] = {channel.name: [[stamp, line.decode('latin-1')] for stamp, line in channel.history.copy()]
+                            for channel in list(self.registry.channels.values()) if channel.history}
+        try:
+            self.send_message(ours, json.dumps(state).encode(), [listener.fileno()])
+            for start in range(0, len(handed), self.HANDOFF_BATCH):
+                batch = handed[start:start + self.HANDOFF_BATCH]
+                self.send_message(ours, json.dumps([record for _, record, _ in batch]).encode(),
+                                  [fd for _, _, fd in batch])
+            self.send_message(ours, b'DONE')
+            if self.recv_message(ours)[0] != b'OK':
+                raise OSError("unexpected reply")
+        except OSError as e:
+            print(f"{Colors.RED}Upgrade failed during the handover, shutting down: {e}{Colors.RESET}")
+            child.kill()
+            self.stop()
+            return
+
+        self.log(f"Handed {len(handed)} clients over to process {child.pid}")
+        # Everyone else (TLS sessions can't move, threaded mode can't take back a
+        # read that is already in progress) is asked to come back
+        moved = {client for client, _, _ in handed}
+        for client, session in self.registry.client_items():
+            if client not in moved:
+                client.send(b":server NOTICE * :Server is restarting, please reconnect\r\n")
+                client.close()
+        time.sleep(0.5)
+        self.logger.close()
+        # Skips every cleanup, the new process owns the sockets now
+        os._exit(0)
+
+    async def quiesce(self):
+        """Stops every client task between two reads for the handover and
+        returns [(client, record, fd)] for the clients that can move."""
+        self.listener.close()
+        items = self.registry.client_items()
+        for client, session in items:
+            client.writer.transport.pause_reading()
+        tasks = list(self.client_tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=5.0)
+        if self.context:
+            return []
+
+        # The new process starts with empty send queues, let these drain first
+        def flushed(client):
+            return not client.pending and not client.writer.transport.get_write_buffer_size()
+        deadline = self.loop.time() + 2.0
+        while self.loop.time() < deadline and not all(flushed(client) for client, _ in items):
+            await asyncio.sleep(0.01)
+
+        handed = []
+        for client, session in items:
+            if client.closing or not flushed(client):
+                continue
+            # Input not run yet, in order: held back lines, a partial line, unread bytes
+            lines = session.backlog[session.backlog_pos:]
+            data = b''.join(line + b'\r\n' for line in lines if line is not None)
+            data += bytes(session.buffer.buffer) + await self.buffered(client.reader)
+            record = {'ip': session.ip, 'nick': session.nick, 'channels': sorted(session.channels),
+                      'input': data.decode('latin-1')}
+            handed.append((client, record, client.writer.get_extra_info('socket').fileno()))
+        return handed
+
+    @staticmethod
+    async def buffered(reader):
+        """The bytes a paused stream has read but nobody consumed. read() on a
+        non-empty buffer returns without waiting, so a read that hasn't
+        finished after one turn of the loop means the buffer is empty."""
+        data = b''
+        while True:
+            task = asyncio.ensure_future(reader.read(65536))
+            await asyncio.sleep(0)
+            if not task.done():
+                task.cancel()
+                return data
+            try:
+                chunk = task.result()
+            except Exception:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    def take_over(self):
+        """Receives the listening socket, state and clients from the process
+        that ran /upgrade, and returns once that process has exited."""
+        channel = self.upgrade_channel
+        self.send_message(channel, b'READY')
+        state, fds = self.recv_message(channel, 1)
+        self.server.close()
+        self.server = socket.socket(fileno=fds[0])
+        # The old process may have been running the socket non-blocking
+        self.server.setblocking(True)
+        self.apply_snapshot(json.loads(state))
+        while True:
+            payload, fds = self.recv_message(channel, self.HANDOFF_BATCH)
+            if payload == b'DONE':
+                break
+            self.restored += [(record, socket.socket(fileno=fd)) for record, fd in zip(json.loads(payload), fds)]
+        self.send_message(channel, b'OK')
+        # Reads nothing, returns when the old process exits and frees the port
+        channel.recv(1)
+        channel.close()
+        self.upgrade_channel = None
+        self.log(f"Took over from the previous process with {len(self.restored)} clients", show=False)
+
+    def restore_session(self, client, session, record):
+        """Puts a client handed over by /upgrade back the way it was. Returns
+        the input it had sent that wasn't run yet."""
+        if record['nick']:
+            self.registry.set_nick(client, record['nick'])
+        prefix = session.prefix or f":{session.ip}".encode()
+        for channel_name in record['channels']:
+            channel, _ = self.registry.get_channel(channel_name, create=True)
+            self.registry.join(client, channel, prefix)
+        return record['input'].encode('latin-1')
+
     def stop(self):
+        if not self.running:
+            return
         self.running = False
-        for client, info in self.clients.items():
+        try:
+            self.save_snapshot()
+        except OSError as e:
+            self.log(f"Could not save snapshot {self.snapshot_file}: {e}", level='warning')
+        if self.console:
+            self.publish(b'SHUTDOWN')
+        for client, session in self.registry.client_items():
             try:
                 client.send(":server NOTICE * :Server is shutting down\r\n".encode())
                 client.close()
             except:
                 pass
         
-        self.server.close()
+        if self.loop and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self.stop_event.set)
+            except RuntimeError:
+                pass
+        else:
+            # close() alone doesn't wake a thread blocked in accept()
+            try:
+                self.server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server.close()
+        if self.bus:
+            self.bus.close()
+            if isinstance(self.bus, ThreadedConnection):
+                self.bus.writer.join(1.0)
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
         self.log("Server stopped", show=False)
+        self.logger.close()
         print(f"{Colors.RED}Server stopped{Colors.RESET}")
 
 if __name__ == "__main__":
@@ -469,9 +3064,69 @@ if __name__ == "__main__":
     parser.add_argument("--port", type=int, default=6667, help="Port to listen on")
     parser.add_argument("--ssl-cert", help="Path to SSL certificate (cert.pem)")
     parser.add_argument("--ssl-key", help="Path to SSL private key (key.pem)")
+    parser.add_argument("--tls-handshake-timeout", type=float, default=10.0,
+                        help="Seconds a client gets to complete the TLS handshake")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded",
+                        help="Connection handling: one thread per client or a single asyncio event loop")
+    parser.add_argument("--max-sendq", type=int, default=512 * 1024,
+                        help="Bytes queued for a client before it is disconnected as too slow")
+    parser.add_argument("--log-file", default="server.log", help="Server log file")
+    parser.add_argument("--log-level", choices=list(LogWriter.LEVELS), default="info", help="Minimum level written to the log")
+    parser.add_argument("--log-max-bytes", type=int, default=10 * 1024 * 1024, help="Rotate the log once it reaches this size")
+    parser.add_argument("--log-backups", type=int, default=5, help="Rotated log files to keep")
+    parser.add_argument("--log-recv-sample", type=int, default=1,
+                        help="Log 1 in N received lines (0 disables RECV logging)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port through SO_REUSEPORT (Linux)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics on this port (worker N uses port + N)")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="Address for the metrics endpoint")
+    parser.add_argument("--ping-interval", type=float, default=120.0,
+                        help="Seconds of silence before the server PINGs a client (0 disables)")
+    parser.add_argument("--ping-timeout", type=float, default=60.0,
+                        help="Seconds a client gets to answer a PING before it is dropped")
+    parser.add_argument("--registration-timeout", type=float, default=60.0,
+                        help="Seconds a connection may stay without a nick (0 disables)")
+    parser.add_argument("--idle-timeout", type=float, default=0,
+                        help="Drop clients that send no command for this many seconds (0 disables)")
+    parser.add_argument("--flood-rate", type=float, default=5.0,
+                        help="Command tokens a client earns per second (0 disables flood control)")
+    parser.add_argument("--flood-burst", type=float, default=20.0,
+                        help="Tokens a client can save up for a burst")
+    parser.add_argument("--flood-config", help="JSON file with flood weights, per-IP-class and per-channel limits")
+    parser.add_argument("--history-lines", type=int, default=100,
+                        help="Messages of scrollback kept per channel (0 disables history)")
+    parser.add_argument("--history-bytes", type=int, default=32 * 1024, help="Bytes of scrollback kept per channel")
+    parser.add_argument("--history-replay", type=int, default=20, help="Messages replayed to a client on JOIN")
+    parser.add_argument("--history-dir", help="Append older scrollback to one file per channel in this directory")
+    parser.add_argument("--snapshot-file", default="server-state.json",
+                        help="Channels and bans are saved here and loaded at startup ('' disables)")
+    parser.add_argument("--snapshot-interval", type=float, default=60.0, help="Seconds between snapshots")
+    parser.add_argument("--admin-password-file",
+                        help="Read the admin password from this file (or set IRC_ADMIN_PASSWORD) instead of asking")
+    parser.add_argument("--upgrade-fd", type=int, help=argparse.SUPPRESS)
     args = parser.parse_args()
 
-    server = IRCServer(host=args.host, port=args.port, ssl_cert=args.ssl_cert, ssl_key=args.ssl_key)
+    options = dict(host=args.host, port=args.port, ssl_cert=args.ssl_cert, ssl_key=args.ssl_key, mode=args.mode,
+                   max_sendq=args.max_sendq, log_file=args.log_file, log_level=args.log_level,
+                   log_max_bytes=args.log_max_bytes, log_backups=args.log_backups,
+                   log_recv_sample=args.log_recv_sample, tls_handshake_timeout=args.tls_handshake_timeout,
+                   metrics_port=args.metrics_port, metrics_host=args.metrics_host,
+                   ping_interval=args.ping_interval, ping_timeout=args.ping_timeout,
+                   registration_timeout=args.registration_timeout, idle_timeout=args.idle_timeout,
+                   flood_rate=args.flood_rate, flood_burst=args.flood_burst, flood_config=args.flood_config,
+                   history_lines=args.history_lines, history_bytes=args.history_bytes,
+                   history_replay=args.history_replay, history_dir=args.history_dir,
+                   snapshot_file=args.snapshot_file or None, snapshot_interval=args.snapshot_interval,
+                   admin_password=os.environ.get('IRC_ADMIN_PASSWORD'))
+    if args.admin_password_file:
+        with open(args.admin_password_file) as f:
+            options['admin_password'] = f.read().strip()
+    if args.workers > 1:
+        run_workers(args.workers, options)
+        sys.exit(0)
+
+    server = IRCServer(**options, upgrade_fd=args.upgrade_fd)
     try:
         server.start()
     except KeyboardInterrupt:
@@ -0,0 +1,84 @@
+"""Checks of the client's protocol helpers, no server needed.
+
+    python -m pytest tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import ChatLog, ClientProtocol, IRCClient, Message
+
+class SplitTextTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = ClientProtocol('tester')
+
+    def budget(self, head):
+        return (ClientProtocol.MAX_LINE - 2 - len(head.encode()) - len(self.protocol.nick.encode())
+                - ClientProtocol.PREFIX_ROOM)
+
+    def test_target_too_long_for_any_text_raises(self):
+        head = f"PRIVMSG #{'x' * 449} :"
+        with self.assertRaises(ValueError):
+            self.protocol.split_text(head, "hello")
+
+    def test_smallest_budget_keeps_whole_characters(self):
+        target = '#' + 'x' * 400
+        head = f"PRIVMSG {target} :"
+        target += 'x' * (self.budget(head) - ClientProtocol.MIN_PIECE)
+        head = f"PRIVMSG {target} :"
+        self.assertEqual(self.budget(head), ClientProtocol.MIN_PIECE)
+        text = "é😀a" * 20
+        pieces = self.protocol.split_text(head, text)
+        self.assertEqual(''.join(pieces), text)
+        self.assertTrue(all(0 < len(piece.encode()) <= ClientProtocol.MIN_PIECE for piece in pieces))
+
+    def test_long_text_splits_at_spaces(self):
+        text = ' '.join(["word"] * 300)
+        pieces = self.protocol.split_text("PRIVMSG #c :", text)
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual(' '.join(pieces), text)
+
+class ChatLogTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_sealed_indexes_stay_within_open_limit(self):
+        log = ChatLog(self.root)
+        log.SEGMENT_BYTES = 2000
+        log.OPEN_INDEXES = 3
+        for i in range(400):
+            log.append('#c', 'nick', f"message number {i} " + ("filler " * 10 if i % 50 else "needle"))
+            if i % 10 == 9:
+                log.flush()  # segments are sealed once a flush passes SEGMENT_BYTES
+        self.assertGreater(log.channel('#c').segment, 10)
+        found = log.search('needle', limit=100)
+        self.assertEqual(sorted(int(text.split()[2]) for _, _, _, text in found), list(range(0, 400, 50)))
+        self.assertLessEqual(len(log.sealed), log.OPEN_INDEXES)
+        log.close()
+
+    def test_search_keeps_queued_messages_in_order(self):
+        log = ChatLog(self.root)
+        for i in range(50):
+            log.append('#c', 'nick', f"ordered {i}")
+            if i % 7 == 0:
+                log.search('ordered')
+        log.close()
+        with open(log.segment_path(log.channel('#c'), 1), encoding='utf-8') as f:
+            self.assertEqual([line.split('\t')[2].strip() for line in f], [f"ordered {i}" for i in range(50)])
+
+    def test_private_messages_share_one_log_both_ways(self):
+        client = IRCClient(log_dir=self.root)
+        client.nick = 'me'
+        client.log_message(Message.parse(":friend!u@h PRIVMSG me :hi there"))
+        client.log_message(Message.parse(":me!u@h PRIVMSG friend :hi back"))
+        found = client.chat_log.search('hi', 'friend')
+        client.chat_log.close()
+        self.assertEqual(sorted(nick for _, _, nick, _ in found), ['friend', 'me'])
+
+if __name__ == "__main__":
+    unittest.main()
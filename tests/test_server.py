@@ -0,0 +1,154 @@
+"""End-to-end checks against servers running in this process on free ports.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import BusHub, FloodControl, IRCServer, Session
+
+class Peer:
+    """A raw IRC connection that collects what the server sends."""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.data = b''
+
+    def send(self, text):
+        self.sock.sendall(text.encode() if isinstance(text, str) else text)
+
+    def wait_for(self, needle, timeout=5.0):
+        """Reads until needle has been received, returns everything so far."""
+        needle = needle.encode()
+        deadline = time.monotonic() + timeout
+        while needle not in self.data:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise AssertionError(f"{needle!r} not received, got {self.data[-500:]!r}")
+            self.sock.settimeout(left)
+            try:
+                chunk = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            if not chunk:
+                raise AssertionError(f"closed before {needle!r}, got {self.data[-500:]!r}")
+            self.data += chunk
+        return self.data
+
+    def close(self):
+        self.sock.close()
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.dir)
+
+    def start_server(self, **options):
+        options = dict(dict(host='127.0.0.1', port=0, admin_password='test', snapshot_file=None,
+                            log_file=os.path.join(self.dir, f"server{len(self.servers)}.log"), console=False),
+                       **options)
+        server = IRCServer(**options)
+        self.servers.append(server)
+        threading.Thread(target=server.start, daemon=True).start()
+        deadline = time.monotonic() + 5
+        while not server.server.getsockname()[1]:
+            self.assertLess(time.monotonic(), deadline, "server did not start")
+            time.sleep(0.01)
+        return server, server.server.getsockname()[1]
+
+    def connect(self, port, nick):
+        peer = Peer(port)
+        self.addCleanup(peer.close)
+        peer.send(f"NICK {nick}\r\nUSER {nick} 0 * :{nick}\r\n")
+        peer.wait_for(f" 001 {nick} ")
+        return peer
+
+class HistoryAcrossWorkersTest(ServerTestCase):
+    def start_workers(self):
+        bus_path = os.path.join(self.dir, 'bus.sock')
+        hub_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        hub_sock.bind(bus_path)
+        hub_sock.listen()
+        threading.Thread(target=asyncio.run, args=(BusHub(hub_sock).serve(),), daemon=True).start()
+        return [self.start_server(worker_id=worker, workers=2, bus_path=bus_path)[1] for worker in range(2)]
+
+    def test_join_on_other_worker_replays_earlier_messages(self):
+        port_a, port_b = self.start_workers()
+        alice = self.connect(port_a, 'alice')
+        alice.send("JOIN #quiet\r\nPRIVMSG #quiet :sent before anyone on b\r\nPING :sent\r\n")
+        alice.wait_for("PONG")
+        time.sleep(0.2)  # let the bus carry the message over
+
+        bob = self.connect(port_b, 'bob')
+        bob.send("JOIN #quiet\r\n")
+        replay = bob.wait_for("End of #quiet history")
+        self.assertIn(b":alice PRIVMSG #quiet :sent before anyone on b", replay)
+
+        bob.send("CHATHISTORY LATEST #quiet * 10\r\n")
+        bob.data = b''
+        self.assertIn(b"sent before anyone on b", bob.wait_for("End of #quiet history"))
+
+class FloodControlTest(ServerTestCase):
+    def test_paste_is_paced_and_delivered_in_full(self):
+        _, port = self.start_server(flood_rate=50, flood_burst=20)
+        reader = self.connect(port, 'reader')
+        reader.send("JOIN #paste\r\n")
+        reader.wait_for("End of /NAMES")
+        paster = self.connect(port, 'paster')
+        paster.send("JOIN #paste\r\n" + "".join(f"PRIVMSG #paste :line {i}\r\n" for i in range(100)))
+        received = reader.wait_for("PRIVMSG #paste :line 99\r\n", timeout=10)
+        self.assertEqual(received.count(b"PRIVMSG #paste :line "), 100)
+        paster.send("PING :after\r\n")
+        self.assertNotIn(b"Excess Flood", paster.wait_for("PONG"))
+
+    def test_repeated_bursts_add_up_to_a_disconnect(self):
+        flood = FloodControl(rate=5, burst=5, max_strikes=2)
+        session = Session(None, '192.0.2.1')
+        flood.assign(session)
+        for burst in range(3):
+            session.tokens = 0.0  # back under the limit, then over it again
+            session.stamp = time.monotonic()
+            delays = [flood.charge(session, b"PRIVMSG #c :x") for _ in range(10)]
+            self.assertTrue(all(delays))
+            self.assertAlmostEqual(session.strikes, burst + 1, places=2)
+        self.assertGreater(session.strikes, flood.default.max_strikes)
+
+class ChannelModeAndWhoisTest(ServerTestCase):
+    def test_only_the_founder_changes_modes(self):
+        _, port = self.start_server()
+        founder = self.connect(port, 'founder')
+        founder.send("JOIN #own\r\n")
+        founder.wait_for("End of /NAMES")
+        member = self.connect(port, 'member')
+        member.send("JOIN #own\r\nMODE #own +s\r\n")
+        member.wait_for("482 member #own")
+        founder.send("MODE #own +s\r\n")
+        founder.wait_for("MODE #own +s")
+
+    def test_whois_cloaks_other_users_address(self):
+        _, port = self.start_server()
+        alice = self.connect(port, 'alice')
+        bob = self.connect(port, 'bob')
+        bob.send("WHOIS alice\r\n")
+        reply = bob.wait_for("318 bob alice")
+        self.assertNotIn(b"127.0.0.1", reply)
+        self.assertIn(b".cloak", reply)
+        alice.send("WHOIS alice\r\n")
+        self.assertIn(b"311 alice alice alice 127.0.0.1", alice.wait_for("318 alice alice"))
+
+if __name__ == "__main__":
+    unittest.main()